@@ -0,0 +1,278 @@
+import ast
+import asyncio
+import statistics
+from array import array
+from math import log, sqrt
+from itertools import count
+
+import pytest
+
+from as7341_sensor import Sensor
+
+
+def test_mock_measure():
+    sensor = Sensor()
+    sensor.prepare()
+    assert sensor._prepared == "F1F4CN"
+    assert sensor.measure("F1F4CN") == [100, 200, 300, 400, 0, 0]
+    assert sensor.measure("F5F8CN") == [500, 600, 700, 800, 0, 0]
+    assert sensor._prepared is None
+
+
+def test_mock_measure_keeps_the_bank_order():
+    sensor = Sensor()
+    sensor._bank_order = ("F5F8CN", "F1F4CN")
+    sensor.measure("F5F8CN")
+    assert sensor._bank_order == ("F5F8CN", "F1F4CN")
+
+
+def test_mock_measure_async():
+    sensor = Sensor(auto_exposure=True)
+    assert asyncio.run(sensor.measure_async("F5F8CN")) == [500, 600, 700, 800, 0, 0]
+    assert asyncio.run(sensor.all_channels_async()) == sensor.all_channels
+
+
+class FakeAS7341:
+    """Records the settings of the chip, with all counts at `count`."""
+
+    count = 1000
+
+    def __init__(self, i2c):
+        self.again_codes = []
+
+    def isconnected(self):
+        return True
+
+    def set_measure_mode(self, mode):
+        pass
+
+    def set_atime(self, value):
+        self.atime = value
+
+    def set_astep(self, value):
+        self.astep = value
+
+    def set_again(self, code):
+        self.again_codes.append(code)
+
+
+class FakePin:
+    IN = PULL_UP = IRQ_FALLING = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+class FakeI2C(FakePin):
+    def scan(self):
+        return [0x39]
+
+
+def load_driver():
+    """Define the Sensor class of lib/as7341_sensor.py with a fake chip."""
+    script_name = "lib/as7341_sensor.py"
+    tree = ast.parse(open(script_name).read())
+    nodes = [node for node in tree.body if isinstance(node, ast.ClassDef)]
+    namespace = {
+        "AS7341": FakeAS7341,
+        "AS7341_MODE_SPM": None,
+        "I2C": FakeI2C,
+        "Pin": FakePin,
+        "array": array,
+        "log": log,
+        "sqrt": sqrt,
+        "ticks_ms": count(step=10).__next__,
+        "ticks_diff": lambda end, start: end - start,
+    }
+    exec(
+        compile(ast.Module(body=nodes, type_ignores=[]), script_name, "exec"), namespace
+    )
+    return namespace["Sensor"]
+
+
+@pytest.mark.parametrize("gain, code", [(0.5, 0), (1, 1), (8, 4), (512, 10)])
+def test_driver_sets_the_gain_code(gain, code):
+    sensor = load_driver()(gain=gain)
+    assert sensor.sensor.again_codes == [code]
+    assert sensor._gain == gain
+
+
+def test_driver_reports_and_scales_with_the_gain_factor():
+    sensor = load_driver()(atime=29, astep=599, gain=8, auto_exposure=True)
+    assert (sensor.sensor.atime, sensor.sensor.astep) == (29, 599)
+    scale = sensor.integration_ms * 8
+    assert sensor._report([scale, 2 * scale]) == pytest.approx([1, 2])
+
+    # too dim by 4x, with the longest integration time already: gain 8x -> 32x
+    assert sensor._scale_exposure(4)
+    assert sensor._gain == 32
+    assert sensor.sensor.again_codes == [4, 6]
+
+
+def sample_readings(n_samples):
+    """Readings of F1-F8 that differ per channel and per reading."""
+    return [[(k + 1) * (i + 1) ** 2 for i in range(8)] for k in range(n_samples)]
+
+
+def fake_readings(sensor, readings):
+    readings = iter(readings)
+
+    async def read_async():
+        return next(readings)
+
+    sensor._read_channels = lambda: next(readings)
+    sensor._read_channels_async = read_async
+
+
+def check_stats(stats, readings):
+    columns = list(zip(*readings))
+    assert list(stats["mean"]) == pytest.approx(
+        [statistics.mean(c) for c in columns], rel=1e-6
+    )
+    std = [statistics.stdev(c) if len(readings) > 1 else 0 for c in columns]
+    assert list(stats["std"]) == pytest.approx(std, rel=1e-5)
+    assert list(stats["min"]) == [min(c) for c in columns]
+    assert list(stats["max"]) == [max(c) for c in columns]
+
+
+@pytest.mark.parametrize("n_samples", [1, 2, 5])
+def test_driver_read_stats(n_samples):
+    sensor = load_driver()()
+    readings = sample_readings(n_samples)
+    fake_readings(sensor, readings)
+    check_stats(sensor.read_stats(n_samples), readings)
+
+
+def test_driver_read_stats_async():
+    sensor = load_driver()()
+    readings = [
+        [x + 0.5 * (-1) ** k for x in row] for k, row in enumerate(sample_readings(4))
+    ]
+    fake_readings(sensor, readings)
+    check_stats(asyncio.run(sensor.read_stats_async(4)), readings)
+
+
+def test_driver_read_stats_reuses_its_buffers():
+    sensor = load_driver()()
+    first, second = sample_readings(3), [[7] * 8, [9] * 8]
+    fake_readings(sensor, first + second)
+    stats = sensor.read_stats(3)
+    buffers = {key: id(stats[key]) for key in stats}
+    assert all(isinstance(stats[key], array) for key in stats)
+
+    # the second call starts over rather than carrying on from the first
+    stats = sensor.read_stats(2)
+    assert {key: id(stats[key]) for key in stats} == buffers
+    check_stats(stats, second)
+    assert list(stats["std"]) == pytest.approx([sqrt(2)] * 8)
+
+
+def test_driver_all_channels_averages_n_samples():
+    sensor = load_driver()(n_samples=3)
+    readings = sample_readings(3)
+    fake_readings(sensor, readings)
+    assert sensor.all_channels == pytest.approx([2 * (i + 1) ** 2 for i in range(8)])
+    assert sensor.read_ms == 10
+    check_stats(sensor.stats, readings)
+
+
+class SimulatedBus:
+    """An AS7341 on a simulated I2C bus, where every transaction takes
+    `transaction_ms` and the sleeps of the driver advance the same clock."""
+
+    ENABLE, SMUXEN, SP_EN = 0x80, 0x10, 0x02
+    STATUS_2, AVALID, ASTATUS, ID = 0xA3, 0x40, 0x94, 0x92
+    ATIME, ASTEP = 0x81, 0xCA
+
+    def __init__(self, transaction_ms=0.25):
+        self.now = 0.0
+        self.transaction_ms = transaction_ms
+        self.registers = bytearray(256)
+        self.registers[self.ID] = 0x24
+        self.started = None  # when the current measurement started
+        self.smux_writes = 0
+
+    def sleep_ms(self, ms):
+        self.now += ms
+
+    def integration_ms(self):
+        astep = self.registers[self.ASTEP] | self.registers[self.ASTEP + 1] << 8
+        return (self.registers[self.ATIME] + 1) * (astep + 1) * 2.78 / 1000
+
+    def writeto_mem(self, address, reg, buffer):
+        self.now += self.transaction_ms
+        self.registers[reg : reg + len(buffer)] = buffer
+        self.smux_writes += reg == 0 and len(buffer) == 20
+        if reg == self.ENABLE:
+            self.registers[reg] &= ~self.SMUXEN  # the SMUX command is done
+            if not self.registers[reg] & self.SP_EN:
+                self.started = None
+            elif self.started is None:
+                self.started = self.now
+
+    def readfrom_mem_into(self, address, reg, buffer):
+        self.now += self.transaction_ms
+        if reg == self.STATUS_2:
+            completed = self.started is not None and (
+                self.now >= self.started + self.integration_ms()
+            )
+            buffer[0] = self.AVALID if completed else 0
+        elif reg == self.ASTATUS:
+            buffer[:] = bytes(len(buffer))
+        else:
+            buffer[:] = self.registers[reg : reg + len(buffer)]
+
+    def scan(self):
+        return [0x39]
+
+
+def load_module(script_name, namespace):
+    """Define everything in a lib module but its imports in namespace."""
+    tree = ast.parse(open(script_name).read())
+    nodes = [
+        node for node in tree.body if not isinstance(node, (ast.Import, ast.ImportFrom))
+    ]
+    exec(
+        compile(ast.Module(body=nodes, type_ignores=[]), script_name, "exec"), namespace
+    )
+    return namespace
+
+
+def simulated_sensor(**kwargs):
+    """The Sensor of lib/as7341_sensor.py with the driver of lib/as7341.py."""
+    bus = SimulatedBus()
+    namespace = {
+        "const": lambda value: value,
+        "sleep_ms": bus.sleep_ms,
+        "ticks_ms": lambda: int(bus.now),
+        "ticks_diff": lambda end, start: end - start,
+        "I2C": FakeI2C,
+        "Pin": FakePin,
+        "array": array,
+        "log": log,
+        "sqrt": sqrt,
+        "print": lambda *args: None,
+    }
+    for module in ["as7341_smux_select", "as7341", "as7341_sensor"]:
+        load_module(f"lib/{module}.py", namespace)
+        namespace["AS7341_MODE_SPM"] = namespace.get("AS7341_CONFIG_INT_MODE_SPM")
+    return namespace["Sensor"](i2c=bus, **kwargs), bus
+
+
+@pytest.mark.parametrize("settings", [{}, {"atime": 29, "astep": 599}])
+def test_driver_reading_time_on_a_simulated_bus(settings):
+    sensor, bus = simulated_sensor(**settings)
+    integration_ms = bus.integration_ms()
+    sensor.prepare()  # as the device does after every experiment
+    for _ in range(3):
+        start, smux_writes = bus.now, bus.smux_writes
+        sensor.all_channels
+        elapsed_ms = bus.now - start
+        # two integrations (8 channels on 6 ADCs) and one SMUX configuration
+        assert 2 * integration_ms <= elapsed_ms <= 2 * integration_ms + 60
+        assert bus.smux_writes - smux_writes == 1
+        assert sensor.read_ms == pytest.approx(elapsed_ms, abs=1)
+
+        start = bus.now
+        sensor.prepare()
+        assert bus.now - start < 20  # arming happens between experiments
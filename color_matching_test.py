@@ -0,0 +1,183 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from color_matching import (
+    evaluate_unordered,
+    grid_color_search,
+    iter_color_grid,
+    random_color_search,
+    stream_grid_color_search,
+)
+
+
+def total_power(params):
+    return params["R"] + params["G"] + params["B"]
+
+
+def slow_for_low_indices(x):
+    time.sleep(0.05 * (3 - x))
+    return x
+
+
+@pytest.mark.parametrize("executor", ["thread", "process", "asyncio"])
+def test_grid_search_executors_match_serial(executor):
+    expected = grid_color_search(total_power, 27)
+    assert grid_color_search(total_power, 27, executor=executor) == expected
+
+
+def test_random_search_with_existing_executor():
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        inputs, scores = random_color_search(total_power, 5, executor=executor)
+        executor.submit(int).result()  # still usable afterwards
+    assert scores == [total_power(x) for x in inputs]
+
+
+def test_on_result_is_called_for_every_input():
+    calls = []
+    grid, scores = grid_color_search(
+        total_power, 8, executor="thread", on_result=lambda *args: calls.append(args)
+    )
+    assert sorted(calls, key=lambda c: c[0]) == list(
+        zip(range(len(grid)), grid, scores)
+    )
+
+
+def test_evaluate_unordered_yields_in_completion_order():
+    results = list(evaluate_unordered(slow_for_low_indices, range(4), "thread"))
+    assert [i for i, _ in results] == [3, 2, 1, 0]
+    assert all(i == score for i, score in results)
+
+
+def test_evaluate_unordered_with_coroutine_function():
+    async def evaluate(x):
+        await asyncio.sleep(0.05 * (3 - x))
+        return 10 * x
+
+    results = list(evaluate_unordered(evaluate, range(4), executor="asyncio"))
+    assert results == [(3, 30), (2, 20), (1, 10), (0, 0)]
+
+
+@pytest.mark.parametrize("executor", ["thread", "asyncio"])
+def test_max_in_flight(executor):
+    lock = threading.Lock()
+    running, peak = [0], [0]
+
+    def evaluate(x):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return x
+
+    results = evaluate_unordered(evaluate, range(10), executor, max_in_flight=2)
+    assert sorted(results) == [(i, i) for i in range(10)]
+    assert peak[0] == 2
+
+
+def test_invalid_arguments():
+    with pytest.raises(ValueError):
+        list(evaluate_unordered(total_power, [], executor="gpu"))
+    with pytest.raises(ValueError):
+        list(evaluate_unordered(total_power, [], max_in_flight=0))
+
+
+def test_iter_color_grid_matches_grid_search():
+    grid, _ = grid_color_search(total_power, 100)
+    assert list(iter_color_grid(100)) == grid
+    assert list(iter_color_grid(num_pts_per_dim=4)) == grid
+
+
+def test_iter_color_grid_bounds():
+    bounds = {"R": [0, 65535], "G": [0, 65535], "B": [0.0, 1.0]}
+    points = list(iter_color_grid(num_pts_per_dim=3, color_bounds=bounds))
+    assert len(points) == 27
+    assert {p["R"] for p in points} == {0, 32768, 65535}
+    assert {p["B"] for p in points} == {0.0, 0.5, 1.0}
+    with pytest.raises(ValueError):
+        next(iter_color_grid())
+
+
+def distance_to_target(params):
+    return abs(params["R"] - 100) + params["G"] + params["B"]
+
+
+@pytest.mark.parametrize("executor", [None, "thread"])
+def test_stream_grid_search_finds_the_best_point(executor):
+    best_params, best_score, n_evaluated = stream_grid_color_search(
+        distance_to_target, num_pts_per_dim=11, chunk_size=100, executor=executor
+    )
+    grid, scores = grid_color_search(distance_to_target, 1400)
+    assert best_score == min(scores)
+    assert best_params == grid[scores.index(min(scores))]
+    assert n_evaluated == 11**3
+
+
+def test_stream_grid_search_batch_and_on_result():
+    chunks, results = [], []
+
+    def evaluate_chunk(chunk):
+        chunks.append(len(chunk))
+        return [distance_to_target(params) for params in chunk]
+
+    best_params, best_score, n_evaluated = stream_grid_color_search(
+        evaluate_chunk,
+        num_pts_per_dim=5,
+        chunk_size=50,
+        batch=True,
+        on_result=lambda i, params, score: results.append(score),
+    )
+    assert chunks == [50, 50, 25]
+    assert len(results) == n_evaluated == 125
+    assert best_score == min(results)
+
+
+@pytest.mark.parametrize("executor", [None, "thread"])
+def test_one_on_result_for_every_search(executor):
+    def search_results(search, *args, **kwargs):
+        calls = []
+
+        def on_result(i, params, score):
+            calls.append((i, params, score))
+
+        search(distance_to_target, *args, on_result=on_result, **kwargs)
+        return sorted(calls, key=lambda call: call[0])
+
+    grid, scores = grid_color_search(distance_to_target, 30)
+    expected = [(i, grid[i], scores[i]) for i in range(len(grid))]
+    assert len(expected) == 27
+    assert search_results(grid_color_search, 30, executor=executor) == expected
+    assert (
+        search_results(
+            stream_grid_color_search,
+            num_iter=30,
+            chunk_size=10,
+            executor=executor,
+        )
+        == expected
+    )
+
+    calls = search_results(random_color_search, 5, executor=executor)
+    assert [i for i, params, score in calls] == list(range(5))
+    assert all(score == distance_to_target(params) for i, params, score in calls)
+
+
+def test_stream_grid_search_stops_early():
+    checks = []
+
+    def early_stop(best_score, n_evaluated):
+        checks.append(n_evaluated)
+        return best_score == 0
+
+    best_params, best_score, n_evaluated = stream_grid_color_search(
+        distance_to_target, num_pts_per_dim=256, early_stop=early_stop
+    )
+    assert (best_params, best_score) == ({"R": 100, "G": 0, "B": 0}, 0)
+    assert checks == [1000] and n_evaluated == 1000
+    with pytest.raises(ValueError):
+        stream_grid_color_search(distance_to_target, 8, chunk_size=0)
@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+
+from database import Database, get_database
+from database import _database
+
+
+class FakeAdmin:
+    def __init__(self):
+        self.commands = []
+
+    def command(self, name):
+        self.commands.append(name)
+
+
+class FakeMongoClient:
+    """Records how it was created; hands out dicts as databases."""
+
+    instances = []
+
+    def __init__(self, uri, **kwargs):
+        self.uri = uri
+        self.kwargs = kwargs
+        self.admin = FakeAdmin()
+        self.databases = {}
+        self.closed = False
+        FakeMongoClient.instances.append(self)
+
+    def __getitem__(self, name):
+        return self.databases.setdefault(name, {})
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture(autouse=True)
+def fake_client(monkeypatch):
+    FakeMongoClient.instances = []
+    monkeypatch.setattr(_database, "MongoClient", FakeMongoClient)
+    monkeypatch.setattr(_database, "_databases", {})
+
+
+def test_client_is_created_lazily_and_reused():
+    database = Database("mongodb://example", "test-db")
+    assert not database.connected
+    assert FakeMongoClient.instances == []
+
+    database.db["results"] = "collection"
+    assert database["results"] == "collection"
+    assert database.connected
+    assert len(FakeMongoClient.instances) == 1
+    assert FakeMongoClient.instances[0].uri == "mongodb://example"
+
+
+def test_pool_and_timeout_settings_are_passed_in_ms():
+    database = Database(
+        "mongodb://example",
+        "test-db",
+        max_pool_size=4,
+        max_idle_time=30,
+        connect_timeout=2.5,
+        appname="orchestrator",
+    )
+    database.ping()
+    kwargs = FakeMongoClient.instances[0].kwargs
+    assert kwargs["maxPoolSize"] == 4
+    assert kwargs["minPoolSize"] == 0
+    assert kwargs["maxIdleTimeMS"] == 30000
+    assert kwargs["connectTimeoutMS"] == 2500
+    assert kwargs["serverSelectionTimeoutMS"] == 10000
+    assert kwargs["socketTimeoutMS"] is None
+    assert kwargs["appname"] == "orchestrator"
+    assert FakeMongoClient.instances[0].admin.commands == ["ping"]
+
+
+def test_close_closes_the_client_and_it_is_recreated_on_next_use():
+    with Database("mongodb://example", "test-db") as database:
+        database.ping()
+        first = database.client
+    assert first.closed
+    assert not database.connected
+
+    database.ping()
+    assert database.client is not first
+    assert len(FakeMongoClient.instances) == 2
+
+
+def test_concurrent_first_use_creates_one_client():
+    database = Database("mongodb://example", "test-db")
+    threads = [threading.Thread(target=lambda: database.client) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(FakeMongoClient.instances) == 1
+
+
+def test_get_database_shares_one_handle_per_database(monkeypatch):
+    monkeypatch.setenv("ATLAS_URI", "mongodb://example")
+    monkeypatch.setenv("DATABASE_NAME", "test-db")
+
+    database = get_database()
+    assert get_database() is database
+    assert get_database("mongodb://example", "test-db") is database
+    assert (database.uri, database.name) == ("mongodb://example", "test-db")
+    assert get_database(name="other-db") is not database
@@ -0,0 +1,129 @@
+import pytest
+
+from evaluation_cache import EvaluationCache, MongoEvaluationCache
+from evaluation_cache import _evaluation_cache
+
+
+def command(R, G=20, B=30):
+    return {"R": R, "G": G, "B": B}
+
+
+class FakeCollection:
+    """Evaluates the range queries of MongoEvaluationCache on a list of documents."""
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find(self, query, projection=None):
+        def matches(document):
+            for field, condition in query.items():
+                value = document
+                for part in field.split("."):
+                    value = value.get(part) if isinstance(value, dict) else None
+                if (
+                    "$exists" in condition
+                    and (value is not None) != condition["$exists"]
+                ):
+                    return False
+                if "$gte" in condition and not value >= condition["$gte"]:
+                    return False
+                if "$lte" in condition and not value <= condition["$lte"]:
+                    return False
+            return True
+
+        return FakeCursor([d for d in self.documents if matches(d)])
+
+
+class FakeCursor(list):
+    def sort(self, key, direction):
+        return FakeCursor(self[::-1] if direction < 0 else self)
+
+    def limit(self, n):
+        return FakeCursor(self[:n])
+
+
+@pytest.mark.parametrize("tolerance", [1, 2, 5])
+def test_tolerance_is_plus_minus_at_bin_edges(tolerance):
+    for measured in range(0, 12):
+        cache = EvaluationCache(tolerance=tolerance)
+        cache.add(command(measured), {"sensor_data": {"ch410": measured}})
+        for requested in range(measured - tolerance - 2, measured + tolerance + 3):
+            hit = cache.lookup(command(requested)) is not None
+            assert hit == (
+                abs(requested - measured) <= tolerance
+            ), f"tolerance={tolerance}, measured R={measured}, requested R={requested}"
+
+
+def test_tolerance_applies_to_every_channel():
+    cache = EvaluationCache(tolerance=2)
+    cache.add(command(11, 11, 11), {"sensor_data": {}})
+    assert cache.lookup(command(13, 9, 12)) is not None
+    assert cache.lookup(command(13, 8, 12)) is None
+
+
+@pytest.mark.parametrize("tolerance", [0, 2])
+def test_tolerance_matches_mongo_cache(tolerance):
+    measured = [command(R) for R in (3, 11, 12, 20)]
+    local_cache = EvaluationCache(tolerance=tolerance)
+    for c in measured:
+        local_cache.add(c, {"command": c, "sensor_data": {}})
+    mongo_cache = MongoEvaluationCache(
+        FakeCollection([{"command": c, "sensor_data": {}} for c in measured]),
+        tolerance=tolerance,
+    )
+    for R in range(0, 25):
+        local_hit = local_cache.lookup(command(R)) is not None
+        mongo_hit = mongo_cache.lookup(command(R)) is not None
+        assert local_hit == mongo_hit, f"tolerance={tolerance}, R={R}"
+
+
+def test_exact_commands_without_tolerance():
+    cache = EvaluationCache()
+    cache.add(command(10), {"sensor_data": {"ch410": 1}})
+    assert cache.lookup(command(10)) == {"sensor_data": {"ch410": 1}}
+    assert cache.lookup(command(11)) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_replicates_are_collected_then_cycled():
+    cache = EvaluationCache(tolerance=2, replicates=2)
+    cache.add(command(10), {"n": 1})
+    assert cache.lookup(command(10)) is None  # measure again
+    cache.add(command(11), {"n": 2})
+    cache.add(command(10), {"n": 3})  # the newest two are reused
+    assert [cache.lookup(command(10))["n"] for _ in range(4)] == [3, 2, 3, 2]
+
+
+def test_replicates_zero_never_reuses():
+    cache = EvaluationCache(replicates=0)
+    cache.add(command(10), {"n": 1})
+    assert cache.lookup(command(10)) is None
+
+
+def test_max_age(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(_evaluation_cache, "time", lambda: now[0])
+    cache = EvaluationCache(tolerance=2, max_age=60)
+    cache.add(command(10), {"n": 1})
+    now[0] += 59
+    assert cache.lookup(command(11)) == {"n": 1}
+    now[0] += 2
+    assert cache.lookup(command(11)) is None
+
+
+def test_least_recently_used_bins_are_evicted():
+    cache = EvaluationCache(max_entries=2)
+    cache.add(command(1), {"n": 1})
+    cache.add(command(2), {"n": 2})
+    cache.lookup(command(1))  # now the most recently used
+    cache.add(command(3), {"n": 3})
+    assert cache.lookup(command(2)) is None
+    assert cache.lookup(command(1)) == {"n": 1}
+    assert cache.lookup(command(3)) == {"n": 3}
+
+
+def test_lookup_returns_a_copy():
+    cache = EvaluationCache()
+    cache.add(command(1), {"n": 1})
+    cache.lookup(command(1))["n"] = 2
+    assert cache.lookup(command(1)) == {"n": 1}
@@ -0,0 +1,768 @@
+import asyncio
+import json
+import socket
+import struct
+import threading
+from types import SimpleNamespace
+
+import pytest
+from paho.mqtt import client as mqtt_client
+
+from experiment_transport import (
+    AsyncExperimentTransport,
+    DeviceBusyError,
+    DeviceRegistry,
+    ExperimentTransport,
+    ResponseRouter,
+    decode_results,
+    encode_results,
+    make_batch_payload,
+    parse_results,
+    unpack_results,
+)
+from experiment_transport import _experiment_transport
+from microcontroller_logging_test import load_functions
+
+results_topic = "test/as7341"
+command_topic = "test/neopixel"
+
+
+class FakeClient:
+    """
+    Stands in for the Paho client: publishing to the command topic of a device
+    in `devices` runs that device, and its replies are delivered to on_message
+    (after `delay` seconds, from another thread, if delay is set).
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.devices = {}  # command topic -> device(payload_dict) -> replies
+        self.published = []
+        self.subscriptions = []
+        self.delay = 0
+
+    def tls_set(self, **kwargs):
+        pass
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def connect(self, host, port):
+        self.on_connect(self, None, {}, 0)
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def socket(self):
+        return None  # replies are delivered without one
+
+    def loop_misc(self):
+        return mqtt_client.MQTT_ERR_SUCCESS
+
+    def subscribe(self, subscriptions):
+        self.subscriptions.extend(subscriptions)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        payload_dict = json.loads(payload)
+        self.published.append((topic, payload_dict))
+        device = self.devices.get(topic)
+        if device is not None:
+            for reply_topic, reply in device(payload_dict):
+                self.deliver(reply_topic, reply)
+
+    def deliver(self, topic, payload):
+        if isinstance(payload, dict):
+            payload = json.dumps(payload).encode()
+        msg = SimpleNamespace(topic=topic, payload=payload)
+        if self.delay:
+            threading.Timer(self.delay, self.on_message, (self, None, msg)).start()
+        else:
+            self.on_message(self, None, msg)
+
+
+def sensor_data(command):
+    return {"ch410": command["R"], "ch440": command["G"], "ch470": command["B"]}
+
+
+def echo(payload_dict):
+    """A device that replies with the payload and its sensor data."""
+    results = {**payload_dict, "sensor_data": sensor_data(payload_dict["command"])}
+    return [(results_topic, results)]
+
+
+def batch_echo(batch_payload):
+    """A device that runs batch payloads like the microcontroller's run_batch."""
+    session_id = batch_payload["session_id"]
+    results = [
+        {**item, "session_id": session_id, "sensor_data": sensor_data(item["command"])}
+        for item in batch_payload["batch"]
+    ]
+    if batch_payload["aggregate"]:
+        batch = [{k: v for k, v in r.items() if k != "session_id"} for r in results]
+        return [(results_topic, {"session_id": session_id, "batch": batch})]
+    return [(results_topic, r) for r in reversed(results)]
+
+
+def payload(i, session_id="s1"):
+    return {
+        "command": {"R": i, "G": 0, "B": 0},
+        "experiment_id": f"e{i}",
+        "session_id": session_id,
+    }
+
+
+@pytest.fixture
+def transport(monkeypatch):
+    monkeypatch.setattr(mqtt_client, "Client", FakeClient)
+    transport = ExperimentTransport(results_topic, "localhost", "user", tls=False)
+    transport.client.devices[command_topic] = echo
+    yield transport
+    transport.close()
+
+
+def test_subscribes_on_connect(transport):
+    assert (results_topic, 2) in transport.client.subscriptions
+    assert (results_topic + "/bin", 2) in transport.client.subscriptions
+
+
+def test_run_experiment(transport):
+    results = transport.run_experiment(command_topic, payload(7))
+    assert results["experiment_id"] == "e7"
+    assert results["sensor_data"] == sensor_data(payload(7)["command"])
+    assert transport.client.published == [(command_topic, payload(7))]
+
+
+def test_run_experiment_skips_other_results(transport):
+    def device(payload_dict):
+        # a late reply to an earlier experiment arrives first
+        return [(results_topic, {**payload(1), "sensor_data": {}})] + echo(payload_dict)
+
+    transport.client.devices[command_topic] = device
+    transport.client.delay = 0.01
+    results = transport.run_experiment(command_topic, payload(2))
+    assert results["experiment_id"] == "e2"
+
+
+def test_run_experiment_timeout(transport):
+    del transport.client.devices[command_topic]
+    with pytest.raises(TimeoutError):
+        transport.run_experiment(command_topic, payload(3), timeout=0.05)
+    assert transport.router.n_waiting == 0
+
+
+def run_async(monkeypatch, main, client_class=FakeClient):
+    """Run main(transport) with a connected AsyncExperimentTransport."""
+    monkeypatch.setattr(mqtt_client, "Client", client_class)
+
+    async def run():
+        transport = AsyncExperimentTransport(
+            results_topic, "localhost", "user", tls=False
+        )
+        transport.client.devices[command_topic] = echo
+        async with transport:
+            return await main(transport)
+
+    return asyncio.run(run())
+
+
+def test_async_run_experiment(monkeypatch):
+    async def main(transport):
+        return await asyncio.gather(
+            *[transport.run_experiment(command_topic, payload(i)) for i in range(5)]
+        )
+
+    results = run_async(monkeypatch, main)
+    assert [r["experiment_id"] for r in results] == [f"e{i}" for i in range(5)]
+    assert results[3]["sensor_data"] == sensor_data(payload(3)["command"])
+
+
+def test_async_run_experiment_timeout(monkeypatch):
+    async def main(transport):
+        del transport.client.devices[command_topic]
+        with pytest.raises(TimeoutError):
+            await transport.run_experiment(command_topic, payload(1), timeout=0.05)
+        return transport.router.n_waiting
+
+    assert run_async(monkeypatch, main) == 0
+
+
+def test_router_matches_on_session_and_experiment_id():
+    router = ResponseRouter()
+    assert router.expect(payload(1), "waiter 1") is None
+    assert router.expect(payload(1, session_id="s2"), "waiter 2") is None
+    assert router.dispatch({**payload(1), "sensor_data": {}}) == "waiter 1"
+    assert router.dispatch({**payload(1), "sensor_data": {}}) is None  # buffered
+    assert router.dispatch({**payload(1, "s2"), "sensor_data": {}}) == "waiter 2"
+    assert router.n_waiting == 0
+
+
+def test_router_buffers_early_results():
+    router = ResponseRouter()
+    results = {**payload(1), "sensor_data": {"ch410": 1}}
+    assert router.dispatch(results) is None
+    assert router.n_buffered == 1
+    assert router.expect(payload(1), "waiter") == results
+    assert router.n_buffered == 0 and router.n_waiting == 0
+
+
+def test_router_does_not_buffer_when_told_not_to():
+    router = ResponseRouter()
+    assert router.dispatch({**payload(1), "status": "busy"}, buffer=False) is None
+    assert router.n_buffered == 0
+
+
+def test_router_cancel():
+    router = ResponseRouter()
+    router.expect(payload(1), "waiter")
+    router.cancel(payload(1))
+    assert router.n_waiting == 0
+    assert router.dispatch({**payload(1), "sensor_data": {}}) is None
+
+
+def test_router_evicts_by_count_and_age(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(_experiment_transport, "monotonic", lambda: now[0])
+    router = ResponseRouter(ttl=10, max_buffered=2)
+    for i in range(3):
+        router.dispatch({**payload(i), "sensor_data": {}})
+    assert router.n_buffered == 2 and router.evictions == 1  # oldest went first
+    assert router.expect(payload(0), "waiter") is None
+    now[0] = 11
+    assert router.expect(payload(2), "waiter") is None  # too old
+    assert router.n_buffered == 0 and router.evictions == 3
+
+
+def test_unclaimed_busy_reply_is_dropped_quietly(transport, capsys):
+    transport.client.deliver(results_topic, {**payload(1), "status": "busy"})
+    assert transport.router.n_buffered == 0
+    assert "Buffering" not in capsys.readouterr().out
+
+    transport.client.deliver(results_topic, {**payload(2), "sensor_data": {}})
+    assert transport.router.n_buffered == 1
+    assert "Buffering unclaimed results" in capsys.readouterr().out
+
+
+def test_make_batch_payload():
+    payloads = [{**payload(i), "encoding": "binary"} for i in range(2)]
+    assert make_batch_payload(payloads, aggregate=True) == {
+        "session_id": "s1",
+        "batch": [{k: v for k, v in p.items() if k != "session_id"} for p in payloads],
+        "aggregate": True,
+        "encoding": "binary",
+    }
+    assert "encoding" not in make_batch_payload([payloads[0], payload(2)])
+    with pytest.raises(ValueError):
+        make_batch_payload([payload(1), payload(2, session_id="s2")])
+
+
+def test_unpack_results():
+    results = {**payload(1), "sensor_data": {}}
+    assert unpack_results(results) == [results]
+    aggregated = {
+        "session_id": "s1",
+        "batch": [{"experiment_id": "e1", "sensor_data": {}}],
+    }
+    assert unpack_results(aggregated) == [
+        {"session_id": "s1", "experiment_id": "e1", "sensor_data": {}}
+    ]
+
+
+@pytest.mark.parametrize("aggregate", [False, True])
+def test_run_experiment_batch(transport, aggregate):
+    transport.client.devices[command_topic] = batch_echo
+    payloads = [payload(i) for i in range(3)]
+    results = transport.run_experiment_batch(
+        command_topic, payloads, aggregate=aggregate
+    )
+    assert [r["experiment_id"] for r in results] == ["e0", "e1", "e2"]
+    assert results[2]["sensor_data"] == sensor_data(payloads[2]["command"])
+    assert transport.client.published == [
+        (command_topic, make_batch_payload(payloads, aggregate=aggregate))
+    ]
+    assert transport.router.n_waiting == 0
+
+
+def test_submit_batch_skips_buffered_results(transport):
+    transport.client.devices[command_topic] = batch_echo
+    early = {**payload(1), "sensor_data": {"ch410": -1}}
+    transport.client.deliver(results_topic, early)
+    futures = transport.submit_batch(command_topic, [payload(i) for i in range(3)])
+    assert [f.result(timeout=1)["experiment_id"] for f in futures] == ["e0", "e1", "e2"]
+    assert futures[1].result() == early
+    [(_, batch_payload)] = transport.client.published
+    assert [item["experiment_id"] for item in batch_payload["batch"]] == ["e0", "e2"]
+
+
+def test_run_experiment_batch_timeout(transport):
+    del transport.client.devices[command_topic]
+    with pytest.raises(TimeoutError, match="3 experiment"):
+        transport.run_experiment_batch(
+            command_topic, [payload(i) for i in range(3)], timeout=0.05
+        )
+    assert transport.router.n_waiting == 0
+
+
+def test_async_run_experiment_batch(monkeypatch):
+    async def main(transport):
+        transport.client.devices[command_topic] = batch_echo
+        return await transport.run_experiment_batch(
+            command_topic, [payload(i) for i in range(3)], aggregate=True
+        )
+
+    results = run_async(monkeypatch, main)
+    assert [r["experiment_id"] for r in results] == ["e0", "e1", "e2"]
+
+
+CHANNEL_NAMES = ["ch410", "ch440", "ch470", "ch510", "ch550", "ch583", "ch620", "ch670"]
+
+
+def json_results(i, n_samples=1, counts=True):
+    """Results of the shape that the device publishes in JSON."""
+    values = [i + k if counts else i + k + 0.25 for k in range(8)]
+    results = {
+        "command": {"R": i, "G": 2 * i, "B": 3 * i},
+        "experiment_id": f"e{i}",
+        "session_id": "s1",
+        "sensor_data": dict(zip(CHANNEL_NAMES, values)),
+        "timing": {"led_ms": 10, "measure_ms": 300 * n_samples, "total_ms": 320},
+    }
+    if n_samples > 1:
+        results["sensor_stats"] = {
+            key: dict(zip(CHANNEL_NAMES, [v + offset for v in values]))
+            for key, offset in (("std", 0.5), ("min", -1.0), ("max", 1.0))
+        }
+        results["sensor_stats"]["n_samples"] = n_samples
+    return results
+
+
+def test_binary_results_have_the_json_shape():
+    records = [
+        json_results(1),
+        json_results(2, n_samples=5),
+        json_results(3, counts=False),
+        {**json_results(4), "session_id": None},
+    ]
+    del records[0]["timing"]
+    assert decode_results(encode_results(records)) == records
+    assert parse_results(results_topic + "/bin", encode_results(records)) == records
+
+
+def test_truncated_binary_results():
+    with pytest.raises(ValueError):
+        decode_results(encode_results([json_results(1, n_samples=3)])[:-1])
+
+
+def test_device_encoder_matches():
+    namespace = load_functions(
+        ["_pack_id", "encode_results"],
+        {
+            "struct": struct,
+            "result_buffer": bytearray(16),
+            "BINARY_VERSION": 1,
+            "CHANNEL_NAMES": CHANNEL_NAMES,
+            "TIMING_KEYS": ("led_ms", "measure_ms", "total_ms"),
+        },
+    )
+    for records in [
+        [json_results(1)],
+        [json_results(2, n_samples=5), json_results(3, counts=False)],
+    ]:
+        device_encoded = bytes(namespace["encode_results"](records))
+        assert device_encoded == encode_results(records)
+
+
+def busy(payload_dict, queue_depth=2):
+    return {
+        "experiment_id": payload_dict["experiment_id"],
+        "session_id": payload_dict["session_id"],
+        "status": "busy",
+        "queue_depth": queue_depth,
+    }
+
+
+class QueueingDevice:
+    """
+    A device that runs one experiment at a time, taking `duration` seconds
+    each, queues up to `capacity` commands and rejects the rest as busy.
+    """
+
+    def __init__(self, client, capacity=2, duration=0.02):
+        self.client = client
+        self.capacity = capacity
+        self.duration = duration
+        self.lock = threading.Lock()
+        self.n_queued = 0
+        self.free_time = 0
+        self.n_busy = 0
+        self.experiment_ids = []
+
+    def __call__(self, payload_dict):
+        with self.lock:
+            if self.n_queued >= self.capacity:
+                self.n_busy += 1
+                return [(results_topic, busy(payload_dict, self.n_queued))]
+            self.n_queued += 1
+            now = _experiment_transport.monotonic()
+            self.free_time = max(now, self.free_time) + self.duration
+            timer = threading.Timer(self.free_time - now, self.finish, [payload_dict])
+            timer.start()
+        return []
+
+    def finish(self, payload_dict):
+        with self.lock:
+            self.n_queued -= 1
+            self.experiment_ids.append(payload_dict["experiment_id"])
+        for topic, results in echo(payload_dict):
+            self.client.deliver(topic, results)
+
+
+def test_run_experiment_retries_when_busy(transport):
+    replies = iter([busy, lambda p: echo(p)[0][1]])
+    transport.client.devices[command_topic] = lambda p: [
+        (results_topic, next(replies)(p))
+    ]
+    results = transport.run_experiment(command_topic, payload(1), busy_delay=0.01)
+    assert results["experiment_id"] == "e1" and "sensor_data" in results
+    assert len(transport.client.published) == 2
+    assert transport.router.n_buffered == 0  # the busy reply isn't kept
+
+
+def test_run_experiment_stays_busy(transport):
+    transport.client.devices[command_topic] = lambda p: [(results_topic, busy(p))]
+    with pytest.raises(TimeoutError, match="busy"):
+        transport.run_experiment(
+            command_topic, payload(1), timeout=0.1, busy_delay=0.02
+        )
+
+
+def test_async_run_experiment_retries_when_busy(monkeypatch):
+    async def main(transport):
+        replies = iter([busy, lambda p: echo(p)[0][1]])
+        transport.client.devices[command_topic] = lambda p: [
+            (results_topic, next(replies)(p))
+        ]
+        return await transport.run_experiment(
+            command_topic, payload(1), busy_delay=0.01
+        )
+
+    assert run_async(monkeypatch, main)["experiment_id"] == "e1"
+
+
+def test_run_experiments_resends_rejected_commands(transport):
+    device = QueueingDevice(transport.client)
+    transport.client.devices[command_topic] = device
+    payloads = [payload(i) for i in range(8)]
+    results = dict(
+        transport.run_experiments([command_topic], payloads, timeout=5, busy_delay=0.05)
+    )
+    assert sorted(results) == list(range(8))
+    assert all(results[i]["experiment_id"] == f"e{i}" for i in range(8))
+    assert device.n_busy > 0
+    assert sorted(device.experiment_ids) == sorted(p["experiment_id"] for p in payloads)
+
+
+def test_busy_batch_reply_from_the_device(transport):
+    namespace = load_functions(["busy_reply"], {})
+    batch_payload = make_batch_payload([payload(1), payload(2)])
+    transport.client.devices[command_topic] = lambda p: [
+        (results_topic, namespace["busy_reply"](p, queue_depth=5))
+    ]
+    futures = transport.submit_batch(command_topic, [payload(1), payload(2)])
+    for future in futures:
+        with pytest.raises(DeviceBusyError, match="queue depth 5"):
+            future.result(timeout=1)
+    assert transport.client.published == [(command_topic, batch_payload)]
+
+
+def status(state="online", topic=command_topic, **kwargs):
+    return {"state": state, "command_topic": topic, **kwargs}
+
+
+def test_device_registry():
+    registry = DeviceRegistry()
+    assert registry.get(command_topic) is None and registry.online() == []
+    assert not registry.is_online(command_topic)
+    assert not registry.is_offline(command_topic)  # unknown isn't offline
+
+    registry.update(status(experiment_ms=500, queue_depth=2, capacity=3))
+    registry.update(status("offline", "test/other"))
+    registry.update({"state": "online"})  # no command topic: ignored
+    assert registry.online() == [command_topic]
+    assert registry.is_offline("test/other")
+    assert registry.capacity(command_topic) == 3
+    assert registry.estimated_wait(command_topic) == 1.5
+    assert registry.estimated_wait("test/other") is None
+    assert registry.age(command_topic) < 1
+
+
+def test_device_registry_status_messages():
+    registry = DeviceRegistry()
+    registry.handle_message("test/status", json.dumps(status("busy")).encode())
+    assert registry.online() == [command_topic]
+    registry.handle_message("test/status", b"not json")
+    assert registry.online() == [command_topic]
+    registry.handle_message("test/status", b"")  # retained status cleared
+    assert registry.get(command_topic) is None
+
+
+def test_wait_online():
+    registry = DeviceRegistry()
+    assert not registry.wait_online(timeout=0.01)
+    threading.Timer(0.02, registry.update, [status()]).start()
+    assert registry.wait_online(command_topic, timeout=1)
+    assert not registry.wait_online("test/other", timeout=0.01)
+
+
+def test_transport_tracks_device_status(monkeypatch):
+    monkeypatch.setattr(mqtt_client, "Client", FakeClient)
+    transport = ExperimentTransport(
+        results_topic, "localhost", "user", tls=False, status_topic="test/+/status"
+    )
+    assert ("test/+/status", 1) in transport.client.subscriptions
+    transport.client.deliver("test/pico1/status", status(device_id="pico1"))
+    assert transport.devices.get(command_topic)["device_id"] == "pico1"
+    assert transport.router.n_buffered == 0
+    transport.close()
+
+
+def silent(payload_dict):
+    """A device that received the command but never replies."""
+    return []
+
+
+def test_explicit_topics_ignore_a_stale_offline_status(transport):
+    transport.devices.update(status("offline"))  # e.g., a retained last will
+    results = dict(transport.run_experiments([command_topic], [payload(1)]))
+    assert results[0]["experiment_id"] == "e1"
+
+
+def test_only_online_devices_without_explicit_topics(transport):
+    other_topic = "test/pico2/neopixel"
+    transport.client.devices[other_topic] = echo
+    transport.devices.update(status("offline"))
+    transport.devices.update(status(topic=other_topic))
+    results = dict(transport.run_experiments(None, [payload(i) for i in range(3)]))
+    assert sorted(results) == [0, 1, 2]
+    assert {topic for topic, _ in transport.client.published} == {other_topic}
+
+
+def test_commands_go_to_the_least_loaded_device(transport):
+    fast_topic = "test/fast/neopixel"
+    transport.client.devices[command_topic] = silent
+    transport.client.devices[fast_topic] = silent
+    transport.devices.update(status(experiment_ms=3000))
+    transport.devices.update(status(topic=fast_topic, experiment_ms=1000))
+    with pytest.raises(TimeoutError):
+        list(
+            transport.run_experiments(
+                [command_topic, fast_topic],
+                [payload(i) for i in range(4)],
+                timeout=0.05,
+            )
+        )
+    topics = [topic for topic, _ in transport.client.published]
+    assert topics.count(fast_topic) == 3 and topics.count(command_topic) == 1
+
+
+def test_reassigned_commands_get_a_new_experiment_id(transport):
+    other_topic = "test/pico2/neopixel"
+    transport.client.devices[command_topic] = silent
+    transport.client.devices[other_topic] = echo
+    transport.devices.update(status(experiment_ms=10))  # preferred
+    transport.devices.update(status(topic=other_topic, experiment_ms=1000))
+    payloads = [payload(1)]
+    [(i, results)] = transport.run_experiments(
+        [command_topic, other_topic], payloads, timeout=5, device_timeout=0.05
+    )
+    assert results["experiment_id"] == "e1-retry1"
+    assert results["retry_of"] == "e1"
+    assert payloads == [{**payload(1), "experiment_id": "e1-retry1", "retry_of": "e1"}]
+    published_ids = [p["experiment_id"] for _, p in transport.client.published]
+    assert published_ids == ["e1", "e1-retry1"]  # no experiment_id is sent twice
+
+    # the first device's late results are dropped, not buffered
+    transport.client.deliver(results_topic, {**payload(1), "sensor_data": {}})
+    assert transport.router.n_buffered == 0
+
+
+def test_router_discards_results_of_abandoned_attempts(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(_experiment_transport, "monotonic", lambda: now[0])
+    router = ResponseRouter(ttl=10)
+    router.dispatch({**payload(1), "sensor_data": {}})  # already buffered
+    router.expect(payload(2), "waiter")
+    router.cancel(payload(1), discard=True)
+    router.cancel(payload(2), discard=True)
+    assert router.n_buffered == 0 and router.n_waiting == 0
+    assert router.is_discarded(payload(2))
+    assert router.dispatch({**payload(2), "sensor_data": {}}) is None
+    assert router.n_buffered == 0
+    now[0] = 11
+    router.dispatch({**payload(3), "sensor_data": {}})
+    assert not router.is_discarded(payload(2))
+
+
+class SocketClient(FakeClient):
+    """
+    A FakeClient with a socket, like the Paho client that is driven from the
+    event loop: CONNACKs and messages are read when the socket is readable, the
+    DISCONNECT packet is written when it is writable, and `drop` loses the
+    connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sock = self._peer = None
+        self._incoming = []
+        self.n_connects = 0
+        self.sent_disconnect = False
+
+    def socket(self):
+        return self._sock
+
+    def connect(self, host, port):
+        self.reconnect()
+
+    def reconnect(self):
+        self._sock, self._peer = socket.socketpair()
+        self._sock.setblocking(False)
+        self.n_connects += 1
+        self.on_socket_open(self, None, self._sock)
+        self._receive(("connack",))
+
+    def drop(self):
+        self._peer.close()
+
+    def _receive(self, packet):
+        self._incoming.append(packet)
+        self._peer.send(b"x")
+
+    def _close_socket(self):
+        sock, self._sock = self._sock, None
+        self.on_socket_unregister_write(self, None, sock)
+        self.on_socket_close(self, None, sock)
+        sock.close()
+        self._peer.close()
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if self._sock is not None:
+            super().publish(topic, payload, qos=qos, retain=retain)
+
+    def deliver(self, topic, payload):
+        if isinstance(payload, dict):
+            payload = json.dumps(payload).encode()
+        self._receive(("message", SimpleNamespace(topic=topic, payload=payload)))
+
+    def loop_read(self):
+        if not self._sock.recv(1024):  # the broker closed the connection
+            self._close_socket()
+            self.on_disconnect(self, None, mqtt_client.MQTT_ERR_CONN_LOST)
+            return mqtt_client.MQTT_ERR_CONN_LOST
+        while self._incoming:
+            kind, *args = self._incoming.pop(0)
+            if kind == "connack":
+                self.on_connect(self, None, {}, 0)
+            else:
+                self.on_message(self, None, *args)
+        return mqtt_client.MQTT_ERR_SUCCESS
+
+    def loop_misc(self):
+        if self._sock is None:
+            return mqtt_client.MQTT_ERR_NO_CONN
+        return mqtt_client.MQTT_ERR_SUCCESS
+
+    def disconnect(self):
+        if self._sock is None:
+            return mqtt_client.MQTT_ERR_NO_CONN
+        self.on_socket_register_write(self, None, self._sock)
+        return mqtt_client.MQTT_ERR_SUCCESS
+
+    def loop_write(self):
+        self.sent_disconnect = True  # the only packet that is queued
+        self.on_disconnect(self, None, mqtt_client.MQTT_ERR_SUCCESS)
+        self._close_socket()
+        return mqtt_client.MQTT_ERR_SUCCESS
+
+
+def test_async_transport_reconnects_after_losing_the_connection(monkeypatch):
+    monkeypatch.setattr(_experiment_transport, "RECONNECT_MIN_DELAY", 0.01)
+    monkeypatch.setattr(_experiment_transport, "_MISC_INTERVAL", 0.01)
+
+    async def main(transport):
+        client = transport.client
+        client.devices[command_topic] = silent
+        pending = asyncio.ensure_future(
+            transport.run_experiment(command_topic, payload(1), timeout=10)
+        )
+        await asyncio.sleep(0.05)
+        client.drop()
+        # long before the timeout
+        with pytest.raises(ConnectionError, match="Lost the connection"):
+            await asyncio.wait_for(pending, 1)
+        await asyncio.sleep(0.1)
+        # the results of the new socket are read
+        client.devices[command_topic] = echo
+        results = await transport.run_experiment(command_topic, payload(2), timeout=1)
+        return client, results, transport.router.n_waiting
+
+    client, results, n_waiting = run_async(monkeypatch, main, SocketClient)
+    assert results["experiment_id"] == "e2"
+    assert client.n_connects == 2
+    assert client.subscriptions.count((results_topic, 2)) == 2  # resubscribed
+    assert n_waiting == 0
+
+
+def test_async_close_sends_the_disconnect(monkeypatch):
+    async def main(transport):
+        transport.client.devices[command_topic] = silent
+        pending = asyncio.ensure_future(
+            transport.run_experiment(command_topic, payload(1), timeout=10)
+        )
+        await asyncio.sleep(0.01)
+        misc_task = transport._misc_task
+        await transport.close()
+        with pytest.raises(ConnectionError, match="Disconnected"):
+            await pending
+        await asyncio.sleep(0)
+        return transport.client, misc_task
+
+    client, misc_task = run_async(monkeypatch, main, SocketClient)
+    assert client.sent_disconnect
+    assert client.socket() is None and client.n_connects == 1
+    assert misc_task.cancelled()
+
+
+def sequential_batch(client, step):
+    """A device that runs a batch payload one command per `step` seconds."""
+
+    def device(batch_payload):
+        for k, (topic, results) in enumerate(reversed(batch_echo(batch_payload))):
+            threading.Timer((k + 1) * step, client.deliver, (topic, results)).start()
+        return []
+
+    return device
+
+
+@pytest.mark.parametrize("experiment_ms", [50, 1])
+def test_batch_commands_time_out_from_when_the_device_gets_to_them(
+    transport, experiment_ms
+):
+    # with an experiment duration that is too short, the deadlines count from
+    # the previous results of the batch instead
+    transport.client.devices[command_topic] = sequential_batch(transport.client, 0.05)
+    transport.devices.update(status(experiment_ms=experiment_ms))
+    payloads = [payload(i) for i in range(4)]
+    results = list(
+        transport.run_experiments(
+            [command_topic], payloads, timeout=5, batch=True, device_timeout=0.1
+        )
+    )
+    # the batch takes twice the device timeout, but no command was late
+    assert [i for i, _ in results] == [0, 1, 2, 3]
+    assert [r["experiment_id"] for _, r in results] == ["e0", "e1", "e2", "e3"]
+    assert len(transport.client.published) == 1
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from history_recorder import HistoryRecorder
+
+
+def test_behaves_like_a_list():
+    history = HistoryRecorder(["R", "G", "B"], dtype=int)
+    for color in [(255, 0, 0), (0, 255, 0)]:
+        history.append(color)
+    assert len(history) == 2
+    assert history[0] == (255, 0, 0)
+    assert history[-1] == (0, 255, 0)
+    assert list(history) == [(255, 0, 0), (0, 255, 0)]
+    assert history[1:] == [(0, 255, 0)]
+    with pytest.raises(IndexError):
+        history[2]
+
+
+def test_drops_oldest_records_when_full():
+    history = HistoryRecorder(["R", "G", "B"], dtype=int, capacity=2)
+    for color in [(1, 0, 0), (2, 0, 0), (3, 0, 0)]:
+        history.append(color)
+    assert list(history) == [(2, 0, 0), (3, 0, 0)]
+    assert (history.n_recorded, history.n_dropped) == (3, 1)
+
+
+def test_extend_matches_append():
+    records = np.arange(21).reshape(7, 3)
+    appended = HistoryRecorder(["a", "b", "c"], capacity=3)
+    for record in records:
+        appended.append(tuple(record))
+    extended = HistoryRecorder(["a", "b", "c"], capacity=3)
+    extended.extend(records[:2])
+    extended.extend(records[2:])
+    assert list(extended) == list(appended)
+    assert extended.n_dropped == appended.n_dropped == 4
+
+
+def test_dtype_per_field():
+    history = HistoryRecorder(["R", "x"], dtype={"R": int}, as_dicts=True)
+    history.extend([[255, 0.5]])
+    history.append({"R": 7, "x": 1.25})
+    assert history[0] == {"R": 255, "x": 0.5}
+    assert type(history[0]["R"]) is int
+    assert history[1] == {"R": 7, "x": 1.25}
+
+
+def test_spills_to_disk(tmp_path):
+    history = HistoryRecorder(["R"], dtype=int, capacity=2, spill_dir=tmp_path)
+    history.extend([[i] for i in range(5)])
+    assert history.n_spilled == 4 and history.n_dropped == 0
+    assert len(list(tmp_path.iterdir())) == 2
+    assert history.to_dataframe()["R"].tolist() == list(range(5))
+    assert history.to_dataframe(include_spilled=False)["R"].tolist() == [4]
+
+
+def test_grows_on_demand_up_to_capacity():
+    history = HistoryRecorder(["a", "b", "c"], capacity=1000)
+    assert history._buffer.nbytes < 1000 * history.dtype.itemsize
+    records = np.arange(3000).reshape(1000, 3)
+    history.extend(records[:100])
+    for record in records[100:150]:
+        history.append(tuple(record))
+    history.extend(records[150:])
+    assert len(history._buffer) == 1000
+    history.append((-1, -1, -1))
+    assert len(history._buffer) == 1000
+    assert history[0] == tuple(records[1]) and history[-1] == (-1, -1, -1)
+    assert history.n_dropped == 1
+
+
+def test_integer_fields_are_rounded():
+    history = HistoryRecorder(["R", "x"], dtype={"R": int})
+    history.append((127.6, 0.5))
+    history.extend([[0.4, 1.0], [254.9, 2.0]])
+    assert [record[0] for record in history] == [128, 0, 255]
+    with pytest.raises(ValueError):
+        history.append((np.nan, 0.0))
+    with pytest.raises(ValueError):
+        history.extend([[np.inf, 0.0]])
+    assert len(history) == 3
@@ -46,6 +46,7 @@ Rob Hamerling, Version 0.0, August 2022
 
   Remarks:
     - Automatic Gain Control (AGC) is not supported
+      (see the auto-exposure mode of Sensor in as7341_sensor.py instead)
     - No provisions for SYND mode
 
 """
@@ -180,6 +181,7 @@ class AS7341:
         self.__buffer2 = bytearray(2)  # I2C I/O buffer for word
         self.__buffer13 = bytearray(13)  # I2C I/O buffer ASTATUS + 6 counts
         self.__measuremode = AS7341_MODE_SPM  # default measurement mode
+        self.__smux_selection = None  # SMUX configuration currently loaded
         self.__connected = self.reset()  # recycle power, check AS7341 presence
 
     """ --------- 'private' functions ----------- """
@@ -247,7 +249,6 @@ class AS7341:
         """write an array of bytes to consucutive addresses starting <reg>"""
         try:
             self.__bus.writeto_mem(self.__address, reg, value)
-            sleep_ms(100)
         except Exception as err:
             print("I2C write_burst at 0x{:02X}, error".format(reg), err)
             return False
@@ -263,10 +264,13 @@ class AS7341:
                   bank 1 is supposed be set by caller
         """
         data = self.__read_byte(reg)  # read <reg>
+        old = data
         if flag:
             data |= mask
         else:
             data &= ~mask
+        if old >= 0 and data == old:
+            return  # already as required, save the write (and its delay)
         self.__write_byte(reg, data)  # rewrite <reg>
 
     def __set_bank(self, bank=1):
@@ -303,6 +307,7 @@ class AS7341:
         When connected set (restore) measurement mode
         """
         self.disable()  # power-off ('reset')
+        self.__smux_selection = None  # SMUX configuration is lost
         sleep_ms(50)  # quisce
         self.enable()  # (only) power-on
         sleep_ms(50)  # settle
@@ -334,8 +339,18 @@ class AS7341:
         self.__modify_reg(AS7341_ENABLE, AS7341_ENABLE_SP_EN, flag)
 
     def set_smux(self, flag=True):
-        """enable (flag == True) SMUX or otherwise disable it"""
+        """enable (flag == True) SMUX or otherwise disable it
+        SMUXEN is cleared by the AS7341 when the SMUX command has been
+        executed, so after enabling wait (limited) for that to happen
+        """
         self.__modify_reg(AS7341_ENABLE, AS7341_ENABLE_SMUXEN, flag)
+        if flag:
+            for _ in range(100):  # limited wait for completion
+                if not self.__read_byte(AS7341_ENABLE) & AS7341_ENABLE_SMUXEN:
+                    break
+                sleep_ms(1)
+            else:  # timeout
+                print("SMUX command timed out")
 
     def set_measure_mode(self, mode=AS7341_CONFIG_INT_MODE_SPM):
         """configure the AS7341 for a specific measurement mode
@@ -360,23 +375,44 @@ class AS7341:
         """
         if selection in AS7341_SMUX_SELECT:
             self.__write_burst(0x00, AS7341_SMUX_SELECT[selection])
+            self.__smux_selection = None  # unknown until SMUX command executed
         else:
             print(selection, "is unknown in AS7341_SMUX_SELECT")
 
     def start_measure(self, selection):
         """select SMUX configuration, prepare and start measurement"""
+        self.prepare_measure(selection)
+        self.begin_measure()
+
+    def prepare_measure(self, selection):
+        """select SMUX configuration and prepare measurement, without starting it
+        The configuration is kept until the next selection, so this can be done
+        ahead of time (e.g. while the light source settles), see 'begin_measure'
+        When <selection> is already loaded the SMUX is not rewritten.
+        """
         self.__modify_reg(AS7341_CFG_0, AS7341_CFG_0_LOW_POWER, False)  # no low power
         self.set_spectral_measurement(False)  # quiesce
-        self.__write_byte(AS7341_CFG_6, AS7341_CFG_6_SMUX_CMD_WRITE)  # write mode
-        if self.__measuremode == AS7341_CONFIG_INT_MODE_SPM:
-            self.channel_select(selection)
-            self.set_smux(True)
-        elif self.__measuremode == AS7341_CONFIG_INT_MODE_SYNS:
+        if self.__measuremode not in (
+            AS7341_CONFIG_INT_MODE_SPM,
+            AS7341_CONFIG_INT_MODE_SYNS,
+        ):
+            return
+        if selection != self.__smux_selection:
+            self.__write_byte(AS7341_CFG_6, AS7341_CFG_6_SMUX_CMD_WRITE)  # write mode
             self.channel_select(selection)
             self.set_smux(True)
+            if selection in AS7341_SMUX_SELECT:
+                self.__smux_selection = selection
+        if self.__measuremode == AS7341_CONFIG_INT_MODE_SYNS:
             self.set_gpio_mode(AS7341_GPIO_2_GPIO_IN_EN)
+
+    def begin_measure(self, wait=True):
+        """start measurement with the SMUX configuration of 'prepare_measure'
+        in SPM mode (and <wait> True) wait until the measurement is completed
+        otherwise check 'measurement_completed' (or the INT pin) before reading
+        """
         self.set_spectral_measurement(True)
-        if self.__measuremode == AS7341_CONFIG_INT_MODE_SPM:
+        if wait and self.__measuremode == AS7341_CONFIG_INT_MODE_SPM:
             while not self.measurement_completed():
                 sleep_ms(50)
 
@@ -398,6 +434,12 @@ class AS7341:
         """
         return self.__read_all_channels()  # return a tuple!
 
+    def spectral_saturated(self):
+        """check if the counts of the latest 'get_spectral_data' were saturated
+        (analog or digital), using the ASTATUS byte read along with the counts
+        """
+        return bool(self.__buffer13[0] & AS7341_ASTATUS_ASAT_STATUS)
+
     def set_flicker_detection(self, flag=True):
         """enable (flag == True) flicker detection or otherwise disable it"""
         self.__modify_reg(AS7341_ENABLE, AS7341_ENABLE_FDEN, flag)
@@ -412,6 +454,7 @@ class AS7341:
         self.__write_byte(AS7341_CFG_6, AS7341_CFG_6_SMUX_CMD_WRITE)
         self.channel_select("FD")  # select flicker detection only
         self.set_smux(True)
+        self.__smux_selection = "FD"
         self.set_spectral_measurement(True)
         self.set_flicker_detection(True)
         for _ in range(10):  # limited wait for completion
@@ -596,6 +639,14 @@ class AS7341:
         hi = self.__read_word(AS7341_SP_TH_HIGH)
         return (lo, hi)
 
+    def set_measurement_interrupt(self, flag=True):
+        """enable (flag == True) an interrupt on Pin INT at the end of every
+        spectral measurement, or otherwise disable it
+        INT is active low, use 'clear_interrupt' before the next measurement
+        """
+        self.set_interrupt_persistence(0)  # every spectral cycle interrupts
+        self.set_spectral_interrupt(flag)
+
     def set_syns_int(self):
         """select SYNS mode and signal SYNS interrupt on Pin INT"""
         self.__set_bank(1)  # CONFIG register is in bank 1
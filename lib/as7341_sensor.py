@@ -1,7 +1,10 @@
 """Sterling Baird: wrapper class for AS7341 sensor."""
 
-from math import log
+from array import array
+from math import log, sqrt
+from time import sleep_ms, ticks_ms, ticks_diff
 
+import asyncio
 from as7341 import AS7341, AS7341_MODE_SPM
 from machine import I2C, Pin
 
@@ -12,7 +15,17 @@ class ExternalDeviceNotFound(OSError):
 
 class Sensor:
     def __init__(
-        self, atime=100, astep=999, gain=8, i2c=I2C(1, scl=Pin(27), sda=Pin(26))
+        self,
+        atime=100,
+        astep=999,
+        gain=8,
+        i2c=I2C(1, scl=Pin(27), sda=Pin(26)),
+        int_pin=None,
+        auto_exposure=False,
+        target_counts=(0.2, 0.8),
+        min_astep=99,
+        max_attempts=4,
+        n_samples=1,
     ):
         """Wrapper for Rob Hamerling's AS7341 implementation.
 
@@ -37,6 +50,27 @@ class Sensor:
         i2c : I2C, optional
             The I2C bus, by default machine.I2C(1, scl=machine.Pin(27),
             sda=machine.Pin(26))
+        int_pin : int or Pin, optional
+            The pin that the AS7341 INT output is wired to. If given, the async
+            measurements wait on its interrupt rather than polling, by default
+            None
+        auto_exposure : bool, optional
+            Whether to pick the gain and integration time per reading, so that
+            the brightest channel lands in `target_counts`. Readings are then
+            reported in counts per ms per gain unit (rather than counts), so
+            that they are comparable across exposures. By default False
+        target_counts : tuple of float, optional
+            The target range of the brightest channel as fractions of the full
+            scale counts, by default (0.2, 0.8)
+        min_astep : int, optional
+            The shortest integration time step count used by auto-exposure
+            (the configured `astep` is the longest), by default 99
+        max_attempts : int, optional
+            The maximum number of readings taken by auto-exposure before
+            reporting one outside of the target range, by default 4
+        n_samples : int, optional
+            The number of readings that `all_channels` averages, with their
+            statistics kept in `stats` (see `read_stats`), by default 1
 
         Raises
         ------
@@ -47,6 +81,7 @@ class Sensor:
         --------
         >>> sensor = Sensor(atime=29, astep=599, again=4)
         >>> channel_data = sensor.all_channels
+        >>> channel_data = await sensor.all_channels_async()
         """
 
         # i2c = machine.SoftI2C(scl=Pin(27), sda=Pin(26))
@@ -61,15 +96,40 @@ class Sensor:
 
         sensor.set_measure_mode(AS7341_MODE_SPM)
 
-        sensor.set_atime(atime)
-        sensor.set_astep(astep)
-        sensor.set_again(gain)
-
         self.sensor = sensor
-
-        self.__atime = atime
-        self.__astep = astep
-        self.__gain = gain
+        self._atime = atime
+        self._astep = astep
+        self._gain = gain  # a gain factor, converted to the AGAIN code
+        self._prepared = None  # SMUX configuration loaded ahead of time
+        self._bank_order = ("F1F4CN", "F5F8CN")  # read by all_channels
+
+        # end of measurement interrupt (INT is open drain, active low)
+        self._ready = None
+        if int_pin is not None:
+            if not isinstance(int_pin, Pin):
+                int_pin = Pin(int_pin, Pin.IN, Pin.PULL_UP)
+            self._ready = asyncio.ThreadSafeFlag()
+            int_pin.irq(lambda pin: self._ready.set(), Pin.IRQ_FALLING)
+            sensor.set_measurement_interrupt(True)
+        self.int_pin = int_pin
+
+        self.auto_exposure = auto_exposure
+        self.target_counts = target_counts
+        self.min_astep = min(min_astep, astep)
+        self.max_astep = astep  # auto-exposure never integrates for longer
+        self.max_attempts = max_attempts
+        self._saturated = False  # ASAT during the current reading
+
+        self.n_samples = n_samples
+        self.read_ms = None  # duration of the latest all_channels reading
+
+        # preallocated per-channel statistics of repeated readings
+        self.stats = {
+            "mean": array("f", [0] * 8),
+            "std": array("f", [0] * 8),
+            "min": array("f", [0] * 8),
+            "max": array("f", [0] * 8),
+        }
 
     @property
     def _atime(self):
@@ -86,7 +146,7 @@ class Sensor:
 
     @_astep.setter
     def _astep(self, value):
-        self.__atime = value
+        self.__astep = value
         self.sensor.set_astep(value)
 
     @property
@@ -104,18 +164,271 @@ class Sensor:
         code = int(round(1.4427 * log(2 * gain)))
         self.sensor.set_again(code)
 
+    def prepare(self, selection=None):
+        """Load the SMUX configuration of the next measurement ahead of time.
+
+        E.g., right after an experiment, so that the next `all_channels` can
+        start integrating immediately rather than first configuring the SMUX.
+        Does nothing if `selection` is already prepared.
+
+        Parameters
+        ----------
+        selection : str, optional
+            A key of AS7341_SMUX_SELECT, by default the first bank that the next
+            `all_channels` reads
+        """
+        if selection is None:
+            selection = self._bank_order[0]
+        if self._prepared != selection:
+            self.sensor.prepare_measure(selection)
+            self._prepared = selection
+
     @property
-    def all_channels(self):
-        self.sensor.start_measure("F1F4CN")
-        f1, f2, f3, f4, clr, nir = self.sensor.get_spectral_data()
+    def integration_ms(self):
+        """The integration time of a measurement in milliseconds."""
+        return (self.__atime + 1) * (self.__astep + 1) * 2.78 / 1000
+
+    @property
+    def full_scale(self):
+        """The maximum count of a channel for the current integration time."""
+        return min(65535, (self.__atime + 1) * (self.__astep + 1))
+
+    def _begin(self, selection):
+        self.prepare(selection)
+        self._prepared = None  # the next measurement needs a new configuration
+        if self._ready is not None:
+            self.sensor.clear_interrupt()
+            self._ready.clear()
+        self.sensor.begin_measure(wait=False)
+
+    def _poll_ms(self):
+        # poll often relative to the integration time, but not excessively
+        return max(1, min(int(self.integration_ms) // 20, 20))
+
+    def measure(self, selection):
+        """Measure the 6 channels of a SMUX configuration.
+
+        Sleeps for the integration time and then polls for completion at a
+        short interval derived from it (blocking, see `measure_async`).
+
+        Parameters
+        ----------
+        selection : str
+            A key of AS7341_SMUX_SELECT, e.g., "F1F4CN" or "F5F8CN"
 
-        self.sensor.start_measure("F5F8CN")
-        f5, f6, f7, f8, clr, nir = self.sensor.get_spectral_data()
+        Returns
+        -------
+        list of int
+            The counts of the 6 channels of the configuration.
+        """
+        self._begin(selection)
+        sleep_ms(int(self.integration_ms))
+        while not self.sensor.measurement_completed():
+            sleep_ms(self._poll_ms())
+        counts = self.sensor.get_spectral_data()
+        self._saturated |= self.sensor.spectral_saturated()
+        return counts
+
+    async def measure_async(self, selection, timeout_ms=None):
+        """Measure the 6 channels of a SMUX configuration, without blocking.
+
+        Other tasks (e.g., MQTT keepalive and message handling) keep running
+        during the integration. With `int_pin`, this waits for the end of
+        measurement interrupt, and otherwise it sleeps for the integration
+        time and then polls at a short interval derived from it.
+
+        Parameters
+        ----------
+        selection : str
+            A key of AS7341_SMUX_SELECT, e.g., "F1F4CN" or "F5F8CN"
+        timeout_ms : int, optional
+            How long to wait for the interrupt before falling back to polling,
+            by default twice the integration time plus 100 ms
+
+        Returns
+        -------
+        list of int
+            The counts of the 6 channels of the configuration.
+        """
+        self._begin(selection)
+        if self._ready is not None:
+            if timeout_ms is None:
+                timeout_ms = 2 * int(self.integration_ms) + 100
+            try:
+                await asyncio.wait_for_ms(self._ready.wait(), timeout_ms)
+            except asyncio.TimeoutError:
+                print("No AS7341 interrupt, polling instead")
+        else:
+            await asyncio.sleep_ms(int(self.integration_ms))
+        while not self.sensor.measurement_completed():
+            await asyncio.sleep_ms(self._poll_ms())
+        counts = self.sensor.get_spectral_data()
+        self._saturated |= self.sensor.spectral_saturated()
+        return counts
+
+    def _bank_counts(self, counts):
+        """Combine the counts of both banks into F1-F8."""
+        self._bank_order = self._bank_order[::-1]
+
+        f1, f2, f3, f4, clr, nir = counts["F1F4CN"]
+
+        f5, f6, f7, f8, clr, nir = counts["F5F8CN"]
 
         clr, nir  # to ignore "unused" linting warnings
 
         return [f1, f2, f3, f4, f5, f6, f7, f8]
 
+    @property
+    def all_channels(self):
+        """F1-F8, or with `n_samples` > 1 their means (see `read_stats`).
+
+        A reading integrates twice (8 channels on 6 ADCs), e.g., 2 x 281 ms
+        at the default atime and astep, plus about 50 ms of I2C transactions
+        and one SMUX configuration (with a simulated 0.25 ms per transaction).
+        """
+        start = ticks_ms()
+        if self.n_samples > 1:
+            channels = list(self.read_stats(self.n_samples)["mean"])
+        else:
+            channels = self._read_channels()
+        self.read_ms = ticks_diff(ticks_ms(), start)
+        return channels
+
+    async def all_channels_async(self):
+        """Read F1-F8 like `all_channels`, without blocking during integration."""
+        start = ticks_ms()
+        if self.n_samples > 1:
+            channels = list((await self.read_stats_async(self.n_samples))["mean"])
+        else:
+            channels = await self._read_channels_async()
+        self.read_ms = ticks_diff(ticks_ms(), start)
+        return channels
+
+    def _read_channels(self):
+        for attempt in range(self.max_attempts if self.auto_exposure else 1):
+            self._saturated = False
+            # The bank that was read last is still loaded in the SMUX, so read
+            # it first next time, which saves reconfiguring the SMUX once per
+            # reading
+            first, second = self._bank_order
+            counts = {first: self.measure(first), second: self.measure(second)}
+            channels = self._bank_counts(counts)
+            if not self.auto_exposure or self._check_exposure(channels):
+                break
+        return self._report(channels)
+
+    async def _read_channels_async(self):
+        for attempt in range(self.max_attempts if self.auto_exposure else 1):
+            self._saturated = False
+            first, second = self._bank_order
+            counts = {first: await self.measure_async(first)}
+            counts[second] = await self.measure_async(second)
+            channels = self._bank_counts(counts)
+            if not self.auto_exposure or self._check_exposure(channels):
+                break
+        return self._report(channels)
+
+    def _accumulate(self, k, channels):
+        """Update the statistics with reading number k (Welford's algorithm,
+        with the sum of squared deviations kept in "std" until `_finish`)."""
+        mean, m2 = self.stats["mean"], self.stats["std"]
+        low, high = self.stats["min"], self.stats["max"]
+        for i, x in enumerate(channels):
+            if k == 0:
+                mean[i], m2[i], low[i], high[i] = x, 0, x, x
+                continue
+            delta = x - mean[i]
+            mean[i] += delta / (k + 1)
+            m2[i] += delta * (x - mean[i])
+            if x < low[i]:
+                low[i] = x
+            if x > high[i]:
+                high[i] = x
+
+    def _finish(self, n_samples):
+        m2 = self.stats["std"]
+        for i in range(8):
+            m2[i] = sqrt(m2[i] / (n_samples - 1)) if n_samples > 1 else 0
+        return self.stats
+
+    def read_stats(self, n_samples):
+        """Take repeated readings of F1-F8 and compute per-channel statistics.
+
+        The statistics are computed on the fly in preallocated buffers, so the
+        readings themselves aren't kept.
+
+        Parameters
+        ----------
+        n_samples : int
+            The number of readings (of F1-F8, see `all_channels`).
+
+        Returns
+        -------
+        dict of array
+            The per-channel "mean", "std" (sample standard deviation), "min"
+            and "max". The arrays are reused by the next call, so copy them
+            if needed.
+        """
+        for k in range(n_samples):
+            self._accumulate(k, self._read_channels())
+        return self._finish(n_samples)
+
+    async def read_stats_async(self, n_samples):
+        """Like `read_stats`, without blocking during integration."""
+        for k in range(n_samples):
+            self._accumulate(k, await self._read_channels_async())
+        return self._finish(n_samples)
+
+    def _report(self, channels):
+        """Normalize to counts per ms per gain unit with auto-exposure."""
+        if not self.auto_exposure:
+            return channels
+        scale = self.integration_ms * self.__gain
+        return [count / scale for count in channels]
+
+    def _check_exposure(self, channels):
+        """Check whether the brightest channel of a reading is in the target
+        range. If not, adjust the exposure for the next reading (which is also
+        kept for the next experiment) and return False, unless the exposure
+        can't be adjusted any further.
+        """
+        low, high = self.target_counts
+        full_scale = self.full_scale
+        peak = max(channels)
+        if self._saturated:
+            factor = 0.1  # the counts don't say by how much, so step boldly
+        elif low * full_scale <= peak <= high * full_scale:
+            return True
+        else:
+            factor = (low + high) / 2 * full_scale / max(peak, 1)
+        return not self._scale_exposure(factor)
+
+    def _scale_exposure(self, factor):
+        """Scale the exposure by about `factor`, preferring short integration
+        times, and return whether it changed.
+        """
+        astep, gain = self.__astep, self.__gain
+        new_astep, new_gain = astep, gain
+        if factor < 1:
+            # too bright: shorten the integration first, then lower the gain
+            new_astep = max(self.min_astep, int((astep + 1) * factor) - 1)
+            factor *= (astep + 1) / (new_astep + 1)
+            while factor < 0.75 and new_gain > 0.5:
+                new_gain /= 2
+                factor *= 2
+        else:
+            # too dim: raise the gain first, then lengthen the integration
+            while factor >= 2 and new_gain < 512:
+                new_gain *= 2
+                factor /= 2
+            new_astep = min(self.max_astep, int((astep + 1) * factor) - 1)
+            new_astep = max(new_astep, astep)
+        if new_astep != astep:
+            self._astep = new_astep
+        if new_gain != gain:
+            self._gain = new_gain
+        return new_astep != astep or new_gain != gain
+
     def disable(self):
         self.sensor.disable()
 
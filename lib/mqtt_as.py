@@ -52,22 +52,48 @@ async def eliza(*_):  # e.g. via set_wifi_handler(coro): see test program
     await asyncio.sleep_ms(_DEFAULT_MS)
 
 
+# Holds up to size - 1 messages. When full, policy "drop_oldest" overwrites the
+# oldest message, "drop_newest" refuses the new one. Either way the discarded
+# message is passed to on_discard(topic, msg, retained) if given, e.g. to tell
+# the sender that it was dropped. high_water is the largest number of messages
+# that were waiting at once.
 class MsgQueue:
-    def __init__(self, size):
+    def __init__(self, size, policy="drop_oldest", on_discard=None):
+        if policy not in ("drop_oldest", "drop_newest"):
+            raise ValueError("Invalid queue policy.")
         self._q = [0 for _ in range(max(size, 4))]
         self._size = size
         self._wi = 0
         self._ri = 0
         self._evt = asyncio.Event()
+        self._drop_newest = policy == "drop_newest"
+        self._on_discard = on_discard
         self.discards = 0
+        self.high_water = 0
 
+    def __len__(self):  # Number of messages waiting
+        return (self._wi - self._ri) % self._size
+
+    # Returns False if the new message was discarded.
     def put(self, *v):
+        if self._drop_newest and (self._wi + 1) % self._size == self._ri:
+            self.discards += 1
+            if self._on_discard is not None:
+                self._on_discard(*v)
+            return False
         self._q[self._wi] = v
         self._evt.set()
         self._wi = (self._wi + 1) % self._size
         if self._wi == self._ri:  # Would indicate empty
+            old = self._q[self._ri]
             self._ri = (self._ri + 1) % self._size  # Discard a message
             self.discards += 1
+            if self._on_discard is not None:
+                self._on_discard(*old)
+        n = len(self)
+        if n > self.high_water:
+            self.high_water = n
+        return True
 
     def __aiter__(self):
         return self
@@ -103,6 +129,10 @@ config = {
     "wifi_pw": None,
     "queue_len": 0,
     "gateway": False,
+    "max_msg_size": 4096,  # Largest incoming PUBLISH (topic + message) in bytes
+    "qos2_inflight": 16,  # Incoming QoS 2 pids remembered until PUBREL
+    "queue_policy": "drop_oldest",  # Or "drop_newest", see MsgQueue
+    "queue_discard_cb": None,  # Called with messages the full queue discards
 }
 
 
@@ -122,6 +152,11 @@ def qos_check(qos):
         raise ValueError("Only qos 0 and 1 are supported.")
 
 
+def sub_qos_check(qos):  # Incoming QoS 2 messages are supported
+    if not 0 <= qos <= 2:
+        raise ValueError("Only qos 0, 1 and 2 are supported.")
+
+
 # MQTT_base class. Handles MQTT protocol on the basis of a good connection.
 # Exceptions from connectivity failures are handled by MQTTClient subclass.
 class MQTT_base:
@@ -159,7 +194,9 @@ class MQTT_base:
         if self._events:
             self.up = asyncio.Event()
             self.down = asyncio.Event()
-            self.queue = MsgQueue(config["queue_len"])
+            self.queue = MsgQueue(
+                config["queue_len"], config["queue_policy"], config["queue_discard_cb"]
+            )
         else:  # Callbacks
             self._cb = config["subs_cb"]
             self._wifi_handler = config["wifi_coro"]
@@ -190,6 +227,33 @@ class MQTT_base:
         self.rcv_pids = set()  # PUBACK and SUBACK pids awaiting ACK response
         self.last_rx = ticks_ms()  # Time of last communication from broker
         self.lock = asyncio.Lock()
+        # Preallocated receive buffers: packet headers and ACKs are read into
+        # _hdr, incoming PUBLISH packets into _rbuf, so reads don't allocate.
+        self._hdr = bytearray(4)
+        self._hdr_mv = memoryview(self._hdr)
+        self._op_mv = self._hdr_mv[:1]  # First byte of a packet
+        self._max_msg_size = config["max_msg_size"]
+        self._rbuf = bytearray(max(self._max_msg_size, 4))
+        self._rbuf_mv = memoryview(self._rbuf)
+        self._ack_pkt = bytearray(b"\x40\x02\0\0")  # PUBACK, PUBREC or PUBCOMP
+        # Pids of incoming QoS 2 messages that were delivered but not yet
+        # released (PUBREL), so that redeliveries aren't delivered again. A
+        # fixed-size ring (0 is not a valid pid): when it's full the oldest
+        # pid is forgotten.
+        self._qos2_pids = [0] * max(config["qos2_inflight"], 1)
+        self._qos2_next = 0
+        self.qos2_dups = 0  # Redelivered QoS 2 messages that were dropped
+        self.oversized = 0  # Incoming messages discarded for exceeding max_msg_size
+        # Readiness waits instead of fixed polling delays: the socket is read
+        # via a StreamReader once nothing is buffered, and _ack_evt is set
+        # whenever a pid is acknowledged (or the connection goes down).
+        self._reader = None
+        self._ack_evt = asyncio.Event()
+        # PUBLISH packets that fit are sent with a single write, so Nagle's
+        # algorithm (where TCP_NODELAY isn't supported) doesn't hold back the
+        # topic and message until the broker ACKs the fixed header (a delayed
+        # ACK can take 40 ms or more)
+        self._sbuf = bytearray(max(self._max_msg_size, 4) + 7)
 
     def _set_last_will(self, topic, msg, retain=False, qos=0):
         qos_check(qos)
@@ -208,32 +272,76 @@ class MQTT_base:
         return ticks_diff(ticks_ms(), t) > self._response_time
 
     async def _as_read(self, n, sock=None):  # OSError caught by superclass
-        if sock is None:
-            sock = self._sock
         # Declare a byte array of size n. That space is needed anyway, better
         # to just 'allocate' it in one go instead of appending to an
         # existing object, this prevents reallocation and fragmentation.
         data = bytearray(n)
-        buffer = memoryview(data)
+        await self._as_readinto(memoryview(data), n, sock)
+        return data
+
+    # Read exactly n bytes into the start of memoryview buf. Only a partial
+    # read slices (and so allocates) the memoryview.
+    async def _as_readinto(self, buf, n, sock=None):  # OSError caught by superclass
+        if sock is None:
+            sock = self._sock
         size = 0
         t = ticks_ms()
         while size < n:
             if self._timeout(t) or not self.isconnected():
                 raise OSError(-1, "Timeout on socket read")
             try:
-                msg_size = sock.readinto(buffer[size:], n - size)
+                msg_size = sock.readinto(buf[size:] if size else buf, n - size)
             except OSError as e:  # ESP32 issues weird 119 errors here
                 msg_size = None
                 if e.args[0] not in BUSY_ERRORS:
                     raise
+            if msg_size is None and sock is self._sock:
+                # Nothing buffered: wait for the socket to become readable
+                msg_size = await self._wait_readinto(buf[size:n], t)
             if msg_size == 0:  # Connection closed by host
                 raise OSError(-1, "Connection closed by host")
             if msg_size is not None:  # data received
                 size += msg_size
                 t = ticks_ms()
                 self.last_rx = ticks_ms()
-            await asyncio.sleep_ms(_SOCKET_POLL_DELAY)
-        return data
+            elif sock is not self._sock:
+                await asyncio.sleep_ms(_SOCKET_POLL_DELAY)
+
+    # Read into buf as soon as the socket is readable, giving up (None) when
+    # the response time since t has passed.
+    async def _wait_readinto(self, buf, t):
+        timeout = self._response_time - ticks_diff(ticks_ms(), t)
+        try:
+            return await asyncio.wait_for_ms(
+                self._reader.readinto(buf), max(timeout, 0)
+            )
+        except asyncio.TimeoutError:
+            return None
+        except OSError as e:
+            if e.args[0] not in BUSY_ERRORS:
+                raise
+            return None
+
+    # Wait for the first byte of the next packet. Called without the lock, as
+    # ._handle_msg() is the only reader once connected.
+    async def _read_op(self):
+        try:
+            n = self._sock.readinto(self._op_mv, 1)  # TLS may have data buffered
+        except OSError as e:
+            if e.args[0] not in BUSY_ERRORS:
+                raise
+            n = None
+        if n is None:
+            try:
+                n = await self._reader.readinto(self._op_mv)
+            except OSError as e:
+                if e.args[0] not in BUSY_ERRORS:
+                    raise
+                await asyncio.sleep_ms(_SOCKET_POLL_DELAY)  # Needed by RP2
+                return None
+        if n == 0:
+            raise OSError(-1, "Empty response")
+        return None if n is None else self._hdr[0]
 
     async def _as_write(self, bytes_wr, length=0, sock=None):
         if sock is None:
@@ -256,7 +364,8 @@ class MQTT_base:
             if n:
                 t = ticks_ms()
                 bytes_wr = bytes_wr[n:]
-            await asyncio.sleep_ms(_SOCKET_POLL_DELAY)
+            if bytes_wr:  # Send buffer full: give it time to drain
+                await asyncio.sleep_ms(_SOCKET_POLL_DELAY)
 
     async def _send_str(self, s):
         await self._as_write(struct.pack("!H", len(s)))
@@ -266,8 +375,8 @@ class MQTT_base:
         n = 0
         sh = 0
         while 1:
-            res = await self._as_read(1)
-            b = res[0]
+            await self._as_readinto(self._hdr_mv, 1)
+            b = self._hdr[0]
             n |= (b & 0x7F) << sh
             if not b & 0x80:
                 return n
@@ -276,6 +385,10 @@ class MQTT_base:
     async def _connect(self, clean):
         self._sock = socket.socket()
         self._sock.setblocking(False)
+        try:  # Don't hold small packets (e.g. a PUBLISH after a PUBACK) for ACKs
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (AttributeError, OSError):  # Not supported by every port
+            pass
         try:
             self._sock.connect(self._addr)
         except OSError as e:
@@ -287,6 +400,7 @@ class MQTT_base:
             import ssl
 
             self._sock = ssl.wrap_socket(self._sock, **self._ssl_params)
+        self._reader = asyncio.StreamReader(self._sock)
         premsg = bytearray(b"\x10\0\0\0\0\0")
         msg = bytearray(b"\x04MQTT\x04\0\0\0")  # Protocol 3.1.1
 
@@ -320,7 +434,8 @@ class MQTT_base:
             await self._send_str(self._pswd)
         # Await CONNACK
         # read causes ECONNABORTED if broker is out; triggers a reconnect.
-        resp = await self._as_read(4)
+        await self._as_readinto(self._hdr_mv, 4)
+        resp = self._hdr
         self.dprint("Connected to broker.")  # Got CONNACK
         if (
             resp[3] != 0 or resp[0] != 0x20 or resp[1] != 0x02
@@ -329,6 +444,10 @@ class MQTT_base:
                 -1,
                 f"Connect fail: 0x{(resp[0] << 8) + resp[1]:04x} {resp[3]} (README 7)",
             )
+        if not resp[2] & 1:  # No session present: the broker won't redeliver
+            pids = self._qos2_pids  # QoS 2 messages and may reuse their pids
+            for i in range(len(pids)):
+                pids[i] = 0
 
     async def _ping(self):
         async with self.lock:
@@ -406,7 +525,13 @@ class MQTT_base:
         while pid in self.rcv_pids:  # local copy
             if self._timeout(t) or not self.isconnected():
                 break  # Must repub or bail out
-            await asyncio.sleep_ms(100)
+            # Every waiter is woken by .set(), so clearing here can't lose an ACK
+            self._ack_evt.clear()
+            timeout = self._response_time - ticks_diff(ticks_ms(), t)
+            try:
+                await asyncio.wait_for_ms(self._ack_evt.wait(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
         else:
             return True  # PID received. All done.
         return False
@@ -448,7 +573,22 @@ class MQTT_base:
             sz >>= 7
             i += 1
         pkt[i] = sz
-        await self._as_write(pkt, i + 1)
+        i += 1
+        buf = self._sbuf
+        n = i + 2 + len(topic) + len(msg) + (2 if qos > 0 else 0)
+        if n <= len(buf):  # Safe to reuse: called with the lock held
+            buf[:i] = pkt[:i]
+            struct.pack_into("!H", buf, i, len(topic))
+            i += 2
+            buf[i : i + len(topic)] = topic
+            i += len(topic)
+            if qos > 0:
+                struct.pack_into("!H", buf, i, pid)
+                i += 2
+            buf[i:n] = msg
+            await self._as_write(buf, n)
+            return
+        await self._as_write(pkt, i)
         await self._send_str(topic)
         if qos > 0:
             struct.pack_into("!H", pkt, 0, pid)
@@ -486,77 +626,135 @@ class MQTT_base:
     # Subscribed messages are delivered to a callback previously
     # set by .setup() method. Other (internal) MQTT
     # messages processed internally.
-    # Immediate return if no data available. Called from ._handle_msg().
-    async def wait_msg(self):
-        try:
-            res = self._sock.read(1)  # Throws OSError on WiFi fail
-        except OSError as e:
-            if e.args[0] in BUSY_ERRORS:  # Needed by RP2
-                await asyncio.sleep_ms(0)
+    # Immediate return if no data available. Called from ._handle_msg() with
+    # the first byte of the packet (op) already read.
+    async def wait_msg(self, op=None):
+        hdr = self._hdr
+        if op is None:
+            try:
+                res = self._sock.readinto(self._op_mv, 1)  # Throws OSError on WiFi fail
+            except OSError as e:
+                if e.args[0] in BUSY_ERRORS:  # Needed by RP2
+                    await asyncio.sleep_ms(0)
+                    return
+                raise
+            if res is None:
                 return
-            raise
-        if res is None:
-            return
-        if res == b"":
-            raise OSError(-1, "Empty response")
+            if res == 0:
+                raise OSError(-1, "Empty response")
+            op = hdr[0]
 
-        if res == b"\xd0":  # PINGRESP
-            await self._as_read(1)  # Update .last_rx time
+        if op == 0xD0:  # PINGRESP
+            await self._as_readinto(self._hdr_mv, 1)  # Update .last_rx time
             return
-        op = res[0]
 
         if op == 0x40:  # PUBACK: save pid
-            sz = await self._as_read(1)
-            if sz != b"\x02":
+            await self._as_readinto(self._hdr_mv, 3)
+            if hdr[0] != 0x02:
                 raise OSError(-1, "Invalid PUBACK packet")
-            rcv_pid = await self._as_read(2)
-            pid = rcv_pid[0] << 8 | rcv_pid[1]
+            pid = hdr[1] << 8 | hdr[2]
             if pid in self.rcv_pids:
                 self.rcv_pids.discard(pid)
+                self._ack_evt.set()
             else:
                 raise OSError(-1, "Invalid pid in PUBACK packet")
 
         if op == 0x90:  # SUBACK
-            resp = await self._as_read(4)
+            await self._as_readinto(self._hdr_mv, 4)
+            resp = hdr
             if resp[3] == 0x80:
                 raise OSError(-1, "Invalid SUBACK packet")
             pid = resp[2] | (resp[1] << 8)
             if pid in self.rcv_pids:
                 self.rcv_pids.discard(pid)
+                self._ack_evt.set()
             else:
                 raise OSError(-1, "Invalid pid in SUBACK packet")
 
         if op == 0xB0:  # UNSUBACK
-            resp = await self._as_read(3)
-            pid = resp[2] | (resp[1] << 8)
+            await self._as_readinto(self._hdr_mv, 3)
+            pid = hdr[2] | (hdr[1] << 8)
             if pid in self.rcv_pids:
                 self.rcv_pids.discard(pid)
+                self._ack_evt.set()
             else:
                 raise OSError(-1)
 
+        if op == 0x62:  # PUBREL: the QoS 2 message won't be redelivered
+            await self._as_readinto(self._hdr_mv, 3)
+            if hdr[0] != 0x02:
+                raise OSError(-1, "Invalid PUBREL packet")
+            pid = hdr[1] << 8 | hdr[2]
+            pids = self._qos2_pids
+            for i in range(len(pids)):
+                if pids[i] == pid:
+                    pids[i] = 0
+            await self._send_ack(0x70, pid)  # PUBCOMP
+            return
+
         if op & 0xF0 != 0x30:
             return
         sz = await self._recv_len()
-        topic_len = await self._as_read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = await self._as_read(topic_len)
-        sz -= topic_len + 2
+        if sz > self._max_msg_size:
+            await self._discard(op, sz)
+            return
+        # Read the whole packet (topic length, topic, pid, message) in one go
+        buf = self._rbuf
+        await self._as_readinto(self._rbuf_mv, sz)
+        topic_len = (buf[0] << 8) | buf[1]
+        start = 2 + topic_len
+        topic = bytes(self._rbuf_mv[2:start])
         if op & 6:
-            pid = await self._as_read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = await self._as_read(sz)
+            pid = buf[start] << 8 | buf[start + 1]
+            start += 2
+        if op & 6 == 4:  # QoS 2: deliver once, until PUBREL
+            if pid in self._qos2_pids:
+                self.qos2_dups += 1
+                await self._ack(op, pid)  # Resend PUBREC
+                return
+            self._qos2_pids[self._qos2_next] = pid
+            self._qos2_next = (self._qos2_next + 1) % len(self._qos2_pids)
+        msg = bytes(self._rbuf_mv[start:sz])
         retained = op & 0x01
         if self._events:
             self.queue.put(topic, msg, bool(retained))
         else:
             self._cb(topic, msg, bool(retained))
+        await self._ack(op, pid if op & 6 else 0)
+
+    # Read and drop a PUBLISH packet larger than max_msg_size in chunks,
+    # acknowledging it so that the broker doesn't redeliver it.
+    async def _discard(self, op, sz):
+        self.oversized += 1
+        self.dprint(
+            "Discarding %d byte message (max_msg_size %d)", sz, self._max_msg_size
+        )
+        buf = self._rbuf
+        pid = 0
+        pos = 0  # Offset of the current chunk in the packet
+        while pos < sz:
+            n = min(sz - pos, len(buf))
+            await self._as_readinto(self._rbuf_mv, n)
+            if pos == 0:
+                pid_pos = 2 + (buf[0] << 8 | buf[1])
+            if op & 6:
+                for i in (pid_pos, pid_pos + 1):
+                    if pos <= i < pos + n:
+                        pid = pid << 8 | buf[i - pos]
+            pos += n
+        await self._ack(op, pid)
+
+    async def _ack(self, op, pid):
         if op & 6 == 2:  # qos 1
-            pkt = bytearray(b"\x40\x02\0\0")  # Send PUBACK
-            struct.pack_into("!H", pkt, 2, pid)
-            await self._as_write(pkt)
-        elif op & 6 == 4:  # qos 2 not supported
-            raise OSError(-1, "QoS 2 not supported")
+            await self._send_ack(0x40, pid)  # PUBACK
+        elif op & 6 == 4:  # qos 2
+            await self._send_ack(0x50, pid)  # PUBREC
+
+    async def _send_ack(self, pkt_type, pid):
+        pkt = self._ack_pkt
+        pkt[0] = pkt_type
+        struct.pack_into("!H", pkt, 2, pid)
+        await self._as_write(pkt)
 
 
 # MQTTClient class. Handles issues relating to connectivity.
@@ -687,7 +885,8 @@ class MQTTClient(MQTT_base):
             asyncio.create_task(self._keep_connected())
             # Runs forever unless user issues .disconnect()
 
-        asyncio.create_task(self._handle_msg())  # Task quits on connection fail.
+        # Task quits on connection fail.
+        self._tasks.append(asyncio.create_task(self._handle_msg()))
         self._tasks.append(asyncio.create_task(self._keep_alive()))
         if self.DEBUG:
             self._tasks.append(asyncio.create_task(self._memory()))
@@ -696,14 +895,17 @@ class MQTTClient(MQTT_base):
         else:
             asyncio.create_task(self._connect_handler(self))  # User handler.
 
-    # Launched by .connect(). Runs until connectivity fails. Checks for and
-    # handles incoming messages.
+    # Launched by .connect(). Runs until connectivity fails. Waits for incoming
+    # messages (without holding the lock, so publishing isn't held up) and
+    # handles them.
     async def _handle_msg(self):
         try:
             while self.isconnected():
+                op = await self._read_op()
+                if op is None:  # Spurious wakeup
+                    continue
                 async with self.lock:
-                    await self.wait_msg()  # Immediate return if no message
-                await asyncio.sleep_ms(_DEFAULT_MS)  # Let other tasks get lock
+                    await self.wait_msg(op)
 
         except OSError:
             pass
@@ -750,6 +952,7 @@ class MQTTClient(MQTT_base):
         if self._isconnected:
             self._isconnected = False
             asyncio.create_task(self._kill_tasks(True))  # Shut down tasks and socket
+            self._ack_evt.set()  # Don't leave ._await_pid() waiting
             if self._events:  # Signal an outage
                 self.down.set()
             else:
@@ -795,7 +998,7 @@ class MQTTClient(MQTT_base):
         self.dprint("Disconnected, exited _keep_connected")
 
     async def subscribe(self, topic, qos=0):
-        qos_check(qos)
+        sub_qos_check(qos)
         while 1:
             await self._connection()
             try:
@@ -1,7 +1,10 @@
 """Control the NeoPixel LED """
 
+import gc
+import os
 import sys
 import json
+import struct
 
 try:
     import ssl
@@ -12,7 +15,7 @@ except:
 import asyncio
 import ntptime
 from uio import StringIO
-from time import time, sleep
+from time import time, sleep, ticks_ms, ticks_diff
 import requests
 
 # WiFi
@@ -38,10 +41,21 @@ from my_secrets import (
     LAMBDA_FUNCTION_URL,
 )
 
+try:
+    # to run several devices per course, give each its own DEVICE_ID
+    from my_secrets import DEVICE_ID
+except ImportError:
+    DEVICE_ID = None
+
+FIRMWARE_VERSION = "0.1"
+
 # Instantiate the LEDs with 1 pixel on Pin 28
 neopixels = NeoPixel(machine.Pin(28), 1)
 
-# Instantiate the Sensor class
+# Instantiate the Sensor class (pass int_pin=<GPIO wired to the AS7341 INT> to
+# wait on the end of measurement interrupt rather than polling, and
+# auto_exposure=True to pick gain and integration time per reading, reported in
+# counts per ms per gain unit)
 sensor = Sensor()
 
 # Description: Receive commands from HiveMQ and send sensor data to HiveMQ
@@ -91,11 +105,56 @@ config.update(
 )
 
 
+CHANNEL_NAMES = ["ch410", "ch440", "ch470", "ch510", "ch550", "ch583", "ch620", "ch670"]
+
+# The phase the device is in ("idle", "measure", "publish", "arm") and the
+# duration of each phase of the latest experiment
+device_state = {"phase": "idle", "timing": {}}
+
+# Experiment logging: documents are buffered on the device and sent to MongoDB
+# (one at a time, with `log_experiment`) by a background task, only while no
+# commands are being handled
+LOG_IDLE_TIME = 2  # only POST once no command has arrived for this long (s)
+LOG_QUEUE_LEN = 50  # documents buffered in memory, beyond that they're spilled
+LOG_SPILL_FILE = "log_spill.jsonl"  # on flash, kept when WiFi/Lambda are down
+LOG_SPILL_MAX = 1000  # documents kept in the spill file, beyond that dropped
+LOG_DEDUPE_LEN = 32  # recent experiments remembered so redeliveries log once
+LOG_RETRY_MIN = 2  # seconds before retrying a failed POST, doubled per failure
+LOG_RETRY_MAX = 300  # maximum seconds between retries
+# requests.post is synchronous, so each POST stalls the event loop (commands,
+# MQTT keepalives), see `logger` for how long
+LOG_POST_TIMEOUT = 2  # seconds, per socket operation of a POST
+
+log_queue = []  # documents waiting to be sent
+logged_keys = []  # (session_id, experiment_id) of the latest queued documents
+log_stats = {
+    "queued": 0,  # documents passed to queue_experiment
+    "duplicates": 0,  # documents of an experiment that was already queued
+    "logged": 0,  # documents sent successfully
+    "spilled": 0,  # documents written to the spill file
+    "dropped": 0,  # documents lost because the spill file was full
+    "failed_posts": 0,
+    "spill_backlog": 0,  # documents currently in the spill file
+}
+last_command_time = time()
+
+# Compact binary results, published on the sensor data topic + "/bin" for
+# payloads with "encoding": "binary" (see experiment_transport.encode_results
+# for the format, and experiment_transport.decode_results for the orchestrator)
+BINARY_VERSION = 1
+TIMING_KEYS = ("led_ms", "measure_ms", "total_ms")
+result_buffer = bytearray(256)  # reused for every message, grown as needed
+
+
 # Function for running a color experiment
-def run_color_experiment(R, G, B):
+async def run_color_experiment(R, G, B):
     """
     Run a color experiment with the specified RGB values.
 
+    Reading the sensor with ``await sensor.all_channels_async()`` (rather than
+    ``sensor.all_channels``) lets the other tasks (e.g., the MQTT keepalive and
+    message handling) keep running while the sensor integrates.
+
     Parameters
     ----------
     R : int
@@ -112,7 +171,7 @@ def run_color_experiment(R, G, B):
 
     Examples
     --------
-    >>> run_color_experiment(255, 0, 0)
+    >>> await run_color_experiment(255, 0, 0)
     {'ch410': 25.5, 'ch440': 51.0, 'ch470': 76.5, 'ch510': 102.0, 'ch550': 127.5, 'ch583': 153.0, 'ch620': 229.5, 'ch670': 255.0} # noqa: E501
     """
     # set the color
@@ -123,12 +182,28 @@ def run_color_experiment(R, G, B):
     return sensor_data
 
 
+def arm_sensor():
+    """
+    Loads the sensor configuration for the next experiment ahead of time, so
+    that configuring it is off the critical path of the next command.
+    """
+    device_state["phase"] = "arm"
+    start = ticks_ms()
+    sensor.prepare()
+    device_state["timing"]["arm_ms"] = ticks_diff(ticks_ms(), start)
+    device_state["phase"] = "idle"
+
+
 def log_experiment(document):
     """
     Sends an experiment document to a specified MongoDB collection.
 
     This function attempts to send a document to a MongoDB collection via an AWS Lambda Function URL.
 
+    It's called by the `logger` task for the documents queued by
+    `queue_experiment`, and documents for which it raises are sent again later.
+    Since the POST blocks the event loop, pass ``timeout=LOG_POST_TIMEOUT``.
+
     Parameters
     ----------
     document : dict
@@ -142,6 +217,12 @@ def log_experiment(document):
     -------
     None
 
+    Raises
+    ------
+    Exception
+        If the document wasn't logged, e.g., without a connection or when the
+        Lambda responds with an error status code.
+
     Examples
     --------
     >>> document = {
@@ -164,15 +245,354 @@ def log_experiment(document):
     ...  # IMPLEMENT
 
 
-# MQTT Topics
-command_topic = f"{COURSE_ID}/neopixel"
-sensor_data_topic = f"{COURSE_ID}/as7341"
+def post_log(document):
+    """
+    Sends a queued document with `log_experiment`.
+
+    Returns
+    -------
+    bool
+        Whether the document was logged.
+    """
+    try:
+        log_experiment(document)
+    except Exception as e:
+        print(f"Failed to log experiment {document.get('experiment_id')}: {e}")
+        return False
+    return True
+
+
+def queue_experiment(document):
+    """
+    Queues an experiment document to be sent to a specified MongoDB collection.
+
+    The document is buffered in memory and sent by the `logger` task (see
+    `log_experiment`), so that handling the next command doesn't wait on the
+    database. If the buffer is full, it is spilled to a file on flash. A
+    document with the same session_id and experiment_id as one of the last
+    LOG_DEDUPE_LEN is skipped.
+
+    Parameters
+    ----------
+    document : dict
+        The document to be added to MongoDB (see `log_experiment`).
+    """
+    # a command that was delivered (and run) again is only logged once
+    key = (document.get("session_id"), document.get("experiment_id"))
+    if key in logged_keys:
+        log_stats["duplicates"] += 1
+        return
+    logged_keys.append(key)
+    if len(logged_keys) > LOG_DEDUPE_LEN:
+        logged_keys.pop(0)
+    log_queue.append(document)
+    log_stats["queued"] += 1
+    if len(log_queue) >= LOG_QUEUE_LEN:
+        spill_log_queue()
+
+
+def spill_log_queue():
+    """
+    Appends the buffered documents to the spill file on flash, so that they
+    survive WiFi or Lambda outages (and resets) without using up memory.
+    Documents beyond LOG_SPILL_MAX are dropped.
+    """
+    n_free = LOG_SPILL_MAX - log_stats["spill_backlog"]
+    documents = log_queue[:n_free]
+    log_stats["dropped"] += len(log_queue) - len(documents)
+    log_queue.clear()
+    try:
+        with open(LOG_SPILL_FILE, "a") as f:
+            for document in documents:
+                f.write(json.dumps(document) + "\n")
+    except OSError as e:
+        print(f"Failed to spill {len(documents)} experiment(s): {e}")
+        log_stats["dropped"] += len(documents)
+        return
+    log_stats["spilled"] += len(documents)
+    log_stats["spill_backlog"] += len(documents)
+
+
+def count_spilled():
+    """Returns the number of documents in the spill file (e.g., after a reset)."""
+    try:
+        with open(LOG_SPILL_FILE) as f:
+            return sum(1 for line in f if line.strip())
+    except OSError:
+        return 0
+
+
+def load_spilled():
+    """
+    Moves up to LOG_QUEUE_LEN documents from the spill file back into the
+    buffer. The file is read and rewritten line by line to keep memory use low.
+    """
+    tmp_file = LOG_SPILL_FILE + ".tmp"
+    n_remaining = 0
+    try:
+        with open(LOG_SPILL_FILE) as f, open(tmp_file, "w") as tmp:
+            for line in f:
+                if not line.strip():
+                    continue
+                if len(log_queue) < LOG_QUEUE_LEN:
+                    try:
+                        log_queue.append(json.loads(line))
+                    except ValueError:  # e.g., a partially written line
+                        log_stats["dropped"] += 1
+                else:
+                    tmp.write(line)
+                    n_remaining += 1
+        os.remove(LOG_SPILL_FILE)
+        if n_remaining:
+            os.rename(tmp_file, LOG_SPILL_FILE)
+        else:
+            os.remove(tmp_file)
+    except OSError as e:
+        print(f"Failed to load spilled experiments: {e}")
+    log_stats["spill_backlog"] = n_remaining
+
+
+def flush_log_queue():
+    """
+    Sends the oldest buffered document to MongoDB, so that the event loop is
+    blocked for at most one POST per call.
+
+    The document is only removed from the buffer once it was logged
+    successfully, so that one that failed is retried.
+
+    Returns
+    -------
+    bool
+        Whether the document was logged successfully.
+    """
+    if not post_log(log_queue[0]):
+        log_stats["failed_posts"] += 1
+        return False
+    log_queue.pop(0)
+    log_stats["logged"] += 1
+    return True
+
+
+def log_backlog():
+    """Returns the number of documents waiting to be logged."""
+    return len(log_queue) + log_stats["spill_backlog"]
+
+
+# MQTT Topics, {COURSE_ID}/{DEVICE_ID}/... with a DEVICE_ID, otherwise the
+# topics of a single device per course, {COURSE_ID}/...
+topic_prefix = f"{COURSE_ID}/{DEVICE_ID}" if DEVICE_ID else COURSE_ID
+command_topic = f"{topic_prefix}/neopixel"
+sensor_data_topic = f"{topic_prefix}/as7341"
 
 print(f"Command topic: {command_topic}")
 print(f"Sensor data topic: {sensor_data_topic}")
 
 
+async def run_payload(payload_data):
+    """
+    Runs the experiment of a payload dictionary (see `run_color_experiment`)
+    and adds its results to it, i.e., the sensor data (and its statistics,
+    with "n_samples") and timing.
+
+    With "n_samples" > 1, each sensor reading in the experiment averages that
+    many readings under the same LED setting (see `Sensor.n_samples`). The
+    payload's "n_samples" is moved into the statistics, so that JSON and
+    binary results have the same shape.
+    """
+    start = ticks_ms()
+    timing = device_state["timing"] = {}
+    device_state["phase"] = "measure"
+    command = payload_data["command"]
+    n_samples = payload_data.pop("n_samples", 1)
+    sensor.prepare()  # nothing to do if `arm_sensor` already did
+    sensor.n_samples = n_samples
+    try:
+        payload_data["sensor_data"] = await run_color_experiment(
+            command["R"], command["G"], command["B"]
+        )
+    finally:
+        sensor.n_samples = 1
+    if n_samples > 1:
+        payload_data["sensor_stats"] = {
+            key: dict(zip(CHANNEL_NAMES, sensor.stats[key]))
+            for key in ("std", "min", "max")
+        }
+        payload_data["sensor_stats"]["n_samples"] = n_samples
+    timing["total_ms"] = ticks_diff(ticks_ms(), start)
+    # the time spent reading the sensor, and the rest of the experiment
+    # (setting and clearing the LED)
+    timing["measure_ms"] = sensor.read_ms or 0
+    timing["led_ms"] = max(timing["total_ms"] - timing["measure_ms"], 0)
+    payload_data["timing"] = dict(timing)
+    # moving average of the experiment duration, advertised in the status
+    experiment_ms = device_state.get("experiment_ms")
+    if experiment_ms is None:
+        device_state["experiment_ms"] = timing["total_ms"]
+    else:
+        device_state["experiment_ms"] = 0.8 * experiment_ms + 0.2 * timing["total_ms"]
+    return payload_data
+
+
+def _pack_id(offset, value):
+    """Writes an id (length byte, 255 for None, and UTF-8 bytes) to the result
+    buffer and returns the offset after it."""
+    if value is None:
+        result_buffer[offset] = 255
+        return offset + 1
+    encoded = str(value).encode()
+    result_buffer[offset] = len(encoded)
+    result_buffer[offset + 1 : offset + 1 + len(encoded)] = encoded
+    return offset + 1 + len(encoded)
+
+
+def encode_results(records):
+    """
+    Encodes results dictionaries in the compact binary format into the reused
+    result buffer and returns a memoryview of the encoded bytes.
+
+    Only the command, ids, sensor data, sensor stats, and timing are encoded,
+    with struct.pack_into rather than building a JSON string, so there is no
+    per-message allocation besides the encoded ids.
+    """
+    global result_buffer
+    size = 3
+    for results in records:
+        size += 41 + len(str(results.get("experiment_id")).encode())
+        size += len(str(results.get("session_id")).encode())
+        if "sensor_stats" in results:
+            size += 98
+        if "timing" in results:
+            size += 12
+    if size > len(result_buffer):
+        result_buffer = bytearray(size)
+    buf = result_buffer
+
+    struct.pack_into("<BH", buf, 0, BINARY_VERSION, len(records))
+    offset = 3
+    for results in records:
+        sensor_data = results["sensor_data"]
+        stats = results.get("sensor_stats")
+        timing = results.get("timing")
+        flags = 0
+        for name in CHANNEL_NAMES:
+            if not isinstance(sensor_data[name], int):
+                flags = 1  # float32 channels
+        if stats is not None:
+            flags |= 2
+        if timing is not None:
+            flags |= 4
+        buf[offset] = flags
+        offset = _pack_id(offset + 1, results.get("experiment_id"))
+        offset = _pack_id(offset, results.get("session_id"))
+        command = results["command"]
+        struct.pack_into("<3H", buf, offset, command["R"], command["G"], command["B"])
+        offset += 6
+        fmt, width = ("<f", 4) if flags & 1 else ("<H", 2)
+        for name in CHANNEL_NAMES:
+            struct.pack_into(fmt, buf, offset, sensor_data[name])
+            offset += width
+        if stats is not None:
+            struct.pack_into("<H", buf, offset, stats["n_samples"])
+            offset += 2
+            for key in ("std", "min", "max"):
+                for name in CHANNEL_NAMES:
+                    struct.pack_into("<f", buf, offset, stats[key][name])
+                    offset += 4
+        if timing is not None:
+            for key in TIMING_KEYS:
+                struct.pack_into("<I", buf, offset, timing[key])
+                offset += 4
+    return memoryview(buf)[:offset]
+
+
+async def publish_payload(client, payload_data):
+    """
+    Publishes a payload dictionary with the results of an experiment (or an
+    aggregated batch of them, or a busy reply) to the sensor data topic.
+
+    Parameters
+    ----------
+    client : MQTTClient
+        The connected MQTT client.
+    payload_data : dict
+        The original payload dictionary with the sensor data (see
+        `run_payload`), of the form
+        {
+            "command": {"R": ..., "G": ..., "B": ...},
+            "experiment_id": "...",
+            "session_id": "...",
+            "sensor_data": {"ch410": ..., "ch440": ..., ..., "ch670": ...},
+        }
+    """
+    # TODO: Convert payload_data into a JSON string and publish it to the
+    # sensor data topic with qos=1
+    ...  # IMPLEMENT
+
+
+async def publish_results(client, results, binary=False):
+    """
+    Publishes results to the sensor data topic (see `publish_payload`), or in
+    the compact binary format to the sensor data topic + "/bin". Aggregated
+    batch results ({"session_id": ..., "batch": [...]}) are encoded as one
+    binary message.
+    """
+    device_state["phase"] = "publish"
+    start = ticks_ms()
+    if binary:
+        records = results["batch"] if "batch" in results else [results]
+        # the buffer isn't reused before the publish (and any resends) is done
+        await client.publish(sensor_data_topic + "/bin", encode_results(records), qos=1)
+    else:
+        await publish_payload(client, results)
+    device_state["timing"]["publish_ms"] = ticks_diff(ticks_ms(), start)
+
+
+async def run_batch(client, batch_data):
+    """
+    Runs the experiments of a batch payload one after the other.
+
+    A batch payload has the form
+    {
+        "session_id": "...",
+        "batch": [{"command": {...}, "experiment_id": "..."}, ...],
+        "aggregate": False,
+    }
+    Each item's results are published as soon as they are available, like for
+    a single command, or with "aggregate" all of them are published together
+    at the end as {"session_id": "...", "batch": [<results>, ...]}. The
+    "encoding" of the batch applies to items that don't have their own.
+    """
+    global last_command_time
+    session_id = batch_data.get("session_id")
+    aggregate = batch_data.get("aggregate", False)
+    encoding = batch_data.get("encoding", "json")
+    batch_results = []
+    for item in batch_data["batch"]:
+        last_command_time = time()
+        payload_data = dict(item)
+        payload_data["session_id"] = session_id
+        try:
+            await run_payload(payload_data)
+        except Exception as e:
+            with StringIO() as f:  # type: ignore
+                sys.print_exception(e, f)  # type: ignore
+                print(f.getvalue())  # type: ignore
+            continue
+        if aggregate:
+            batch_results.append(payload_data)
+        else:
+            binary = payload_data.get("encoding", encoding) == "binary"
+            await publish_results(client, payload_data, binary)
+        queue_experiment(payload_data)
+
+    if aggregate:
+        aggregated = {"session_id": session_id, "batch": batch_results}
+        await publish_results(client, aggregated, encoding == "binary")
+    arm_sensor()
+
+
 async def messages(client):  # Respond to incoming messages
+    global last_command_time
     async for topic, msg, retained in client.queue:
         try:
             topic = topic.decode()
@@ -181,37 +601,206 @@ async def messages(client):  # Respond to incoming messages
             print((topic, msg, retained))
 
             if topic == command_topic:
-                # TODO: Implement message handling logic to run the experiment
-                # and publish a dictionary with the original payload dictionary
-                # and the sensor data to the sensor data topic. The dictionary
-                # should be named payload_data and should be of the form:
-                # {
-                #     "command": {"R": ..., "G": ..., "B": ...},
-                #     "experiment_id": "...",
-                #     "session_id": "...",
-                #     "sensor_data": {"ch410": ..., "ch440": ..., ..., "ch670": ...},
-                # }
+                set_status("busy")
+                last_command_time = time()
+
+                # TODO: Load the message (a JSON string) into a dictionary
+                # named payload_data. The experiment is then run (see
+                # run_payload) and its results published (see publish_payload)
                 ...  # IMPLEMENT
 
-                # Log the experiment to MongoDB
-                log_experiment(payload_data)
+                if "batch" in payload_data:
+                    await run_batch(client, payload_data)
+                    continue
+
+                await run_payload(payload_data)
+
+                # Publish as soon as the results are available, then prepare the
+                # sensor for the next experiment and queue the logging
+                binary = payload_data.get("encoding") == "binary"
+                await publish_results(client, payload_data, binary)
+                arm_sensor()
+
+                # Queue the experiment to be logged to MongoDB
+                queue_experiment(payload_data)
 
         except Exception as e:
+            device_state["phase"] = "idle"
             with StringIO() as f:  # type: ignore
                 sys.print_exception(e, f)  # type: ignore
                 print(f.getvalue())  # type: ignore
+        finally:
+            if not len(client.queue):
+                set_status("online")
+
+
+# The device advertises its status as a retained message on the status topic,
+# when it connects and when it goes from idle ("online") to "busy" and back,
+# while the broker publishes "offline" on its behalf (last will) when the
+# connection is lost, so that the orchestrator knows which devices it can use
+status_topic = f"{topic_prefix}/status"
+STATUS_DEBOUNCE_MS = 1000  # a state is only published once it lasted this long
+status = {"state": "offline", "published": None}
+status_event = asyncio.Event()
+
+
+def set_status(state):
+    """Sets the state to advertise, which is published if it lasts (see
+    `status_updates`)."""
+    if status["state"] != state:
+        status["state"] = state
+        status_event.set()
+
+
+def status_document(client):
+    """Returns the status document of the device."""
+    return {
+        "state": status["state"],
+        "command_topic": command_topic,
+        "device_id": DEVICE_ID,
+        "firmware": FIRMWARE_VERSION,
+        "experiment_ms": device_state.get("experiment_ms"),
+        "queue_depth": len(client.queue),
+        "capacity": config["queue_len"],  # commands it takes at once (incl. running)
+        "free_ram": gc.mem_free(),
+    }
+
+
+async def status_updates(client):
+    """
+    Publishes the status when it changes.
+
+    A change is only published once the new state has lasted
+    STATUS_DEBOUNCE_MS, and only if it differs from the state that was
+    published last. A device that runs one command at a time then doesn't
+    publish "busy" and "online" for every command. Only a backlog of commands
+    (or a long batch) is advertised as "busy". Right after connecting, the
+    status is published without waiting.
+    """
+    while True:
+        await status_event.wait()
+        status_event.clear()
+        if status["published"] is not None:
+            await asyncio.sleep_ms(STATUS_DEBOUNCE_MS)
+        state = status["state"]
+        if state != status["published"]:
+            await client.publish(
+                status_topic, json.dumps(status_document(client)), True, 1
+            )
+            status["published"] = state
+
+
+# Commands that arrive while the message queue is full are refused (rather than
+# replacing queued commands) and answered with a "busy" reply, so that the
+# orchestrator can send them again later instead of waiting for a timeout
+BUSY_REPLIES_MAX = 10  # refused commands waiting for a reply, beyond that dropped
+busy_commands = []
+busy_event = asyncio.Event()
+
+
+def on_discard(topic, msg, retained):
+    """Queues a busy reply for a command that the full message queue refused."""
+    if topic == command_topic.encode() and len(busy_commands) < BUSY_REPLIES_MAX:
+        busy_commands.append(msg)
+        busy_event.set()
+
+
+def busy_reply(payload_data, queue_depth):
+    """
+    Returns the busy reply for a refused payload dictionary (or batch payload),
+    with the ids that the orchestrator matches replies on.
+    """
+    if "batch" in payload_data:
+        session_id = payload_data.get("session_id")
+        return {
+            "session_id": session_id,
+            "batch": [
+                busy_reply(dict(item, session_id=session_id), queue_depth)
+                for item in payload_data["batch"]
+            ],
+        }
+    return {
+        "experiment_id": payload_data.get("experiment_id"),
+        "session_id": payload_data.get("session_id"),
+        "status": "busy",
+        "queue_depth": queue_depth,
+    }
+
+
+async def busy_replies(client):  # Tell the orchestrator about refused commands
+    while True:
+        await busy_event.wait()
+        busy_event.clear()
+        while busy_commands:
+            msg = busy_commands.pop(0)
+            try:
+                reply = busy_reply(json.loads(msg), len(client.queue))
+            except ValueError:
+                continue
+            await publish_payload(client, reply)
 
 
 async def up(client):  # Respond to connectivity being (re)established
     while True:
         await client.up.wait()  # Wait on an Event
         client.up.clear()
-        await client.subscribe(command_topic, 1)  # renew subscriptions
+        # renew subscriptions, with QoS 2 so that a command is delivered (and
+        # run) exactly once
+        await client.subscribe(command_topic, 2)
+        # published right away, also when it was online before the connection
+        # dropped (and the broker published the last will)
+        status["state"] = "online"
+        status["published"] = None
+        status_event.set()
+
+
+async def logger(client):
+    """
+    Sends the buffered experiment documents to MongoDB in the background.
+
+    A POST (`log_experiment`) is synchronous and stalls every other task, so
+    one is only started while the device is idle: no command is waiting in
+    the message queue, none is being run, and none has arrived for
+    LOG_IDLE_TIME. Only a command that arrives during a POST waits for it,
+    by at most one POST: the DNS lookup and TLS handshake (1-3 s on the Pico
+    W, which LOG_POST_TIMEOUT doesn't bound), plus up to LOG_POST_TIMEOUT per
+    blocking read or write of the request. While WiFi or the Lambda is down,
+    POSTs are retried with exponential backoff (LOG_RETRY_MIN to
+    LOG_RETRY_MAX), so that such stalls are rare.
+    """
+    log_stats["spill_backlog"] = count_spilled()
+    retry_delay = 0
+    retry_time = time()
+    delay = 1
+    while True:
+        # between POSTs, only yield to the other tasks while there's a backlog
+        await asyncio.sleep(delay)
+        delay = 1
+        if not log_queue and log_stats["spill_backlog"]:
+            load_spilled()
+        # the POST blocks, so only send while there are no commands
+        if (
+            not log_queue
+            or len(client.queue)
+            or device_state["phase"] != "idle"
+            or time() - last_command_time < LOG_IDLE_TIME
+            or time() < retry_time
+        ):
+            continue
+        if flush_log_queue():
+            retry_delay = 0
+            delay = 0
+        else:
+            # back off while WiFi or the Lambda is down
+            retry_delay = min(max(2 * retry_delay, LOG_RETRY_MIN), LOG_RETRY_MAX)
+            retry_time = time() + retry_delay
+            print(f"Retrying logging in {retry_delay}s, backlog: {log_backlog()}")
 
 
 async def main(client):
     await client.connect()
-    for coroutine in (up, messages):
+    arm_sensor()
+    for coroutine in (up, messages, busy_replies, status_updates, logger):
         asyncio.create_task(coroutine(client))
 
     start_time = time()
@@ -219,10 +808,25 @@ async def main(client):
     while True:
         await asyncio.sleep(5)
         elapsed_time = round(time() - start_time)
-        print(f"Elapsed: {elapsed_time}s")
+        print(f"Elapsed: {elapsed_time}s, device: {device_state}")
+        print(f"Log backlog: {log_backlog()} {log_stats}")
+        queue = client.queue
+        print(
+            f"Queue: {len(queue)} waiting, high water {queue.high_water}, "
+            f"refused {queue.discards}"
+        )
 
 
 config["queue_len"] = 5  # Use event interface with specified queue length
+offline_status = {
+    "state": "offline",
+    "command_topic": command_topic,
+    "device_id": DEVICE_ID,
+    "firmware": FIRMWARE_VERSION,
+}
+config["will"] = (status_topic, json.dumps(offline_status), True, 1)
+config["queue_policy"] = "drop_newest"  # Refuse commands when the queue is full
+config["queue_discard_cb"] = on_discard
 MQTTClient.DEBUG = True  # Optional: print diagnostic messages
 client = MQTTClient(config)
 try:
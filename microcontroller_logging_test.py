@@ -0,0 +1,163 @@
+import ast
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+script_name = "microcontroller.py"
+
+
+def load_functions(names, namespace):
+    """Define functions of the microcontroller script in namespace, without running it."""
+    tree = ast.parse(open(script_name).read())
+    nodes = [
+        node
+        for node in tree.body
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+        and node.name in names
+    ]
+    assert {node.name for node in nodes} == set(
+        names
+    ), f"Functions {names} not found in {script_name}"
+    exec(
+        compile(ast.Module(body=nodes, type_ignores=[]), script_name, "exec"), namespace
+    )
+    return namespace
+
+
+class FakeLambda:
+    """Stands in for `log_experiment`, failing with the given status codes."""
+
+    def __init__(self, status_codes=()):
+        self.documents = []
+        self.status_codes = list(status_codes)
+
+    def __call__(self, document):
+        self.documents.append(document)
+        status_code = self.status_codes.pop(0) if self.status_codes else 200
+        if status_code != 200:
+            raise OSError(f"{status_code} Bad Gateway")
+
+
+def make_logger(status_codes=()):
+    log_experiment = FakeLambda(status_codes)
+    namespace = load_functions(
+        ["post_log", "flush_log_queue"],
+        {
+            "log_experiment": log_experiment,
+            "log_queue": [],
+            "log_stats": {"logged": 0, "failed_posts": 0},
+        },
+    )
+    return namespace, log_experiment
+
+
+def documents(n):
+    return [{"experiment_id": f"e{i}", "sensor_data": {}} for i in range(n)]
+
+
+def is_stub(node):
+    return any(
+        isinstance(n, ast.Expr)
+        and isinstance(n.value, ast.Constant)
+        and n.value.value is Ellipsis
+        for n in ast.walk(node)
+    )
+
+
+def test_the_exercise_functions_are_stubs():
+    stubs = {"run_color_experiment", "log_experiment", "publish_payload", "messages"}
+    tree = ast.parse(open(script_name).read())
+    nodes = {
+        node.name: node
+        for node in tree.body
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+    }
+    for name in stubs:
+        assert is_stub(nodes[name]), f"{name} should be left for the students"
+
+
+def test_flush_sends_one_document_at_a_time():
+    namespace, log_experiment = make_logger(status_codes=[200, 502])
+    namespace["log_queue"].extend(documents(3))
+    assert namespace["flush_log_queue"]()
+    assert namespace["log_queue"] == documents(3)[1:]
+    assert not namespace["flush_log_queue"]()  # kept to be retried
+    assert namespace["log_queue"] == documents(3)[1:]
+    assert namespace["log_stats"] == {"logged": 1, "failed_posts": 1}
+
+    while namespace["log_queue"]:
+        assert namespace["flush_log_queue"]()
+    assert namespace["log_stats"] == {"logged": 3, "failed_posts": 1}
+    assert [d["experiment_id"] for d in log_experiment.documents] == [
+        "e0",
+        "e1",
+        "e1",
+        "e2",
+    ]
+
+
+def test_redelivered_experiments_are_logged_once():
+    namespace = load_functions(
+        ["queue_experiment"],
+        {
+            "LOG_QUEUE_LEN": 50,
+            "LOG_DEDUPE_LEN": 2,
+            "log_queue": [],
+            "logged_keys": [],
+            "log_stats": {"queued": 0, "duplicates": 0},
+        },
+    )
+    for i in [0, 1, 1, 2, 0]:  # e0 was forgotten by the time it came back
+        namespace["queue_experiment"]({"session_id": "s1", "experiment_id": f"e{i}"})
+    assert [d["experiment_id"] for d in namespace["log_queue"]] == [
+        "e0",
+        "e1",
+        "e2",
+        "e0",
+    ]
+    assert namespace["log_stats"] == {"queued": 4, "duplicates": 1}
+
+
+class StopLogger(Exception):
+    pass
+
+
+def test_logger_only_posts_while_no_commands_are_waiting():
+    client = SimpleNamespace(queue=["command"])
+    device_state = {"phase": "idle"}
+    steps = [
+        lambda: None,  # a command is waiting
+        lambda: (client.queue.clear(), device_state.update(phase="measure")),
+        lambda: device_state.update(phase="idle"),
+        lambda: None,
+    ]
+    n_posted = []  # documents posted before each step
+
+    async def sleep(seconds):
+        if not steps:
+            raise StopLogger
+        n_posted.append(len(log_experiment.documents))
+        steps.pop(0)()
+
+    namespace, log_experiment = make_logger()
+    namespace["log_queue"].extend(documents(2))
+    namespace["log_stats"]["spill_backlog"] = 0
+    namespace = load_functions(
+        ["logger", "log_backlog"],
+        dict(
+            namespace,
+            asyncio=SimpleNamespace(sleep=sleep),
+            time=lambda: 100,
+            count_spilled=lambda: 0,
+            device_state=device_state,
+            last_command_time=0,
+            LOG_IDLE_TIME=2,
+            LOG_RETRY_MIN=2,
+            LOG_RETRY_MAX=300,
+        ),
+    )
+    with pytest.raises(StopLogger):
+        asyncio.run(namespace["logger"](client))
+    assert n_posted == [0, 0, 0, 1]
+    assert log_experiment.documents == documents(2)
@@ -0,0 +1,140 @@
+import asyncio
+from itertools import count
+
+import pytest
+
+from as7341_sensor import Sensor
+from microcontroller_logging_test import load_functions
+
+CHANNEL_NAMES = ["ch410", "ch440", "ch470", "ch510", "ch550", "ch583", "ch620", "ch670"]
+
+
+class FakeNeoPixels(list):
+    """Records every color that is written to the LED."""
+
+    def __init__(self, events):
+        super().__init__([(0, 0, 0)])
+        self.events = events
+
+    def write(self):
+        self.events.append(("led", self[0]))
+
+
+def make_device():
+    """The experiment flow of the device script, with the mocked sensor and a
+    student's implementation of the exercise functions."""
+    events = []
+    sensor = Sensor()
+    neopixels = FakeNeoPixels(events)
+    clock = count(step=5)
+
+    async def run_color_experiment(R, G, B):
+        neopixels[0] = (R, G, B)
+        neopixels.write()
+        sensor_data = dict(zip(CHANNEL_NAMES, await sensor.all_channels_async()))
+        neopixels[0] = (0, 0, 0)
+        neopixels.write()
+        return sensor_data
+
+    async def publish_payload(client, payload_data):
+        events.append(("publish", payload_data.get("experiment_id")))
+        client.append(payload_data)
+
+    namespace = load_functions(
+        ["arm_sensor", "run_payload", "publish_results", "run_batch"],
+        {
+            "sensor": sensor,
+            "run_color_experiment": run_color_experiment,
+            "publish_payload": publish_payload,
+            "queue_experiment": lambda document: events.append(
+                ("log", document["experiment_id"])
+            ),
+            "device_state": {"phase": "idle", "timing": {}},
+            "CHANNEL_NAMES": CHANNEL_NAMES,
+            "ticks_ms": lambda: next(clock),
+            "ticks_diff": lambda end, start: end - start,
+            "time": lambda: 0,
+        },
+    )
+    return namespace, sensor, events
+
+
+def payload(i, **kwargs):
+    return {"command": {"R": i, "G": 0, "B": 0}, "experiment_id": f"e{i}", **kwargs}
+
+
+async def handle_commands(namespace, client, payloads):
+    """What messages() does with each (single) command, after parsing it."""
+    for payload_data in payloads:
+        await namespace["run_payload"](payload_data)
+        await namespace["publish_results"](client, payload_data)
+        namespace["arm_sensor"]()
+
+
+def test_results_are_published_in_order():
+    namespace, sensor, events = make_device()
+    namespace["arm_sensor"]()
+    client = []
+    asyncio.run(handle_commands(namespace, client, [payload(i) for i in range(3)]))
+
+    assert [results["experiment_id"] for results in client] == ["e0", "e1", "e2"]
+    for results in client:
+        assert results["sensor_data"] == dict(
+            zip(CHANNEL_NAMES, [100, 200, 300, 400, 500, 600, 700, 800])
+        )
+        assert set(results["timing"]) == {"led_ms", "measure_ms", "total_ms"}
+    # the LED is set and cleared before each result is published
+    assert [event for event in events if event[0] == "publish"] == [
+        ("publish", "e0"),
+        ("publish", "e1"),
+        ("publish", "e2"),
+    ]
+    for i in range(3):
+        assert events[3 * i : 3 * i + 3] == [
+            ("led", (i, 0, 0)),
+            ("led", (0, 0, 0)),
+            ("publish", f"e{i}"),
+        ]
+    assert namespace["device_state"]["phase"] == "idle"
+
+
+def test_the_smux_is_configured_once_per_reading():
+    namespace, sensor, events = make_device()
+    namespace["arm_sensor"]()
+    assert sensor._smux_loads == ["F1F4CN"]  # ahead of the first command
+
+    client = []
+    asyncio.run(handle_commands(namespace, client, [payload(i) for i in range(4)]))
+
+    # each reading starts with the bank that the previous one read last (and
+    # that is still loaded), so only the second bank is configured per reading
+    assert sensor._smux_loads == ["F1F4CN"] + ["F5F8CN", "F1F4CN"] * 2
+    # and the bank that is read first next is armed
+    assert sensor._prepared == sensor._bank_order[0] == sensor._smux_loads[-1]
+
+
+@pytest.mark.parametrize("aggregate", [False, True])
+def test_batch_results_keep_their_experiment_ids(aggregate):
+    namespace, sensor, events = make_device()
+    namespace["arm_sensor"]()
+    client = []
+    batch_data = {
+        "session_id": "s1",
+        "batch": [payload(i, n_samples=3 if i == 1 else 1) for i in range(3)],
+        "aggregate": aggregate,
+    }
+    asyncio.run(namespace["run_batch"](client, batch_data))
+
+    if aggregate:
+        assert len(client) == 1 and client[0]["session_id"] == "s1"
+        records = client[0]["batch"]
+    else:
+        records = client
+    assert [r["experiment_id"] for r in records] == ["e0", "e1", "e2"]
+    assert all(r["session_id"] == "s1" for r in records)
+    assert records[1]["sensor_stats"]["n_samples"] == 3
+    assert "n_samples" not in records[1]
+    assert "sensor_stats" not in records[0]
+    assert sensor.n_samples == 1  # oversampling is only for that command
+    assert [e for e in events if e[0] == "log"] == [("log", f"e{i}") for i in range(3)]
+    assert sensor._prepared == sensor._bank_order[0]
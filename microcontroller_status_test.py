@@ -0,0 +1,169 @@
+import ast
+import asyncio
+import json
+from types import SimpleNamespace
+
+from microcontroller_logging_test import load_functions, script_name
+
+command_topic = "test/rig1/neopixel"
+status_topic = "test/rig1/status"
+
+
+class FakeClient:
+    """Records the published messages, with a message queue of commands."""
+
+    def __init__(self):
+        self.queue = []
+        self.published = []
+        self.up = asyncio.Event()
+
+    async def publish(self, topic, msg, retain=False, qos=0):
+        self.published.append((topic, json.loads(msg), retain, qos))
+
+    async def subscribe(self, topic, qos):
+        pass
+
+    def states(self):
+        return [msg["state"] for topic, msg, retain, qos in self.published]
+
+
+def make_device():
+    namespace = load_functions(
+        ["set_status", "status_document", "status_updates", "up"],
+        {
+            "asyncio": SimpleNamespace(
+                sleep_ms=lambda ms: asyncio.sleep(ms / 1000), Event=asyncio.Event
+            ),
+            "json": json,
+            "gc": SimpleNamespace(mem_free=lambda: 100000),
+            "config": {"queue_len": 5},
+            "device_state": {"experiment_ms": 600},
+            "command_topic": command_topic,
+            "status_topic": status_topic,
+            "DEVICE_ID": "rig1",
+            "FIRMWARE_VERSION": "0.1",
+            "STATUS_DEBOUNCE_MS": 100,
+            "status": {"state": "offline", "published": None},
+        },
+    )
+    return namespace
+
+
+def run_device(steps):
+    """Runs the status tasks of a device with `steps(namespace, client)`."""
+
+    async def main():
+        namespace["status_event"] = asyncio.Event()
+        tasks = [
+            asyncio.create_task(namespace[name](client))
+            for name in ("status_updates", "up")
+        ]
+        await steps(namespace, client)
+        for task in tasks:
+            task.cancel()
+
+    namespace = make_device()
+    client = FakeClient()
+    asyncio.run(main())
+    return client
+
+
+def test_status_is_published_right_after_connecting():
+    async def steps(namespace, client):
+        client.up.set()
+        await asyncio.sleep(0.01)  # well within the debounce time
+
+    client = run_device(steps)
+    assert client.published == [
+        (
+            status_topic,
+            {
+                "state": "online",
+                "command_topic": command_topic,
+                "device_id": "rig1",
+                "firmware": "0.1",
+                "experiment_ms": 600,
+                "queue_depth": 0,
+                "capacity": 5,
+                "free_ram": 100000,
+            },
+            True,  # retained
+            1,
+        )
+    ]
+
+
+def test_short_commands_dont_publish_a_status():
+    async def steps(namespace, client):
+        client.up.set()
+        await asyncio.sleep(0.01)
+        for _ in range(2):  # one command at a time, each shorter than 100 ms
+            namespace["set_status"]("busy")
+            await asyncio.sleep(0.02)
+            namespace["set_status"]("online")
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.25)
+
+    assert run_device(steps).states() == ["online"]
+
+
+def test_lasting_states_are_published_once():
+    async def steps(namespace, client):
+        client.up.set()
+        await asyncio.sleep(0.01)
+        namespace["set_status"]("busy")  # e.g., a long batch
+        await asyncio.sleep(0.2)
+        namespace["set_status"]("busy")
+        await asyncio.sleep(0.1)
+        namespace["set_status"]("online")
+        await asyncio.sleep(0.2)
+
+    assert run_device(steps).states() == ["online", "busy", "online"]
+
+
+def test_status_is_published_again_after_reconnecting():
+    async def steps(namespace, client):
+        client.up.set()
+        await asyncio.sleep(0.01)
+        client.up.set()  # the broker published the last will in between
+        await asyncio.sleep(0.01)
+
+    assert run_device(steps).states() == ["online", "online"]
+
+
+def assigns(node, name):
+    """Whether a statement assigns to `name`, e.g., "offline_status" or
+    "config['will']"."""
+    return isinstance(node, ast.Assign) and any(
+        ast.unparse(target) == name for target in node.targets
+    )
+
+
+def test_last_will_is_a_retained_offline_status():
+    tree = ast.parse(open(script_name).read())
+    nodes = [
+        node
+        for node in tree.body
+        if assigns(node, "offline_status") or assigns(node, "config['will']")
+    ]
+    assert len(nodes) == 2
+    namespace = {
+        "config": {},
+        "json": json,
+        "command_topic": command_topic,
+        "status_topic": status_topic,
+        "DEVICE_ID": "rig1",
+        "FIRMWARE_VERSION": "0.1",
+    }
+    exec(
+        compile(ast.Module(body=nodes, type_ignores=[]), script_name, "exec"), namespace
+    )
+
+    topic, msg, retain, qos = namespace["config"]["will"]
+    assert (topic, retain, qos) == (status_topic, True, 1)
+    assert json.loads(msg) == {
+        "state": "offline",
+        "command_topic": command_topic,
+        "device_id": "rig1",
+        "firmware": "0.1",
+    }
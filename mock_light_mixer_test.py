@@ -0,0 +1,34 @@
+import numpy as np
+
+from mock_light_mixer import LightMixer
+
+
+def test_history_keeps_integer_commands():
+    mixer = LightMixer()
+    mixer.run_color_experiment(255, 127, 63)
+    record = mixer._history[-1]
+    assert (record["R"], record["G"], record["B"]) == (255, 127, 63)
+    assert all(type(record[c]) is int for c in "RGB")
+    assert isinstance(record["ch410"], float)
+
+
+def test_batch_matches_single_experiments():
+    rgb = [[255, 127, 63], [0, 0, 255], [10, 20, 30]]
+    single, batch = LightMixer(), LightMixer()
+    expected = [list(single.run_color_experiment(*c).values()) for c in rgb]
+    intensities = batch.run_color_experiment_batch(rgb)
+    np.testing.assert_allclose(intensities, expected)
+    batch_history = batch._history.to_dataframe()
+    single_history = single._history.to_dataframe()
+    assert batch_history[["R", "G", "B"]].equals(single_history[["R", "G", "B"]])
+    np.testing.assert_allclose(batch_history, single_history)
+
+
+def test_objective_batch_matches_single_objective():
+    mixer = LightMixer()
+    intensities = mixer.run_color_experiment_batch([[255, 127, 63], [0, 0, 255]])
+    expected = [
+        mixer.calculate_objective(dict(zip(mixer.wavelength_names, row)))
+        for row in intensities
+    ]
+    np.testing.assert_allclose(mixer.calculate_objective_batch(intensities), expected)
@@ -0,0 +1,283 @@
+import ast
+import asyncio
+import binascii
+import errno
+import struct
+import time
+from types import SimpleNamespace
+
+import pytest
+
+script_name = "lib/mqtt_as.py"
+
+
+async def sleep_ms(ms):
+    await asyncio.sleep(ms / 1000)
+
+
+async def wait_for_ms(awaitable, timeout_ms):
+    return await asyncio.wait_for(awaitable, timeout_ms / 1000)
+
+
+class FakeWLAN:
+    def __init__(self, interface):
+        pass
+
+    def active(self, *args):
+        return True
+
+    def isconnected(self):
+        return True
+
+
+def load_mqtt_as():
+    """Define lib/mqtt_as.py with CPython stand-ins for the MicroPython modules."""
+    tree = ast.parse(open(script_name).read())
+    nodes = [
+        node for node in tree.body if not isinstance(node, (ast.Import, ast.ImportFrom))
+    ]
+    start = time.monotonic()
+    namespace = {
+        "gc": SimpleNamespace(collect=lambda: None),
+        "struct": struct,
+        "asyncio": SimpleNamespace(
+            **vars(asyncio), sleep_ms=sleep_ms, wait_for_ms=wait_for_ms
+        ),
+        "hexlify": binascii.hexlify,
+        "EINPROGRESS": errno.EINPROGRESS,
+        "ETIMEDOUT": errno.ETIMEDOUT,
+        "ticks_ms": lambda: int(1000 * (time.monotonic() - start)),
+        "ticks_diff": lambda a, b: a - b,
+        "network": SimpleNamespace(WLAN=FakeWLAN, STA_IF=0),
+        "unique_id": lambda: b"\x01\x02",
+        "const": lambda x: x,
+        "platform": "linux",
+    }
+    exec(
+        compile(ast.Module(body=nodes, type_ignores=[]), script_name, "exec"), namespace
+    )
+    return SimpleNamespace(**namespace)
+
+
+mqtt_as = load_mqtt_as()
+
+
+class FakeSocket:
+    """A non-blocking socket that returns at most `chunk` bytes per read."""
+
+    def __init__(self, data=b"", chunk=3):
+        self.data = bytearray(data)
+        self.chunk = chunk
+        self.written = []
+
+    def readinto(self, buf, n=None):
+        n = len(buf) if n is None else n
+        if not self.data:
+            return None  # nothing buffered
+        k = min(n, self.chunk, len(self.data))
+        buf[:k] = self.data[:k]
+        del self.data[:k]
+        return k
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def make_client(**config):
+    config = dict(mqtt_as.config, server="broker", queue_len=10, **config)
+    client = mqtt_as.MQTTClient(config)
+    client._isconnected = True
+    return client
+
+
+def publish_packet(topic, msg, qos=0, pid=0, dup=False):
+    body = struct.pack("!H", len(topic)) + topic
+    if qos:
+        body += struct.pack("!H", pid)
+    body += msg
+    n, remaining_length = len(body), bytearray()
+    while True:
+        b, n = n & 0x7F, n >> 7
+        remaining_length.append(b | (0x80 if n else 0))
+        if not n:
+            break
+    return bytes([0x30 | qos << 1 | dup << 3]) + remaining_length + body
+
+
+def ack(packet_type, pid):
+    return bytes([packet_type, 2]) + struct.pack("!H", pid)
+
+
+PINGRESP = b"\xd0\x00"
+
+
+def receive(client, data, n_packets, chunk=3):
+    """Feed data to wait_msg and return the messages that were queued."""
+    client._sock = FakeSocket(data, chunk)
+
+    async def main():
+        for _ in range(n_packets):
+            await client.wait_msg()
+        return [await client.queue.__anext__() for _ in range(len(client.queue))]
+
+    return asyncio.run(main())
+
+
+def test_packets_are_read_in_pieces():
+    client = make_client()
+    client.rcv_pids.add(5)
+    data = (
+        publish_packet(b"t/neopixel", b'{"R": 1}', qos=1, pid=9)
+        + ack(0x40, 5)
+        + publish_packet(b"t/q0", b"z" * 200)
+        + PINGRESP
+    )
+    messages = receive(client, data, n_packets=4)
+    assert messages == [
+        (b"t/neopixel", b'{"R": 1}', False),
+        (b"t/q0", b"z" * 200, False),
+    ]
+    assert all(type(part) is bytes for message in messages for part in message[:2])
+    assert client.rcv_pids == set()
+    assert client._sock.written == [ack(0x40, 9)]
+    assert not client._sock.data
+
+
+def test_oversized_messages_are_dropped_and_acknowledged():
+    client = make_client(max_msg_size=100)
+    data = publish_packet(b"t/big", b"y" * 1000, qos=1, pid=11) + publish_packet(
+        b"t/small", b"ok"
+    )
+    messages = receive(client, data, n_packets=2, chunk=7)
+    assert messages == [(b"t/small", b"ok", False)]
+    assert client.oversized == 1
+    assert client._sock.written == [ack(0x40, 11)]
+
+
+class FakeReader:
+    """Stands in for the StreamReader: data becomes readable after a delay."""
+
+    def __init__(self, sock, data, delay=0.01):
+        self.sock, self.data, self.delay = sock, data, delay
+
+    async def readinto(self, buf):
+        await asyncio.sleep(self.delay)
+        self.sock.data += self.data
+        return self.sock.readinto(buf)
+
+
+def test_read_waits_for_the_socket_to_be_readable():
+    client = make_client()
+    client._sock = FakeSocket(chunk=4)
+    client._reader = FakeReader(client._sock, b"\x02\x00\x07")
+
+    async def main():
+        await client._as_readinto(client._hdr_mv, 3)
+
+    asyncio.run(main())
+    assert bytes(client._hdr[:3]) == b"\x02\x00\x07"
+
+
+def test_ack_wakes_the_publisher():
+    client = make_client()
+    client.rcv_pids.add(3)
+
+    async def main():
+        waiter = asyncio.create_task(client._await_pid(3))
+        await asyncio.sleep(0)
+        client._sock = FakeSocket(ack(0x40, 3))
+        await client.wait_msg()
+        return await asyncio.wait_for(waiter, timeout=0.05)  # not polled
+
+    assert asyncio.run(main())
+
+
+def test_reconnect_wakes_the_publisher():
+    client = make_client()
+    client._sock = FakeSocket()
+    client.rcv_pids.add(3)
+
+    async def main():
+        waiter = asyncio.create_task(client._await_pid(3))
+        await asyncio.sleep(0)
+        client._reconnect()
+        return await asyncio.wait_for(waiter, timeout=0.05)
+
+    assert not asyncio.run(main())
+
+
+def test_publish_is_a_single_write():
+    client = make_client()
+    client._sock = FakeSocket()
+    asyncio.run(client._publish(b"t/as7341", b"x" * 50, 0, 1, 0, 7))
+    assert client._sock.written == [publish_packet(b"t/as7341", b"x" * 50, 1, 7)]
+
+
+def test_write_waits_while_the_send_buffer_is_full():
+    client = make_client()
+    client._sock = FakeSocket()
+    results = iter([None, 2, 0, 10])  # full, partial, full, rest
+
+    def write(data):
+        n = next(results)
+        if n:
+            client._sock.written.append(bytes(data[:n]))
+        return n
+
+    client._sock.write = write
+    asyncio.run(client._as_write(b"abcdefgh"))
+    assert b"".join(client._sock.written) == b"abcdefgh"
+
+
+def test_qos2_messages_are_delivered_once():
+    client = make_client(qos2_inflight=2)
+    data = (
+        publish_packet(b"t", b"a", qos=2, pid=3)
+        + publish_packet(b"t", b"a", qos=2, pid=3, dup=True)  # redelivery
+        + ack(0x62, 3)  # PUBREL: pid 3 may be reused
+        + publish_packet(b"t", b"b", qos=2, pid=3)
+        + publish_packet(b"t", b"c", qos=2, pid=4)
+        + publish_packet(b"t", b"d", qos=2, pid=5)  # forgets pid 3
+        + publish_packet(b"t", b"b", qos=2, pid=3, dup=True)
+    )
+    messages = receive(client, data, n_packets=7)
+    assert [msg for _, msg, _ in messages] == [b"a", b"b", b"c", b"d", b"b"]
+    assert client.qos2_dups == 1
+    assert client._sock.written == [
+        ack(0x50, 3),  # PUBREC
+        ack(0x50, 3),
+        ack(0x70, 3),  # PUBCOMP
+        ack(0x50, 3),
+        ack(0x50, 4),
+        ack(0x50, 5),
+        ack(0x50, 3),
+    ]
+
+
+def test_qos2_is_for_subscriptions_only():
+    mqtt_as.sub_qos_check(2)
+    with pytest.raises(ValueError):
+        mqtt_as.qos_check(2)
+
+
+def test_full_queue_refuses_new_messages():
+    discarded = []
+    queue = mqtt_as.MsgQueue(3, "drop_newest", lambda *v: discarded.append(v))
+    assert queue.put(b"t", b"1", False) and queue.put(b"t", b"2", False)
+    assert not queue.put(b"t", b"3", False)
+    assert discarded == [(b"t", b"3", False)]
+    assert (len(queue), queue.high_water, queue.discards) == (2, 2, 1)
+    assert asyncio.run(queue.__anext__()) == (b"t", b"1", False)
+
+
+def test_full_queue_overwrites_the_oldest_message():
+    discarded = []
+    queue = mqtt_as.MsgQueue(3, on_discard=lambda *v: discarded.append(v))
+    for msg in (b"1", b"2", b"3"):
+        assert queue.put(b"t", msg, False)
+    assert discarded == [(b"t", b"1", False)]
+    assert asyncio.run(queue.__anext__()) == (b"t", b"2", False)
@@ -6,7 +6,7 @@ import os
 import json
 import secrets
 import threading
-from time import time
+from time import time, sleep
 
 import numpy as np
 import pandas as pd
@@ -14,12 +14,14 @@ import pandas as pd
 from queue import Queue, Empty
 import paho.mqtt.client as paho
 
+from experiment_transport import ExperimentTransport, device_topic
+from database import get_database
+from evaluation_cache import EvaluationCache
+
 from ax.service.ax_client import AxClient, ObjectiveProperties
 import plotly.graph_objects as go
 from sklearn.metrics import mean_absolute_error
 
-from pymongo.mongo_client import MongoClient
-
 course_id = os.environ["COURSE_ID"]
 
 username = os.environ["HIVEMQ_USERNAME"]
@@ -30,9 +32,21 @@ database_name = os.environ["DATABASE_NAME"]
 collection_name = os.environ["COLLECTION_NAME"]
 atlas_uri = os.environ["ATLAS_URI"]
 
-# Topics
-neopixel_topic = f"{course_id}/neopixel"
-as7341_topic = f"{course_id}/as7341"
+# One pooled MongoDB client for the whole run (evaluation cache lookups and the
+# data logging below), created on first use since connecting to Atlas is slow
+database = get_database(
+    atlas_uri,
+    database_name,
+    max_pool_size=4,
+    connect_timeout=10,
+    server_selection_timeout=10,
+)
+
+# Topics, {course_id}/{device_id}/... for devices with a DEVICE_ID and
+# {course_id}/... for a single device without one
+neopixel_topic = device_topic(course_id, "neopixel")
+as7341_topic = device_topic(course_id, "as7341")
+status_topic = device_topic(course_id, "status")  # retained device status documents
 
 # create random session id to keep track of the session and filter out old data
 session_id = ...  # IMPLEMENT
@@ -43,6 +57,53 @@ with open("session_id.txt", "w") as f:  # for autograding
 num_iter = 20
 target_command = {"R": 38, "G": 79, "B": 63}
 
+# number of trials to request from Ax at once (1 = one trial at a time)
+batch_size = 1
+
+# number of sensor readings averaged on the device per experiment (the results
+# then also include their per-channel std, min, and max as "sensor_stats")
+n_samples = 1
+
+# command topics of the devices that batches of trials are spread over, one per
+# device, e.g., [device_topic(course_id, "neopixel", "pico1"), ...]
+command_topics = [neopixel_topic]
+
+# Run the experiments over one long-lived ExperimentTransport (see the
+# experiment_transport package) instead of get_client_and_queue and
+# run_experiment below. The transport retries commands that a device refuses as
+# busy and sends each trial to the least-loaded device, and the options below
+# need it.
+use_transport = False
+
+# (transport only) maximum number of trials per device waiting for results
+# (None for the number of commands that the device advertises it can take), and
+# the number of seconds after which a trial is reassigned to another device.
+# With command_topics = None, trials go to every device of this course that
+# advertises that it's online (see DeviceRegistry).
+max_in_flight = None
+device_timeout = 60
+
+# (transport only) number of seconds to wait at startup for a device to
+# advertise that it's online. Keep this short: the first command has to go out
+# well within the autograder's 45 s, and devices without a status still work.
+status_timeout = 5
+
+# (transport only) send each device its share of a batch of trials as one
+# message (a batch payload) instead of one message per trial
+batch_payloads = False
+
+# (transport only) "binary" to have the devices publish compact struct-packed
+# results instead of JSON (see experiment_transport.encode_results), which is
+# smaller and cheaper to produce on the microcontroller; extra payload keys
+# aren't echoed back then
+result_encoding = "json"
+
+# Optionally reuse the results of commands at or near ones already measured,
+# e.g., EvaluationCache(tolerance=2, replicates=1, max_age=3600), or
+# MongoEvaluationCache(database[collection_name], ...) to also reuse results
+# from earlier runs
+evaluation_cache = None  # type: EvaluationCache | None
+
 # %% MQTT Communication
 
 
@@ -187,10 +248,173 @@ def run_experiment(
             return results
 
 
-# Orchestrator subscribes to the sensor data topic
-mqtt_client, queue = get_client_and_queue(
-    as7341_topic, host, username, password=password
-)
+def run_experiments(
+    client,
+    queue,
+    command_topics,
+    payload_dicts,
+    queue_timeout=30,
+    function_timeout=300,
+    busy_delay=1,
+):
+    """
+    This function sends several commands at once, spreading them over the
+    devices listening on the command topics, and yields the results in the
+    order that they arrive.
+
+    Parameters
+    ----------
+    client : paho.mqtt.client.Client
+        The Paho MQTT client to use for sending the commands and receiving the
+        results.
+    queue : queue.Queue
+        The queue where incoming messages from the MQTT client will be stored.
+    command_topics : list of str
+        The MQTT topics to publish the commands to, one per device. Commands
+        are assigned to the topics in a round-robin fashion.
+    payload_dicts : list of dict
+        The dictionaries containing the command and experiment_id, each with a
+        unique experiment_id.
+    queue_timeout : int, optional
+        The number of seconds to wait for a message in the queue before timing
+        out, by default 30.
+    function_timeout : int, optional
+        The number of seconds to wait for all of the results before timing out,
+        by default 300.
+    busy_delay : float, optional
+        The number of seconds to wait before sending a command again that a
+        device refused because its queue was full, by default 1.
+
+    Yields
+    ------
+    int, dict
+        The index of the payload dictionary in payload_dicts and the results
+        of the corresponding experiment, as a dictionary.
+
+    Raises
+    ------
+    TimeoutError
+        If not all results arrive within the specified function_timeout.
+    queue.Empty
+        If no message is received in the queue within the specified
+        queue_timeout.
+
+    Examples
+    --------
+    >>> payload_dicts = [
+    ...     {"command": {"R": 255, "G": 0, "B": 0}, "experiment_id": "a1"},
+    ...     {"command": {"R": 0, "G": 255, "B": 0}, "experiment_id": "b2"},
+    ... ]
+    >>> for i, results in run_experiments(client, queue, ["test/topic"], payload_dicts):
+    ...     print(i, results["experiment_id"])
+    1 b2
+    0 a1
+    """
+    # keep track of which payload each outstanding experiment id belongs to
+    pending = {}
+    for i, payload_dict in enumerate(payload_dicts):
+        command_topic = command_topics[i % len(command_topics)]
+        client.publish(command_topic, json.dumps(payload_dict), qos=2)
+        pending[payload_dict["experiment_id"]] = i
+
+    client.loop_start()
+
+    t0 = time()
+    try:
+        while pending:
+            if time() - t0 > function_timeout:
+                raise TimeoutError(
+                    f"Function timed out with {len(pending)} experiment(s) "
+                    f"outstanding ({function_timeout} seconds)"
+                )
+            try:
+                results = queue.get(True, timeout=queue_timeout)
+            except Empty as e:
+                raise Empty(
+                    f"Sensor data retrieval timed out ({queue_timeout} seconds)"
+                ) from e
+
+            # results can come back in any order, e.g., from different devices
+            if (
+                not isinstance(results, dict)
+                or results.get("experiment_id") not in pending
+            ):
+                continue
+            i = pending[results["experiment_id"]]
+            if results.get("status") == "busy":
+                # the device's queue was full, so send the command again later
+                sleep(busy_delay)
+                command_topic = command_topics[i % len(command_topics)]
+                client.publish(command_topic, json.dumps(payload_dicts[i]), qos=2)
+                continue
+            yield pending.pop(results["experiment_id"]), results
+    finally:
+        client.loop_stop()
+
+
+transport = None
+if use_transport:
+    # One long-lived connection for the whole campaign. Results are matched to
+    # the waiting experiment by experiment_id, so concurrent experiments can
+    # share it. The status of the devices of this course is kept in
+    # transport.devices, for spreading trials over the devices.
+    transport = ExperimentTransport(
+        [as7341_topic, device_topic(course_id, "as7341", "+")],
+        host,
+        username,
+        password=password,
+        status_topic=[status_topic, device_topic(course_id, "status", "+")],
+    )
+
+    # Wait for a device to advertise that it's online (the status is retained,
+    # so this is immediate if one already is)
+    if transport.devices.wait_online(timeout=status_timeout):
+        for command_topic in transport.devices.online():
+            print(f"Device status: {transport.devices.get(command_topic)}")
+    elif command_topics is None:
+        print(f"No online status from {status_topic} yet, sending commands anyway")
+        command_topics = [neopixel_topic]
+else:
+    # Orchestrator subscribes to the sensor data topic
+    mqtt_client, queue = get_client_and_queue(
+        as7341_topic, host, username, password=password
+    )
+
+
+def dispatch_experiments(payload_dicts):
+    """
+    This function sends the payloads to the devices and yields the results as
+    they arrive, over the transport (each to the least-loaded device) if
+    use_transport, otherwise with run_experiments.
+
+    Parameters
+    ----------
+    payload_dicts : list of dict
+        The payload dictionaries to be sent to the neopixels. Over the
+        transport, an experiment that is reassigned to another device is
+        replaced with its retry, which has a new experiment_id.
+
+    Yields
+    ------
+    int, dict
+        The index of the payload dictionary in payload_dicts and the results of
+        the experiment.
+
+    Examples
+    --------
+    >>> list(dispatch_experiments([{"command": {"R": 255, "G": 0, "B": 0}, "experiment_id": "a1", "session_id": "d4e5f6"}]))
+    [(0, {"command": {"R": 255, "G": 0, "B": 0}, "experiment_id": "a1", "session_id": "d4e5f6", "sensor_data": {...}})]
+    """
+    if transport is None:
+        return run_experiments(mqtt_client, queue, command_topics, payload_dicts)
+    return transport.run_experiments(
+        command_topics,
+        payload_dicts,
+        batch=batch_payloads,
+        max_in_flight=max_in_flight,
+        device_timeout=device_timeout,
+    )
+
 
 # %% Bayesian Optimization
 
@@ -199,8 +423,17 @@ target_payload_dict = {
     "experiment_id": "target",
     "session_id": session_id,
 }
-
-target_results = run_experiment(mqtt_client, queue, neopixel_topic, target_payload_dict)
+if n_samples > 1:
+    target_payload_dict["n_samples"] = n_samples
+if result_encoding != "json":
+    target_payload_dict["encoding"] = result_encoding
+
+if transport is None:
+    target_results = run_experiment(
+        mqtt_client, queue, neopixel_topic, target_payload_dict
+    )
+else:
+    [(_, target_results)] = dispatch_experiments([target_payload_dict])
 print(f"Target results: {target_results}")
 target_sensor_data = target_results["sensor_data"]
 
@@ -210,12 +443,10 @@ results_dicts = []  # For autograding
 obj_name = "mae"
 
 
-def evaluate(command):
+def get_payload_dict(command):
     """
-    This function sends a command to the neopixel, waits for sensor data,
-    calculates the mean absolute error (MAE) between the received sensor data
-    and target sensor data, and returns a dictionary with the object name and
-    MAE.
+    This function creates the payload dictionary for a command, tagged with a
+    new random experiment id and the session id.
 
     Parameters
     ----------
@@ -226,13 +457,12 @@ def evaluate(command):
     Returns
     -------
     dict
-        A dictionary with the object name as the key and the calculated MAE as
-        the value.
+        A dictionary with the command, experiment id, and session id.
 
     Examples
     --------
-    >>> evaluate({"R": 255, "G": 255, "B": 255})
-    {"mae": 12.34}
+    >>> get_payload_dict({"R": 255, "G": 255, "B": 255})
+    {"command": {"R": 255, "G": 255, "B": 255}, "experiment_id": "1a2b3c4d", "session_id": "d4e5f6"}
     """
     # create a random experiment id to keep track where the sensor data is from
     experiment_id = ...  # IMPLEMENT
@@ -243,9 +473,37 @@ def evaluate(command):
         "experiment_id": experiment_id,
         "session_id": session_id,
     }
+    if n_samples > 1:
+        payload_dict["n_samples"] = n_samples
+    if result_encoding != "json":
+        payload_dict["encoding"] = result_encoding
+    return payload_dict
 
-    results_dict = run_experiment(mqtt_client, queue, neopixel_topic, payload_dict)
 
+def score(payload_dict, results_dict):
+    """
+    This function calculates the mean absolute error (MAE) between the received
+    sensor data and target sensor data, and returns a dictionary with the
+    object name and MAE.
+
+    Parameters
+    ----------
+    payload_dict : dict
+        The payload dictionary that was sent to the neopixel.
+    results_dict : dict
+        The results of the experiment, as returned by run_experiment.
+
+    Returns
+    -------
+    dict
+        A dictionary with the object name as the key and the calculated MAE as
+        the value.
+
+    Examples
+    --------
+    >>> score(payload_dict, results_dict)
+    {"mae": 12.34}
+    """
     # calculate MAE between sensor data and target sensor data
     mae = ...  # IMPLEMENT
 
@@ -256,6 +514,175 @@ def evaluate(command):
     return ...  # IMPLEMENT
 
 
+def run_cached_experiments(payload_dicts):
+    """
+    This function looks up the results of each payload's command in
+    evaluation_cache, so that (nearly) repeated commands aren't measured again.
+
+    Parameters
+    ----------
+    payload_dicts : list of dict
+        The payload dictionaries that would be sent to the neopixel.
+
+    Returns
+    -------
+    list of dict or None
+        For each payload, the cached results (tagged with the payload's
+        experiment_id and session_id, and marked as cached) or None if the
+        command needs to be measured.
+
+    Examples
+    --------
+    >>> run_cached_experiments([{"command": {"R": 255, "G": 0, "B": 0}, "experiment_id": "a1", "session_id": "d4e5f6"}])
+    [None]
+    """
+    if evaluation_cache is None:
+        return [None] * len(payload_dicts)
+
+    results_dicts = []
+    for payload_dict in payload_dicts:
+        cached = evaluation_cache.lookup(payload_dict["command"])
+        if cached is not None:
+            # keep the measured command and sensor data, but file it under this
+            # experiment so that it can be traced back to the cached experiment
+            cached = {
+                **cached,
+                **payload_dict,
+                "cached_experiment_id": cached.get("experiment_id"),
+                "measured_command": cached.get("command"),
+            }
+        results_dicts.append(cached)
+    return results_dicts
+
+
+def evaluate(command):
+    """
+    This function sends a command to the neopixel, waits for sensor data,
+    calculates the mean absolute error (MAE) between the received sensor data
+    and target sensor data, and returns a dictionary with the object name and
+    MAE.
+
+    Parameters
+    ----------
+    command : dict
+        The command to be sent to the neopixel. This should be a dictionary with
+        'R', 'G', and 'B' keys.
+
+    Returns
+    -------
+    dict
+        A dictionary with the object name as the key and the calculated MAE as
+        the value.
+
+    Examples
+    --------
+    >>> evaluate({"R": 255, "G": 255, "B": 255})
+    {"mae": 12.34}
+    """
+    payload_dict = get_payload_dict(command)
+
+    results_dict = run_cached_experiments([payload_dict])[0]
+    if results_dict is None:
+        if transport is None:
+            results_dict = run_experiment(
+                mqtt_client, queue, neopixel_topic, payload_dict
+            )
+        else:
+            # a reassigned experiment is replaced with its retry (new experiment_id)
+            dispatched = [payload_dict]
+            [(_, results_dict)] = dispatch_experiments(dispatched)
+            [payload_dict] = dispatched
+        if evaluation_cache is not None:
+            evaluation_cache.add(command, results_dict)
+
+    return score(payload_dict, results_dict)
+
+
+def evaluate_batch(commands):
+    """
+    This function sends several commands at once across the devices (each to
+    the least-loaded one) and yields the MAE for each command as its sensor data
+    arrives, which is not necessarily in the order of the commands.
+
+    Parameters
+    ----------
+    commands : list of dict
+        The commands to be sent to the neopixels. Each should be a dictionary
+        with 'R', 'G', and 'B' keys.
+
+    Yields
+    ------
+    int, dict
+        The index of the command in commands and a dictionary with the object
+        name as the key and the calculated MAE as the value.
+
+    Examples
+    --------
+    >>> for i, results in evaluate_batch([{"R": 255, "G": 0, "B": 0}, {"R": 0, "G": 255, "B": 0}]):
+    ...     print(i, results)
+    1 {"mae": 23.45}
+    0 {"mae": 12.34}
+    """
+    batch_payload_dicts = [get_payload_dict(command) for command in commands]
+
+    cached_results_dicts = run_cached_experiments(batch_payload_dicts)
+    uncached = [i for i, r in enumerate(cached_results_dicts) if r is None]
+    for i, results_dict in enumerate(cached_results_dicts):
+        if results_dict is not None:
+            yield i, score(batch_payload_dicts[i], results_dict)
+
+    # a reassigned experiment is replaced with its retry (new experiment_id)
+    dispatched = [batch_payload_dicts[i] for i in uncached]
+    for j, results_dict in dispatch_experiments(dispatched):
+        i = uncached[j]
+        if evaluation_cache is not None:
+            evaluation_cache.add(commands[i], results_dict)
+        yield i, score(dispatched[j], results_dict)
+
+
+def run_trials_in_batches(ax_client, n_trials, batch_size):
+    """
+    This function runs n_trials trials, asking Ax for up to batch_size trials at
+    a time and completing each trial as its results arrive. Afterwards, the
+    payload_dicts and results_dicts for autograding are in trial order.
+
+    Parameters
+    ----------
+    ax_client : ax.service.ax_client.AxClient
+        The AxClient of the experiment.
+    n_trials : int
+        The number of trials to run.
+    batch_size : int
+        The maximum number of trials to run at once.
+
+    Examples
+    --------
+    >>> run_trials_in_batches(ax_client, 20, 4)
+    >>> [results_dict["trial_index"] for results_dict in results_dicts][:4]
+    [0, 1, 2, 3]
+    """
+    n_run = 0
+    while n_run < n_trials:
+        # Ax may return fewer trials than requested, e.g., while the model is
+        # still waiting on data from the initial (Sobol) trials
+        trials, _ = ax_client.get_next_trials(
+            max_trials=min(batch_size, n_trials - n_run)
+        )
+        trial_indices = list(trials.keys())
+        for i, results in evaluate_batch(list(trials.values())):
+            ax_client.complete_trial(trial_index=trial_indices[i], raw_data=results)
+            results_dicts[-1]["trial_index"] = trial_indices[i]  # for autograding
+        n_run += len(trials)
+
+    # results arrive out of order, so put both lists (which score() appends to
+    # together) back in trial order, to line up with each other and with Ax
+    order = sorted(
+        range(len(results_dicts)), key=lambda k: results_dicts[k]["trial_index"]
+    )
+    payload_dicts[:] = [payload_dicts[k] for k in order]  # for autograding
+    results_dicts[:] = [results_dicts[k] for k in order]  # for autograding
+
+
 # Define the parameters per the README.md file instructions
 parameters = ...  # IMPLEMENT
 
@@ -269,13 +696,19 @@ ax_client = AxClient(random_seed=42)
 # parameters and objective(s)
 ax_client.create_experiment(parameters=parameters, objectives=objectives)
 
-for _ in range(num_iter):
-    parameterization, trial_index = ax_client.get_next_trial()
-    # e.g., parameterization={"R": 10, "G": 20, "B": 15} and trial_index=0
-    results = evaluate(parameterization)
-    ax_client.complete_trial(trial_index=trial_index, raw_data=results)
+if batch_size == 1:
+    for _ in range(num_iter):
+        parameterization, trial_index = ax_client.get_next_trial()
+        # e.g., parameterization={"R": 10, "G": 20, "B": 15} and trial_index=0
+        results = evaluate(parameterization)
+        ax_client.complete_trial(trial_index=trial_index, raw_data=results)
+else:
+    run_trials_in_batches(ax_client, num_iter, batch_size)
 
 
+if transport is not None:
+    transport.close()
+
 best_parameters, metrics = ax_client.get_best_parameters()
 
 # Extract the values in the order of the keys in target_command
@@ -322,7 +755,13 @@ with open("results.json", "w") as f:
 
 # %% Data logging
 
-# get all results that have the same session ID as this run
+# the devices log results while they're idle, so the last ones may still be on
+# their way (the query reuses the pooled client, as should the ones below)
+n_logged = database[collection_name].count_documents({"session_id": session_id})
+print(f"Results logged to MongoDB so far: {n_logged}")
+
+# get all results that have the same session ID as this run, from
+# database[collection_name]
 ...  # IMPLEMENT
 
 # Create a flattened pandas DataFrame from database
@@ -331,5 +770,5 @@ with open("results.json", "w") as f:
 # Export to results.csv file
 ...  # IMPLEMENT
 
-# Close the client
+# Close the client (database.close())
 ...  # IMPLEMENT
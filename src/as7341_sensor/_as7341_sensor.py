@@ -1,12 +1,31 @@
 class Sensor:
     """Mock class for Sensor: Wrapper for AS7341 implementation"""
 
-    def __init__(self, atime=100, astep=999, gain=8, i2c=None):
+    def __init__(
+        self,
+        atime=100,
+        astep=999,
+        gain=8,
+        i2c=None,
+        int_pin=None,
+        auto_exposure=False,
+        target_counts=(0.2, 0.8),
+        min_astep=99,
+        max_attempts=4,
+        n_samples=1,
+    ):
         """Mock initialization of Sensor"""
         self.__atime = atime
         self.__astep = astep
         self.__gain = gain
         self._all_channels_accessed = False  # This is for testing purposes
+        self._prepared = None
+        self._smux_loads = []  # configurations loaded, for testing purposes
+        self.auto_exposure = auto_exposure
+        self._bank_order = ("F1F4CN", "F5F8CN")
+        self.n_samples = n_samples
+        self.read_ms = None
+        self.stats = None
 
     @property
     def _atime(self):
@@ -22,7 +41,7 @@ class Sensor:
 
     @_astep.setter
     def _astep(self, value):
-        self.__atime = value
+        self.__astep = value
 
     @property
     def _gain(self):
@@ -32,11 +51,59 @@ class Sensor:
     def _gain(self, gain):
         self.__gain = gain
 
+    def prepare(self, selection=None):
+        """Mock method to load a SMUX configuration ahead of time"""
+        selection = selection or self._bank_order[0]
+        if self._prepared != selection:
+            # like the driver, only load a configuration that isn't loaded yet
+            loaded = self._smux_loads[-1] if self._smux_loads else None
+            if selection != loaded:
+                self._smux_loads.append(selection)
+            self._prepared = selection
+
+    def measure(self, selection):
+        """Mock method to measure the 6 channels of a SMUX configuration"""
+        self.prepare(selection)
+        self._prepared = None
+        if selection == "F5F8CN":
+            return [500, 600, 700, 800, 0, 0]  # return mock values
+        return [100, 200, 300, 400, 0, 0]  # return mock values
+
     @property
     def all_channels(self):
         """Mock method to get all channels data"""
         self._all_channels_accessed = True  # This is for testing purposes
-        return [100, 200, 300, 400, 500, 600, 700, 800]  # return mock values
+        self.read_ms = 0
+        if self.n_samples > 1:
+            return list(self.read_stats(self.n_samples)["mean"])
+        # like the driver, read the bank that is still loaded first
+        first, second = self._bank_order
+        counts = {first: self.measure(first), second: self.measure(second)}
+        self._bank_order = self._bank_order[::-1]
+        return counts["F1F4CN"][:4] + counts["F5F8CN"][:4]  # mock values
+
+    async def measure_async(self, selection, timeout_ms=None):
+        """Mock method to measure a SMUX configuration without blocking"""
+        return self.measure(selection)
+
+    async def all_channels_async(self):
+        """Mock method to get all channels data without blocking"""
+        return self.all_channels
+
+    def read_stats(self, n_samples):
+        """Mock method to get per-channel statistics of repeated readings"""
+        channels = [100, 200, 300, 400, 500, 600, 700, 800]  # mock values
+        self.stats = {
+            "mean": channels,
+            "std": [0.0] * len(channels),
+            "min": channels,
+            "max": channels,
+        }
+        return self.stats
+
+    async def read_stats_async(self, n_samples):
+        """Mock method to get statistics of repeated readings without blocking"""
+        return self.read_stats(n_samples)
 
     def disable(self):
         """Mock method to disable the sensor"""
@@ -1,2 +1,8 @@
 """Mock function that  gets installed by requirements.txt"""
-from color_matching._color_matching import grid_color_search, random_color_search
+from color_matching._color_matching import (
+    evaluate_unordered,
+    grid_color_search,
+    iter_color_grid,
+    random_color_search,
+    stream_grid_color_search,
+)
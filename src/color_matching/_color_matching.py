@@ -1,8 +1,328 @@
+import asyncio
+import inspect
+from itertools import islice, product
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+
 import numpy as np
 from sklearn.model_selection import ParameterGrid
 
 
-def grid_color_search(evaluation_function, num_iter):
+def evaluate_unordered(evaluation_function, inputs, executor=None, max_in_flight=None):
+    """
+    Evaluates each of the inputs, yielding the scores in the order in which the
+    evaluations complete.
+
+    Parameters
+    ----------
+    evaluation_function : function
+        A function that takes one of the inputs and returns a score. With the
+        "asyncio" executor, this may also be a coroutine function. With the
+        "process" executor, it must be picklable (e.g., a module-level
+        function).
+    inputs : iterable
+        The inputs to evaluate, e.g., dictionaries of RGB color components.
+    executor : str or concurrent.futures.Executor, optional
+        How to run the evaluations: None (serially, in order), "thread" (in a
+        thread pool), "process" (in a process pool), "asyncio" (as tasks on a
+        dedicated event loop, with synchronous functions run in threads) or an
+        existing Executor instance, which is not shut down afterwards. By
+        default None.
+    max_in_flight : int, optional
+        The maximum number of evaluations running at once, by default None (as
+        many as the thread or process pool has workers, or no limit for
+        "asyncio" and Executor instances).
+
+    Yields
+    ------
+    int, object
+        The index of the input and its score.
+
+    Examples
+    --------
+    >>> def evaluate(params):
+    ...     return params['R'] + params['G'] + params['B']
+    ...
+    >>> inputs = [{'R': 0, 'G': 0, 'B': 0}, {'R': 255, 'G': 0, 'B': 0}]
+    >>> list(evaluate_unordered(evaluate, inputs, executor="thread"))
+    [(1, 255), (0, 0)]  # hypothetical completion order
+    """
+    if max_in_flight is not None and max_in_flight < 1:
+        raise ValueError(f"max_in_flight must be at least 1, not {max_in_flight}")
+
+    if executor is None:
+        for i, x in enumerate(inputs):
+            yield i, evaluation_function(x)
+    elif executor == "asyncio":
+        yield from _evaluate_asyncio(evaluation_function, inputs, max_in_flight)
+    elif isinstance(executor, Executor):
+        yield from _evaluate_executor(
+            evaluation_function, inputs, executor, max_in_flight
+        )
+    elif executor in ("thread", "process"):
+        pool = ThreadPoolExecutor if executor == "thread" else ProcessPoolExecutor
+        with pool(max_workers=max_in_flight) as pool_executor:
+            yield from _evaluate_executor(
+                evaluation_function, inputs, pool_executor, max_in_flight
+            )
+    else:
+        raise ValueError(
+            f"executor must be None, 'thread', 'process', 'asyncio' or an "
+            f"Executor instance, not {executor!r}"
+        )
+
+
+def _evaluate_executor(evaluation_function, inputs, executor, max_in_flight):
+    """Evaluate inputs on a concurrent.futures executor, in completion order."""
+    inputs = enumerate(inputs)
+    pending = {}
+
+    def submit_next():
+        for i, x in inputs:
+            pending[executor.submit(evaluation_function, x)] = i
+            return True
+        return False
+
+    try:
+        while (max_in_flight is None or len(pending) < max_in_flight) and (
+            submit_next()
+        ):
+            pass
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                submit_next()
+                yield i, future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _evaluate_asyncio(evaluation_function, inputs, max_in_flight):
+    """Evaluate inputs as tasks on a new event loop, in completion order."""
+
+    async def evaluate(x):
+        if inspect.iscoroutinefunction(evaluation_function):
+            return await evaluation_function(x)
+        return await asyncio.to_thread(evaluation_function, x)
+
+    inputs = enumerate(inputs)
+    pending = {}
+    loop = asyncio.new_event_loop()
+
+    def submit_next():
+        for i, x in inputs:
+            pending[loop.create_task(evaluate(x))] = i
+            return True
+        return False
+
+    try:
+        while (max_in_flight is None or len(pending) < max_in_flight) and (
+            submit_next()
+        ):
+            pass
+        while pending:
+            done, _ = loop.run_until_complete(
+                asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            )
+            for task in done:
+                i = pending.pop(task)
+                submit_next()
+                yield i, task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+
+
+def _evaluate_ordered(evaluation_function, inputs, executor, max_in_flight, on_result):
+    """Evaluate inputs concurrently, returning the scores in the input order."""
+    scores = [None] * len(inputs)
+    for i, score in evaluate_unordered(
+        evaluation_function, inputs, executor=executor, max_in_flight=max_in_flight
+    ):
+        scores[i] = score
+        if on_result is not None:
+            on_result(i, inputs[i], score)
+    return scores
+
+
+def _color_grid_axes(num_iter=None, num_pts_per_dim=None, color_bounds=None):
+    """Return the grid values along each color dimension."""
+    param_grid = {}
+    if color_bounds is None:
+        color_bounds = {"R": [0, 255], "G": [0, 255], "B": [0, 255]}
+    if num_pts_per_dim is None:
+        num_pts_per_dim = int(np.floor(num_iter ** (1 / len(color_bounds))))
+    for name, bnd in color_bounds.items():
+        param_grid[name] = np.linspace(bnd[0], bnd[1], num=num_pts_per_dim)
+        if isinstance(bnd[0], int):
+            param_grid[name] = np.round(param_grid[name]).astype(int)
+    return param_grid
+
+
+def iter_color_grid(num_iter=None, num_pts_per_dim=None, color_bounds=None):
+    """
+    Lazily generates the points of a color grid, one at a time, in the same
+    order as `grid_color_search` (the last color in alphabetical order varies
+    fastest).
+
+    Parameters
+    ----------
+    num_iter : int, optional
+        The approximate total number of grid points, as in `grid_color_search`.
+    num_pts_per_dim : int, optional
+        The number of grid points per color, instead of `num_iter`, e.g., 256
+        for a full 256^3 sweep.
+    color_bounds : dict, optional
+        The [lower, upper] bounds of each color, by default 0-255 for each of
+        'R', 'G', and 'B'. Integer bounds give integer grid values, e.g.,
+        ``{"R": [0, 65535], "G": [0, 65535], "B": [0, 65535]}`` for 16-bit PWM.
+
+    Yields
+    ------
+    dict
+        A dictionary with a value for each color, e.g., keys 'R', 'G', 'B'.
+
+    Examples
+    --------
+    >>> list(iter_color_grid(num_pts_per_dim=2))[:3]
+    [{'R': 0, 'G': 0, 'B': 0}, {'R': 255, 'G': 0, 'B': 0}, {'R': 0, 'G': 255, 'B': 0}]
+    """
+    if num_iter is None and num_pts_per_dim is None:
+        raise ValueError("Either num_iter or num_pts_per_dim must be specified")
+    param_grid = _color_grid_axes(num_iter, num_pts_per_dim, color_bounds)
+    names = sorted(param_grid)  # same order as ParameterGrid
+    for values in product(*(param_grid[name].tolist() for name in names)):
+        point = dict(zip(names, values))
+        yield {name: point[name] for name in param_grid}
+
+
+def stream_grid_color_search(
+    evaluation_function,
+    num_iter=None,
+    num_pts_per_dim=None,
+    color_bounds=None,
+    chunk_size=1000,
+    batch=False,
+    early_stop=None,
+    executor=None,
+    max_in_flight=None,
+    on_result=None,
+):
+    """
+    Performs a grid search while generating the grid lazily and keeping only
+    the best score so far, so that memory use doesn't depend on the grid
+    resolution. The grid is evaluated in chunks, and an early-stop criterion
+    can be checked after each chunk.
+
+    Parameters
+    ----------
+    evaluation_function : function
+        A function that takes a dictionary of RGB color components and returns
+        a score to be minimized. With ``batch=True``, it instead takes a list of
+        such dictionaries (one chunk) and returns a list of scores, e.g., to use
+        `LightMixer.run_color_experiment_batch`.
+    num_iter : int, optional
+        The approximate total number of grid points, see `iter_color_grid`.
+    num_pts_per_dim : int, optional
+        The number of grid points per color, see `iter_color_grid`.
+    color_bounds : dict, optional
+        The [lower, upper] bounds of each color, see `iter_color_grid`.
+    chunk_size : int, optional
+        The number of grid points evaluated between early-stop checks, by
+        default 1000.
+    batch : bool, optional
+        Whether `evaluation_function` evaluates a whole chunk at once, by
+        default False.
+    early_stop : function, optional
+        A function called as ``early_stop(best_score, n_evaluated)`` after each
+        chunk, which returns True to stop the search, by default None.
+    executor : str or concurrent.futures.Executor, optional
+        How to run the evaluations within a chunk, see `evaluate_unordered`, by
+        default None (serially). Ignored if ``batch=True``.
+    max_in_flight : int, optional
+        The maximum number of evaluations running at once, see
+        `evaluate_unordered`, by default None.
+    on_result : function, optional
+        A function called as ``on_result(i, params, score)`` for each evaluated
+        grid point, where i is its index in the grid order (like for
+        `grid_color_search`), e.g., to log results to disk, by default None.
+
+    Returns
+    -------
+    dict, float, int
+        The best grid point, its score, and the number of grid points that were
+        evaluated.
+
+    Examples
+    --------
+    >>> def evaluate(params):
+    ...     return abs(params['R'] - 100) + params['G'] + params['B']
+    ...
+    >>> stream_grid_color_search(
+    ...     evaluate, num_pts_per_dim=256, early_stop=lambda best, n: best == 0
+    ... )
+    ({'R': 100, 'G': 0, 'B': 0}, 0, 1000)
+    """
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be at least 1, not {chunk_size}")
+    if executor in ("thread", "process") and not batch:
+        # share one pool across all of the chunks
+        pool = ThreadPoolExecutor if executor == "thread" else ProcessPoolExecutor
+        with pool(max_workers=max_in_flight) as pool_executor:
+            return stream_grid_color_search(
+                evaluation_function,
+                num_iter=num_iter,
+                num_pts_per_dim=num_pts_per_dim,
+                color_bounds=color_bounds,
+                chunk_size=chunk_size,
+                early_stop=early_stop,
+                executor=pool_executor,
+                max_in_flight=max_in_flight,
+                on_result=on_result,
+            )
+
+    grid = iter_color_grid(num_iter, num_pts_per_dim, color_bounds)
+    best_params, best_score, n_evaluated = None, None, 0
+    while True:
+        chunk = list(islice(grid, chunk_size))
+        if not chunk:
+            break
+
+        if batch:
+            results = enumerate(evaluation_function(chunk))
+        else:
+            results = evaluate_unordered(
+                evaluation_function,
+                chunk,
+                executor=executor,
+                max_in_flight=max_in_flight,
+            )
+        for i, score in results:
+            if on_result is not None:
+                on_result(n_evaluated + i, chunk[i], score)
+            if best_score is None or score < best_score:
+                best_params, best_score = chunk[i], score
+        n_evaluated += len(chunk)
+
+        if early_stop is not None and early_stop(best_score, n_evaluated):
+            break
+
+    return best_params, best_score, n_evaluated
+
+
+def grid_color_search(
+    evaluation_function, num_iter, executor=None, max_in_flight=None, on_result=None
+):
     """
     Performs a grid search over the given parameters and evaluates each
     combination using the provided function.
@@ -17,6 +337,16 @@ def grid_color_search(evaluation_function, num_iter):
         The approximate total number of parameter combinations to evaluate. The
         actual number of combinations may be less than this number due to the
         discrete nature of the grid.
+    executor : str or concurrent.futures.Executor, optional
+        How to run the evaluations, see `evaluate_unordered`, by default None
+        (serially).
+    max_in_flight : int, optional
+        The maximum number of evaluations running at once, see
+        `evaluate_unordered`, by default None.
+    on_result : function, optional
+        A function called as ``on_result(i, params, score)`` as each evaluation
+        completes (i.e., in completion order), e.g., to log progress, by default
+        None.
 
     Returns
     -------
@@ -34,20 +364,19 @@ def grid_color_search(evaluation_function, num_iter):
     ...
     >>> parameters = {'R': [0, 255], 'G': [0, 255], 'B': [0, 255]}
     >>> grid_search(parameters, evaluate, 27)
+    >>> grid_color_search(evaluate, 27, executor="thread", max_in_flight=4)
     """
-    param_grid = {}
-    color_bounds = {"R": [0, 255], "G": [0, 255], "B": [0, 255]}
-    num_pts_per_dim = int(np.floor(num_iter ** (1 / len(color_bounds))))
-    for name, bnd in color_bounds.items():
-        param_grid[name] = np.linspace(bnd[0], bnd[1], num=num_pts_per_dim)
-        if isinstance(bnd[0], int):
-            param_grid[name] = np.round(param_grid[name]).astype(int)
+    param_grid = _color_grid_axes(num_iter)
 
     grid = list(ParameterGrid(param_grid))
 
-    grid_data = [
-        evaluation_function(dict(R=pt["R"], G=pt["G"], B=pt["B"])) for pt in grid
-    ]
+    grid_data = _evaluate_ordered(
+        evaluation_function,
+        [dict(R=pt["R"], G=pt["G"], B=pt["B"]) for pt in grid],
+        executor,
+        max_in_flight,
+        on_result,
+    )
 
     return grid, grid_data
 
@@ -83,7 +412,9 @@ def get_random_color(rng=np.random.default_rng(42), max_power=1.0):
     return dict(R=int(R), G=int(G), B=int(B))
 
 
-def random_color_search(evaluation_function, num_iter):
+def random_color_search(
+    evaluation_function, num_iter, executor=None, max_in_flight=None, on_result=None
+):
     """
     Performs a random search by generating random RGB colors and evaluating them
     using the provided function.
@@ -96,6 +427,16 @@ def random_color_search(evaluation_function, num_iter):
         'B' and values are the values for those components.
     num_iter : int
         The number of random RGB colors to generate and evaluate.
+    executor : str or concurrent.futures.Executor, optional
+        How to run the evaluations, see `evaluate_unordered`, by default None
+        (serially).
+    max_in_flight : int, optional
+        The maximum number of evaluations running at once, see
+        `evaluate_unordered`, by default None.
+    on_result : function, optional
+        A function called as ``on_result(i, params, score)`` as each evaluation
+        completes (i.e., in completion order), e.g., to log progress, by default
+        None.
 
     Returns
     -------
@@ -111,8 +452,11 @@ def random_color_search(evaluation_function, num_iter):
     ...     return params['R'] + params['G'] + params['B']
     ...
     >>> random_search(evaluate, 5)
+    >>> random_color_search(evaluate, 5, executor="process")
     """
     random_inputs = [get_random_color() for _ in range(num_iter)]
-    random_data = [evaluation_function(random_inputs[i]) for i in range(num_iter)]
+    random_data = _evaluate_ordered(
+        evaluation_function, random_inputs, executor, max_in_flight, on_result
+    )
 
     return random_inputs, random_data
@@ -0,0 +1,4 @@
+from database._database import (
+    Database,
+    get_database,
+)
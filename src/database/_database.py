@@ -0,0 +1,168 @@
+import os
+import threading
+
+from pymongo.mongo_client import MongoClient
+
+# HACK: hardcoded (instead of using credentials_test.py)
+atlas_uri_key = "ATLAS_URI"  # HACK: hardcoded
+database_name_key = "DATABASE_NAME"  # HACK: hardcoded
+
+
+class Database:
+    """
+    A MongoDB database handle whose client is created on first use and then
+    reused, so that a campaign pays for the DNS (SRV) lookup and the TLS
+    handshakes of connecting to Atlas once rather than per query. The client
+    keeps a pool of up to `max_pool_size` connections, which concurrent
+    queries (e.g., evaluation cache lookups from several threads) share.
+
+    Parameters
+    ----------
+    uri : str
+        The MongoDB connection string, e.g., the Atlas URI.
+    name : str
+        The name of the database.
+    max_pool_size : int, optional
+        The maximum number of connections to keep open, by default 10.
+    min_pool_size : int, optional
+        The number of connections to keep open even when idle, by default 0.
+    max_idle_time : float, optional
+        The number of seconds after which an idle connection is closed, by
+        default None (never).
+    connect_timeout : float, optional
+        The number of seconds to wait for a new connection, by default 10.
+    server_selection_timeout : float, optional
+        The number of seconds to wait for a server to send a query to (e.g.,
+        while the cluster is unreachable) before raising, by default 10.
+    socket_timeout : float, optional
+        The number of seconds to wait for a reply to a query, by default None
+        (no limit).
+    **client_kwargs
+        Further keyword arguments for `pymongo.mongo_client.MongoClient`.
+
+    Examples
+    --------
+    >>> database = Database(atlas_uri, "test-db", max_pool_size=4)
+    >>> database["test-collection"].count_documents({"session_id": "d4e5f6"})
+    20
+    >>> database.close()
+    """
+
+    def __init__(
+        self,
+        uri,
+        name,
+        max_pool_size=10,
+        min_pool_size=0,
+        max_idle_time=None,
+        connect_timeout=10,
+        server_selection_timeout=10,
+        socket_timeout=None,
+        **client_kwargs,
+    ):
+        self.uri = uri
+        self.name = name
+        self.client_kwargs = {
+            "maxPoolSize": max_pool_size,
+            "minPoolSize": min_pool_size,
+            "maxIdleTimeMS": _to_ms(max_idle_time),
+            "connectTimeoutMS": _to_ms(connect_timeout),
+            "serverSelectionTimeoutMS": _to_ms(server_selection_timeout),
+            "socketTimeoutMS": _to_ms(socket_timeout),
+            **client_kwargs,
+        }
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getitem__(self, collection_name):
+        """Return a collection of the database."""
+        return self.db[collection_name]
+
+    @property
+    def client(self):
+        """The MongoClient, created on first use."""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = MongoClient(self.uri, **self.client_kwargs)
+        return self._client
+
+    @property
+    def db(self):
+        """The pymongo database."""
+        return self.client[self.name]
+
+    @property
+    def connected(self):
+        """Whether the client has been created (and not closed)."""
+        return self._client is not None
+
+    def ping(self):
+        """
+        Ping the server, which also opens a connection ahead of the first query.
+
+        Raises
+        ------
+        pymongo.errors.PyMongoError
+            If the server can't be reached.
+        """
+        self.client.admin.command("ping")
+
+    def close(self):
+        """Close the client and its connections. It's recreated on next use."""
+        with self._lock:
+            client, self._client = self._client, None
+        if client is not None:
+            client.close()
+
+
+def _to_ms(seconds):
+    return None if seconds is None else int(seconds * 1000)
+
+
+_databases = {}  # (uri, name) -> Database
+_databases_lock = threading.Lock()
+
+
+def get_database(uri=None, name=None, **kwargs):
+    """
+    Return the shared `Database` handle for a database, creating it on the
+    first call, so that everything in a process that talks to the database
+    shares one client and its connection pool.
+
+    Parameters
+    ----------
+    uri : str, optional
+        The MongoDB connection string, by default the ATLAS_URI environment
+        variable.
+    name : str, optional
+        The name of the database, by default the DATABASE_NAME environment
+        variable.
+    **kwargs
+        The pool and timeout settings (see `Database`). They only apply when
+        the handle is created by this call.
+
+    Returns
+    -------
+    Database
+        The shared handle (its client is created on first use).
+
+    Examples
+    --------
+    >>> collection = get_database()["test-collection"]
+    >>> get_database() is get_database()
+    True
+    """
+    uri = os.environ[atlas_uri_key] if uri is None else uri
+    name = os.environ[database_name_key] if name is None else name
+    with _databases_lock:
+        database = _databases.get((uri, name))
+        if database is None:
+            database = _databases[(uri, name)] = Database(uri, name, **kwargs)
+    return database
@@ -0,0 +1,4 @@
+from evaluation_cache._evaluation_cache import (
+    EvaluationCache,
+    MongoEvaluationCache,
+)
@@ -0,0 +1,246 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from itertools import count, product
+from time import time
+
+from bson import ObjectId
+
+COLOR_KEYS = ("R", "G", "B")
+
+
+class EvaluationCache:
+    """
+    A local cache of experiment results, keyed on the RGB command.
+
+    A lookup reuses results whose command is within `tolerance` of the
+    requested command in each of R, G, and B (the same as
+    `MongoEvaluationCache`). Until at least `replicates` such results exist,
+    lookups miss so that the command is measured again, and afterwards lookups
+    cycle through the newest `replicates` of them instead of running the
+    experiment. Results are stored in bins of width `tolerance`, so a lookup
+    only searches the bin of the command and its neighbors. Bins are evicted
+    when they haven't been used recently (more than `max_entries` bins), and
+    individual results are dropped once they are older than `max_age` so that
+    sensor drift doesn't leave stale results around.
+
+    Parameters
+    ----------
+    tolerance : int or float, optional
+        The maximum difference per color channel for results to be reused. With
+        0, only identical commands share results. By default 0.
+    replicates : int, optional
+        The number of measurements to collect before reusing them. With 0,
+        results are never reused (always re-measure). By default 1.
+    max_entries : int, optional
+        The maximum number of bins to keep, least recently used are evicted
+        first, by default 10000.
+    max_age : float, optional
+        The number of seconds after which a result is no longer reused, by
+        default None (no limit).
+
+    Examples
+    --------
+    >>> cache = EvaluationCache(tolerance=2, replicates=1)
+    >>> cache.lookup({"R": 10, "G": 20, "B": 30}) is None
+    True
+    >>> cache.add({"R": 10, "G": 20, "B": 30}, {"sensor_data": {"ch410": 1.0}})
+    >>> cache.lookup({"R": 12, "G": 19, "B": 30})
+    {'sensor_data': {'ch410': 1.0}}
+    >>> cache.lookup({"R": 13, "G": 20, "B": 30}) is None
+    True
+    """
+
+    def __init__(self, tolerance=0, replicates=1, max_entries=10000, max_age=None):
+        self.tolerance = tolerance
+        self.replicates = replicates
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        # key -> list of (time added, sequence number, command, results)
+        self._entries = OrderedDict()
+        # key -> {command: number of hits}, to cycle through replicates
+        self._n_lookups = {}
+        self._sequence = count()
+
+    def key(self, command):
+        """Return the (quantized) cache key of a command."""
+        if not self.tolerance:
+            return tuple(command[c] for c in COLOR_KEYS)
+        return tuple(int(command[c] // self.tolerance) for c in COLOR_KEYS)
+
+    def _neighbor_keys(self, key):
+        if not self.tolerance:
+            return [key]
+        return [
+            tuple(k + offset for k, offset in zip(key, offsets))
+            for offsets in product((-1, 0, 1), repeat=len(key))
+        ]
+
+    def lookup(self, command):
+        """
+        Return cached results for a command, if they may be reused.
+
+        Parameters
+        ----------
+        command : dict
+            A dictionary with 'R', 'G', and 'B' keys.
+
+        Returns
+        -------
+        dict or None
+            A copy of cached results, or None if the command should be measured.
+        """
+        if self.replicates == 0:
+            self.misses += 1
+            return None
+
+        values = tuple(command[c] for c in COLOR_KEYS)
+        oldest = None if self.max_age is None else time() - self.max_age
+        matches = []  # (key, sample)
+        for key in self._neighbor_keys(self.key(command)):
+            samples = self._entries.get(key)
+            if samples is None:
+                continue
+            if oldest is not None:
+                samples[:] = [sample for sample in samples if sample[0] >= oldest]
+            matches += [
+                (key, sample)
+                for sample in samples
+                if all(abs(a - b) <= self.tolerance for a, b in zip(sample[2], values))
+            ]
+
+        if len(matches) < self.replicates:
+            self.misses += 1
+            return None
+
+        # cycle through the newest replicates
+        matches.sort(key=lambda match: match[1][1], reverse=True)
+        matches = matches[: self.replicates]
+        for key, _ in matches:
+            self._entries.move_to_end(key)
+        n_lookups = self._n_lookups.setdefault(self.key(command), {})
+        n = n_lookups.get(values, 0)
+        n_lookups[values] = n + 1
+        self.hits += 1
+        return dict(matches[n % len(matches)][1][3])
+
+    def add(self, command, results):
+        """
+        Store the results of a measured command.
+
+        Parameters
+        ----------
+        command : dict
+            A dictionary with 'R', 'G', and 'B' keys.
+        results : dict
+            The results of the experiment for that command.
+        """
+        key = self.key(command)
+        values = tuple(command[c] for c in COLOR_KEYS)
+        samples = self._entries.setdefault(key, [])
+        samples.append((time(), next(self._sequence), values, dict(results)))
+        # keep the newest replicates of each command
+        same = [i for i, sample in enumerate(samples) if sample[2] == values]
+        for i in reversed(same[: -max(self.replicates, 1)]):
+            del samples[i]
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            evicted_key, _ = self._entries.popitem(last=False)
+            self._n_lookups.pop(evicted_key, None)
+
+
+class MongoEvaluationCache:
+    """
+    A cache of experiment results backed by the MongoDB collection that the
+    microcontroller logs its results to.
+
+    A lookup searches the collection for results whose command is within
+    `tolerance` of the requested command (in each of R, G, and B) and that are
+    no older than `max_age`. If at least `replicates` such results exist, the
+    lookups cycle through the newest `replicates` of them. Since the
+    microcontroller already logs every result, `add` doesn't write anything.
+
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection
+        The collection that experiment results are logged to.
+    tolerance : int or float, optional
+        The maximum difference per color channel for results to be reused, by
+        default 0.
+    replicates : int, optional
+        The number of measurements needed before they are reused. With 0,
+        results are never reused (always re-measure). By default 1.
+    max_age : float, optional
+        The number of seconds after which a result is no longer reused, by
+        default None (no limit).
+    query : dict, optional
+        An additional filter for the results that may be reused, e.g.,
+        ``{"session_id": session_id}``, by default None.
+
+    Examples
+    --------
+    >>> cache = MongoEvaluationCache(collection, tolerance=2, max_age=3600)
+    >>> cache.lookup({"R": 10, "G": 20, "B": 30})
+    {'command': {'R': 11, 'G': 20, 'B': 30}, 'experiment_id': '...', ...}
+    """
+
+    def __init__(self, collection, tolerance=0, replicates=1, max_age=None, query=None):
+        self.collection = collection
+        self.tolerance = tolerance
+        self.replicates = replicates
+        self.max_age = max_age
+        self.query = query or {}
+        self.hits = 0
+        self.misses = 0
+        self._n_lookups = {}
+
+    def lookup(self, command):
+        """
+        Return cached results for a command, if they may be reused.
+
+        Parameters
+        ----------
+        command : dict
+            A dictionary with 'R', 'G', and 'B' keys.
+
+        Returns
+        -------
+        dict or None
+            A results document, or None if the command should be measured.
+        """
+        if self.replicates == 0:
+            self.misses += 1
+            return None
+
+        query = {
+            f"command.{c}": {
+                "$gte": command[c] - self.tolerance,
+                "$lte": command[c] + self.tolerance,
+            }
+            for c in COLOR_KEYS
+        }
+        query["sensor_data"] = {"$exists": True}
+        if self.max_age is not None:
+            # ObjectIds start with their creation time
+            oldest = datetime.now(timezone.utc) - timedelta(seconds=self.max_age)
+            query["_id"] = {"$gte": ObjectId.from_datetime(oldest)}
+        query.update(self.query)
+
+        samples = list(
+            self.collection.find(query, {"_id": 0})
+            .sort("_id", -1)
+            .limit(self.replicates)
+        )
+        if len(samples) < self.replicates:
+            self.misses += 1
+            return None
+
+        key = tuple(command[c] for c in COLOR_KEYS)
+        n = self._n_lookups.get(key, 0)
+        self._n_lookups[key] = n + 1
+        self.hits += 1
+        return samples[n % len(samples)]
+
+    def add(self, command, results):
+        """Do nothing, the microcontroller already logs results to MongoDB."""
@@ -0,0 +1,16 @@
+"""A long-lived MQTT transport for running experiments on the devices"""
+
+from experiment_transport._experiment_transport import (
+    ExperimentTransport,
+    AsyncExperimentTransport,
+    ResponseRouter,
+    make_batch_payload,
+    unpack_results,
+    encode_results,
+    decode_results,
+    parse_results,
+    BINARY_TOPIC_SUFFIX,
+    DeviceBusyError,
+    DeviceRegistry,
+    device_topic,
+)
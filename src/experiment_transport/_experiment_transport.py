@@ -0,0 +1,1564 @@
+import asyncio
+import json
+import struct
+import threading
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from time import monotonic, sleep
+
+from paho.mqtt import client as mqtt_client
+
+
+def device_topic(course_id, name, device_id=None):
+    """
+    Return an MQTT topic of a device.
+
+    Devices with a device id use ``{course_id}/{device_id}/{name}``, so that
+    several devices can share a course id, while a device without one uses
+    the topics of a single device per course, ``{course_id}/{name}``.
+
+    Parameters
+    ----------
+    course_id : str
+        The course id.
+    name : str
+        The name of the topic, e.g., "neopixel" (commands), "as7341" (results),
+        or "status".
+    device_id : str, optional
+        The device id, or "+" for the topic filter that matches the topic of
+        every device with a device id, by default None.
+
+    Returns
+    -------
+    str
+        The topic.
+
+    Examples
+    --------
+    >>> device_topic("test", "neopixel", "pico1")
+    'test/pico1/neopixel'
+    >>> device_topic("test", "neopixel")
+    'test/neopixel'
+    """
+    if device_id is None:
+        return f"{course_id}/{name}"
+    return f"{course_id}/{device_id}/{name}"
+
+
+def _topic_list(topics):
+    """Return a topic, a list of topics, or None as a list of topics."""
+    if topics is None:
+        return []
+    if isinstance(topics, str):
+        return [topics]
+    return list(topics)
+
+
+def _subscriptions(subscribe_topics, status_topics):
+    """Return the (topic, qos) subscriptions of a transport."""
+    subscriptions = []
+    for topic in subscribe_topics:
+        subscriptions += [(topic, 2), (topic + BINARY_TOPIC_SUFFIX, 2)]
+    return subscriptions + [(topic, 1) for topic in status_topics]
+
+
+def _matches_any(topic_filters, topic):
+    """Return whether a topic matches any of the topic filters."""
+    return any(mqtt_client.topic_matches_sub(sub, topic) for sub in topic_filters)
+
+
+def make_batch_payload(payload_dicts, aggregate=False):
+    """
+    Combine payload dictionaries into one batch payload, so that a device runs
+    several experiments for a single message.
+
+    Parameters
+    ----------
+    payload_dicts : list of dict
+        The dictionaries containing the command and a unique experiment_id, all
+        with the same session_id (if any).
+    aggregate : bool, optional
+        Whether the device should publish all of the results in one message at
+        the end, rather than each as soon as it is available, by default False.
+
+    Returns
+    -------
+    dict
+        A dictionary of the form {"session_id": ..., "batch": [...],
+        "aggregate": ...}, where the items of the batch are the payload
+        dictionaries without their session_id. If all payload dictionaries
+        have the same "encoding", it is also set for the batch, which is what
+        aggregated results are published with.
+
+    Raises
+    ------
+    ValueError
+        If the payload dictionaries have different session_ids.
+
+    Examples
+    --------
+    >>> make_batch_payload([
+    ...     {"command": {"R": 255, "G": 0, "B": 0}, "experiment_id": "a1", "session_id": "s1"},
+    ...     {"command": {"R": 0, "G": 255, "B": 0}, "experiment_id": "b2", "session_id": "s1"},
+    ... ])
+    {"session_id": "s1", "batch": [{"command": {"R": 255, "G": 0, "B": 0}, "experiment_id": "a1"}, {"command": {"R": 0, "G": 255, "B": 0}, "experiment_id": "b2"}], "aggregate": False}
+    """
+    session_ids = {payload_dict.get("session_id") for payload_dict in payload_dicts}
+    if len(session_ids) > 1:
+        raise ValueError(f"A batch must have a single session_id, not {session_ids}")
+    batch = [
+        {k: v for k, v in payload_dict.items() if k != "session_id"}
+        for payload_dict in payload_dicts
+    ]
+    batch_payload = {
+        "session_id": session_ids.pop(),
+        "batch": batch,
+        "aggregate": aggregate,
+    }
+    encodings = {payload_dict.get("encoding") for payload_dict in payload_dicts}
+    if len(encodings) == 1 and None not in encodings:
+        batch_payload["encoding"] = encodings.pop()
+    return batch_payload
+
+
+def unpack_results(message):
+    """
+    Return the results dictionaries in a message, i.e., the message itself, or
+    the items of an aggregated batch (with the batch's session_id).
+
+    Parameters
+    ----------
+    message : dict
+        A message received on the sensor data topic.
+
+    Returns
+    -------
+    list of dict
+        The results dictionaries.
+    """
+    if not isinstance(message.get("batch"), list):
+        return [message]
+    session_id = message.get("session_id")
+    return [{"session_id": session_id, **results} for results in message["batch"]]
+
+
+# Compact binary results (see `encode_results`), published by devices on the
+# sensor data topic plus this suffix when a payload has "encoding": "binary"
+BINARY_TOPIC_SUFFIX = "/bin"
+BINARY_VERSION = 1
+CHANNEL_NAMES = ("ch410", "ch440", "ch470", "ch510", "ch550", "ch583", "ch620", "ch670")
+TIMING_KEYS = ("led_ms", "measure_ms", "total_ms")
+FLAG_FLOAT, FLAG_STATS, FLAG_TIMING = 1, 2, 4
+NO_ID = 255  # id length byte of a missing (None) session_id or experiment_id
+
+
+def _encode_id(value):
+    if value is None:
+        return struct.pack("<B", NO_ID)
+    encoded = str(value).encode()
+    if len(encoded) >= NO_ID:
+        raise ValueError(f"Ids are limited to {NO_ID - 1} bytes, not {value!r}")
+    return struct.pack("<B", len(encoded)) + encoded
+
+
+def _decode_id(data, offset):
+    (n,) = struct.unpack_from("<B", data, offset)
+    if n == NO_ID:
+        return None, offset + 1
+    return bytes(data[offset + 1 : offset + 1 + n]).decode(), offset + 1 + n
+
+
+def encode_results(results_dicts):
+    """
+    Encode results dictionaries in the compact binary format that devices
+    publish when a payload has ``"encoding": "binary"``.
+
+    All values are little-endian. The message starts with a header of the format
+    version (uint8) and the number of records (uint16). Each record consists of
+
+    - flags (uint8): float channels (1), sensor_stats (2), and timing (4),
+    - experiment_id and session_id, each as a length (uint8, 255 for None)
+      followed by the UTF-8 bytes,
+    - the R, G, and B command (3 x uint16),
+    - the sensor data in `CHANNEL_NAMES` order (8 x uint16 counts, or 8 x
+      float32 with the float flag),
+    - with the sensor_stats flag, n_samples (uint16) and the std, min, and max
+      per channel (24 x float32),
+    - with the timing flag, the `TIMING_KEYS` durations (3 x uint32).
+
+    Other keys of the results dictionaries aren't encoded.
+
+    Parameters
+    ----------
+    results_dicts : list of dict
+        The results dictionaries, as published in JSON.
+
+    Returns
+    -------
+    bytes
+        The encoded message.
+    """
+    parts = [struct.pack("<BH", BINARY_VERSION, len(results_dicts))]
+    for results in results_dicts:
+        sensor_data = [results["sensor_data"][name] for name in CHANNEL_NAMES]
+        stats = results.get("sensor_stats")
+        timing = results.get("timing")
+        flags = 0
+        if not all(isinstance(value, int) for value in sensor_data):
+            flags |= FLAG_FLOAT
+        if stats is not None:
+            flags |= FLAG_STATS
+        if timing is not None:
+            flags |= FLAG_TIMING
+        command = results["command"]
+        parts += [
+            struct.pack("<B", flags),
+            _encode_id(results.get("experiment_id")),
+            _encode_id(results.get("session_id")),
+            struct.pack("<3H", command["R"], command["G"], command["B"]),
+            struct.pack("<8f" if flags & FLAG_FLOAT else "<8H", *sensor_data),
+        ]
+        if stats is not None:
+            values = [
+                stats[key][name]
+                for key in ("std", "min", "max")
+                for name in CHANNEL_NAMES
+            ]
+            parts.append(struct.pack("<H24f", stats["n_samples"], *values))
+        if timing is not None:
+            parts.append(struct.pack("<3I", *(timing[key] for key in TIMING_KEYS)))
+    return b"".join(parts)
+
+
+def decode_results(data):
+    """
+    Decode a binary results message (see `encode_results`) into results
+    dictionaries of the same shape as the JSON ones.
+
+    Parameters
+    ----------
+    data : bytes
+        The encoded message.
+
+    Returns
+    -------
+    list of dict
+        The results dictionaries.
+
+    Raises
+    ------
+    ValueError
+        If the message has an unknown version or is truncated.
+
+    Examples
+    --------
+    >>> decode_results(encode_results([{"command": {"R": 1, "G": 2, "B": 3}, "experiment_id": "a1", "session_id": "s1", "sensor_data": dict.fromkeys(CHANNEL_NAMES, 7)}]))
+    [{'command': {'R': 1, 'G': 2, 'B': 3}, 'experiment_id': 'a1', 'session_id': 's1', 'sensor_data': {'ch410': 7, ..., 'ch670': 7}}]
+    """
+    try:
+        version, n_records = struct.unpack_from("<BH", data, 0)
+        if version != BINARY_VERSION:
+            raise ValueError(f"Unknown binary results version {version}")
+        offset = 3
+        results_dicts = []
+        for _ in range(n_records):
+            (flags,) = struct.unpack_from("<B", data, offset)
+            experiment_id, offset = _decode_id(data, offset + 1)
+            session_id, offset = _decode_id(data, offset)
+            R, G, B = struct.unpack_from("<3H", data, offset)
+            offset += 6
+            fmt = "<8f" if flags & FLAG_FLOAT else "<8H"
+            sensor_data = struct.unpack_from(fmt, data, offset)
+            offset += struct.calcsize(fmt)
+            results = {
+                "command": {"R": R, "G": G, "B": B},
+                "experiment_id": experiment_id,
+                "session_id": session_id,
+                "sensor_data": dict(zip(CHANNEL_NAMES, sensor_data)),
+            }
+            if flags & FLAG_STATS:
+                n_samples, *values = struct.unpack_from("<H24f", data, offset)
+                offset += struct.calcsize("<H24f")
+                results["sensor_stats"] = {
+                    key: dict(zip(CHANNEL_NAMES, values[8 * i : 8 * i + 8]))
+                    for i, key in enumerate(("std", "min", "max"))
+                }
+                results["sensor_stats"]["n_samples"] = n_samples
+            if flags & FLAG_TIMING:
+                results["timing"] = dict(
+                    zip(TIMING_KEYS, struct.unpack_from("<3I", data, offset))
+                )
+                offset += 12
+            results_dicts.append(results)
+    except struct.error as e:
+        raise ValueError(f"Truncated binary results: {e}") from e
+    return results_dicts
+
+
+def parse_results(topic, payload):
+    """
+    Parse a message received on a sensor data topic into its results
+    dictionaries, decoding binary results (on topics ending in
+    `BINARY_TOPIC_SUFFIX`) and unpacking aggregated batches.
+
+    Parameters
+    ----------
+    topic : str
+        The topic that the message was received on.
+    payload : bytes
+        The message.
+
+    Returns
+    -------
+    list of dict
+        The results dictionaries.
+
+    Raises
+    ------
+    ValueError
+        If the message can't be parsed.
+    """
+    if topic.endswith(BINARY_TOPIC_SUFFIX):
+        return decode_results(payload)
+    results = json.loads(payload)
+    if not isinstance(results, dict):
+        raise ValueError("Expected a JSON object")
+    return unpack_results(results)
+
+
+class DeviceBusyError(RuntimeError):
+    """
+    Raised for a command that a device rejected because its command queue was
+    full, i.e., when it replied with ``"status": "busy"`` instead of results.
+
+    Parameters
+    ----------
+    results : dict
+        The busy reply, with the experiment_id and session_id of the rejected
+        command and the device's "queue_depth".
+    """
+
+    def __init__(self, results):
+        self.results = results
+        super().__init__(
+            f"Device busy, experiment {results.get('experiment_id')} was rejected "
+            f"(queue depth {results.get('queue_depth')})"
+        )
+
+
+def is_busy(results):
+    """Return whether a results dictionary is a device's busy reply."""
+    return results.get("status") == "busy"
+
+
+class DeviceRegistry:
+    """
+    The latest status of each device, from the retained status documents that
+    devices publish when they connect and when their state changes, and that
+    the broker publishes on their behalf (as their last will) when they go
+    offline.
+
+    A status document has the form
+    {
+        "state": "online" | "busy" | "offline",
+        "command_topic": "...",
+        "device_id": "...",
+        "firmware": "...",
+        "experiment_ms": ...,  # average duration of an experiment
+        "queue_depth": ...,  # commands waiting on the device
+        "capacity": ...,  # commands the device takes at once (incl. running)
+        "free_ram": ...,
+    }
+    and devices are identified by their command topic.
+
+    Examples
+    --------
+    >>> registry = DeviceRegistry()
+    >>> registry.update({"state": "online", "command_topic": "test/neopixel", "experiment_ms": 640, "queue_depth": 0})
+    >>> registry.online()
+    ['test/neopixel']
+    >>> registry.estimated_wait("test/neopixel")
+    0.64
+    """
+
+    ONLINE_STATES = ("online", "busy")
+
+    def __init__(self):
+        self._devices = {}  # command topic -> (arrival time, status)
+        self._status_topics = {}  # status topic -> command topic
+        self._changed = threading.Condition()
+
+    def update(self, status, status_topic=None):
+        """Store the status document of a device."""
+        command_topic = status.get("command_topic")
+        if command_topic is None:
+            return
+        with self._changed:
+            self._devices[command_topic] = (monotonic(), status)
+            if status_topic is not None:
+                self._status_topics[status_topic] = command_topic
+            self._changed.notify_all()
+
+    def handle_message(self, topic, payload):
+        """
+        Update the registry from a message on a status topic. An empty
+        (retained) message removes the device.
+        """
+        if not payload:
+            with self._changed:
+                self._devices.pop(self._status_topics.pop(topic, None), None)
+                self._changed.notify_all()
+            return
+        try:
+            status = json.loads(payload)
+        except ValueError:
+            print(f"Ignoring unexpected status on topic {topic}: {payload}")
+            return
+        if isinstance(status, dict):
+            self.update(status, status_topic=topic)
+
+    def get(self, command_topic):
+        """Return the latest status document of a device, or None."""
+        entry = self._devices.get(command_topic)
+        return None if entry is None else entry[1]
+
+    def age(self, command_topic):
+        """Return the number of seconds since the device's status arrived."""
+        entry = self._devices.get(command_topic)
+        return None if entry is None else monotonic() - entry[0]
+
+    def is_online(self, command_topic):
+        """Return whether a device is known to be online (idle or busy)."""
+        status = self.get(command_topic)
+        return status is not None and status.get("state") in self.ONLINE_STATES
+
+    def is_offline(self, command_topic):
+        """Return whether a device is known to be offline."""
+        status = self.get(command_topic)
+        return status is not None and status.get("state") not in self.ONLINE_STATES
+
+    def online(self):
+        """Return the command topics of the devices that are online."""
+        return [topic for topic in list(self._devices) if self.is_online(topic)]
+
+    def capacity(self, command_topic):
+        """
+        Return the number of commands that a device takes at once (queued and
+        running), or None if that's unknown.
+        """
+        status = self.get(command_topic)
+        return None if status is None else status.get("capacity")
+
+    def estimated_wait(self, command_topic):
+        """
+        Return the estimated number of seconds until a new command would be
+        done on a device (queued commands plus the new one, at the device's
+        average experiment duration), or None if that's unknown.
+        """
+        status = self.get(command_topic)
+        if status is None or status.get("experiment_ms") is None:
+            return None
+        n_commands = (status.get("queue_depth") or 0) + 1
+        return n_commands * status["experiment_ms"] / 1000
+
+    def wait_online(self, command_topic=None, timeout=None):
+        """
+        Wait until a device is online.
+
+        Parameters
+        ----------
+        command_topic : str, optional
+            The command topic of the device, by default None (any device).
+        timeout : float, optional
+            The maximum number of seconds to wait, by default None (no limit).
+
+        Returns
+        -------
+        bool
+            Whether the device (or any device) is online.
+        """
+        if command_topic is None:
+            predicate = lambda: bool(self.online())  # noqa: E731
+        else:
+            predicate = lambda: self.is_online(command_topic)  # noqa: E731
+        with self._changed:
+            return self._changed.wait_for(predicate, timeout=timeout)
+
+
+class ResponseRouter:
+    """
+    Hands incoming results to whoever is waiting for them.
+
+    Results are matched to waiters on ``(session_id, experiment_id)`` with a
+    dictionary lookup rather than by scanning a queue. Results that nobody is
+    waiting for are buffered instead of dropped: a reply that arrives before
+    its waiter is registered is picked up on registration, and a reply that
+    arrives after its waiter gave up is picked up if the same payload is
+    registered again, without re-running the experiment. Buffered results are
+    evicted after `ttl` seconds, oldest first, and the buffer never holds more
+    than `max_buffered` results. Results of payloads that were cancelled with
+    ``discard=True`` are dropped instead of buffered for `ttl` seconds.
+
+    Parameters
+    ----------
+    ttl : float, optional
+        The number of seconds to keep results that nobody is waiting for, by
+        default 300.
+    max_buffered : int, optional
+        The maximum number of results to keep that nobody is waiting for, by
+        default 1000.
+
+    Examples
+    --------
+    >>> router = ResponseRouter()
+    >>> router.expect({"experiment_id": "a1", "session_id": "s1"}, "waiter")
+    >>> router.dispatch({"experiment_id": "a1", "session_id": "s1", "sensor_data": {}})
+    'waiter'
+    """
+
+    def __init__(self, ttl=300, max_buffered=1000):
+        self.ttl = ttl
+        self.max_buffered = max_buffered
+        self.evictions = 0
+        self._waiters = {}  # key -> waiter
+        self._buffered = OrderedDict()  # key -> (arrival time, results), oldest first
+        self._discarded = OrderedDict()  # key -> time of cancellation, oldest first
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(message):
+        """Return the ``(session_id, experiment_id)`` key of a payload or result."""
+        return message.get("session_id"), message.get("experiment_id")
+
+    def _evict(self, now):
+        while self._buffered:
+            key, (arrival_time, _) = next(iter(self._buffered.items()))
+            if (
+                now - arrival_time <= self.ttl
+                and len(self._buffered) <= self.max_buffered
+            ):
+                break
+            del self._buffered[key]
+            self.evictions += 1
+        while self._discarded:
+            key, cancel_time = next(iter(self._discarded.items()))
+            if now - cancel_time <= self.ttl:
+                break
+            del self._discarded[key]
+
+    def expect(self, payload_dict, waiter):
+        """
+        Register a waiter for the results of a payload.
+
+        Parameters
+        ----------
+        payload_dict : dict
+            The payload dictionary that was (or will be) sent to the device.
+        waiter : object
+            Anything that identifies the waiter, e.g., a future. It is returned
+            by `dispatch` when the results arrive.
+
+        Returns
+        -------
+        dict or None
+            The results if they had already arrived, in which case the waiter is
+            not registered, otherwise None.
+        """
+        key = self.key(payload_dict)
+        with self._lock:
+            self._evict(monotonic())
+            buffered = self._buffered.pop(key, None)
+            if buffered is not None:
+                return buffered[1]
+            self._waiters[key] = waiter
+        return None
+
+    def dispatch(self, results, buffer=True):
+        """
+        Route incoming results to their waiter, or buffer them if there is none.
+
+        Parameters
+        ----------
+        results : dict
+            The results dictionary received from a device.
+        buffer : bool, optional
+            Whether to buffer the results if nobody is waiting for them, by
+            default True. Replies that aren't results (e.g., busy replies)
+            shouldn't be handed to a later waiter.
+
+        Returns
+        -------
+        object or None
+            The waiter registered for these results (which is unregistered), or
+            None if the results were buffered (or dropped).
+        """
+        key = self.key(results)
+        with self._lock:
+            waiter = self._waiters.pop(key, None)
+            if waiter is None and buffer and key not in self._discarded:
+                now = monotonic()
+                self._buffered[key] = (now, results)
+                self._buffered.move_to_end(key)
+                self._evict(now)
+        return waiter
+
+    def cancel(self, payload_dict, discard=False):
+        """
+        Unregister the waiter for a payload, e.g., after it timed out.
+
+        Parameters
+        ----------
+        payload_dict : dict
+            The payload dictionary that the waiter was registered for.
+        discard : bool, optional
+            Whether to also drop its results, now and if they arrive within
+            `ttl` seconds, e.g., when the experiment was sent again under a
+            new experiment_id, by default False.
+        """
+        key = self.key(payload_dict)
+        with self._lock:
+            self._waiters.pop(key, None)
+            if discard:
+                self._buffered.pop(key, None)
+                now = monotonic()
+                self._discarded[key] = now
+                self._discarded.move_to_end(key)
+                self._evict(now)
+
+    def pop_waiters(self):
+        """
+        Unregister all waiters, e.g., when the connection is lost.
+
+        Returns
+        -------
+        list
+            The waiters that were registered.
+        """
+        with self._lock:
+            waiters = list(self._waiters.values())
+            self._waiters.clear()
+        return waiters
+
+    def is_discarded(self, message):
+        """Return whether the results of a payload are dropped (see `cancel`)."""
+        return self.key(message) in self._discarded
+
+    @property
+    def n_waiting(self):
+        """The number of registered waiters."""
+        return len(self._waiters)
+
+    @property
+    def n_buffered(self):
+        """The number of buffered results that nobody is waiting for yet."""
+        return len(self._buffered)
+
+
+class ExperimentTransport:
+    """
+    A long-lived MQTT connection for sending commands to devices and receiving
+    their results.
+
+    The Paho network loop is started once and runs until `close` is called, so
+    experiments don't pay for a network thread per request and no incoming
+    message waits on the next experiment to be read. Each outgoing payload gets
+    a future that is resolved by the message with the same `session_id` and
+    `experiment_id` (see `ResponseRouter`), which lets many concurrent
+    experiments share one connection.
+
+    Parameters
+    ----------
+    subscribe_topic : str or list of str
+        The MQTT topic (or topics, or topic filters, e.g., "test/+/as7341")
+        that results are published to. Binary results (see `encode_results`)
+        are received on these topics plus `BINARY_TOPIC_SUFFIX`.
+    host : str
+        The hostname or IP address of the MQTT server to connect to.
+    username : str
+        The username to use for MQTT authentication.
+    password : str, optional
+        The password to use for MQTT authentication, by default None.
+    port : int, optional
+        The port number to connect to at the MQTT server, by default 8883.
+    tls : bool, optional
+        Whether to use TLS for the connection, by default True.
+    connect_timeout : float, optional
+        The number of seconds to wait for the connection to be established, by
+        default 10.
+    response_ttl : float, optional
+        The number of seconds to keep results that nobody is waiting for, by
+        default 300.
+    max_buffered : int, optional
+        The maximum number of results to keep that nobody is waiting for, by
+        default 1000.
+    status_topic : str or list of str, optional
+        The MQTT topic (or topics, or topic filters, e.g., "test/+/status")
+        that devices publish their status to, which is then kept in
+        ``devices`` (see `DeviceRegistry`), by default None.
+
+    Examples
+    --------
+    >>> transport = ExperimentTransport("test/as7341", "mqtt.example.com", "username", "password")
+    >>> transport.run_experiment("test/neopixel", {"command": {"R": 255, "G": 0, "B": 0}, "experiment_id": "a1b2"})
+    {"command": {"R": 255, "G": 0, "B": 0}, "experiment_id": "a1b2", "sensor_data": {<sensor_data>}}
+    >>> transport.close()
+    """
+
+    def __init__(
+        self,
+        subscribe_topic,
+        host,
+        username,
+        password=None,
+        port=8883,
+        tls=True,
+        connect_timeout=10,
+        response_ttl=300,
+        max_buffered=1000,
+        status_topic=None,
+    ):
+        self.subscribe_topic = subscribe_topic
+        self.status_topic = status_topic
+        self._subscribe_topics = _topic_list(subscribe_topic)
+        self._status_topics = _topic_list(status_topic)
+        self.router = ResponseRouter(ttl=response_ttl, max_buffered=max_buffered)
+        self.devices = DeviceRegistry()
+        self._connected_event = threading.Event()
+
+        client = mqtt_client.Client()
+        client.on_connect = self._on_connect
+        client.on_message = self._on_message
+        if tls:
+            client.tls_set(tls_version=mqtt_client.ssl.PROTOCOL_TLS_CLIENT)
+        client.username_pw_set(username, password)
+        client.connect(host, port)
+        client.loop_start()  # runs until close()
+
+        if not self._connected_event.wait(timeout=connect_timeout):
+            client.loop_stop()
+            raise TimeoutError(
+                f"Could not connect to {host}:{port} within {connect_timeout} s"
+            )
+
+        self.client = client
+
+    def _on_connect(self, client, userdata, flags, rc):
+        # (re)subscribe on every (re)connect
+        client.subscribe(_subscriptions(self._subscribe_topics, self._status_topics))
+        self._connected_event.set()
+
+    def _on_message(self, client, userdata, msg):
+        if _matches_any(self._status_topics, msg.topic):
+            self.devices.handle_message(msg.topic, msg.payload)
+            return
+
+        try:
+            results_dicts = parse_results(msg.topic, msg.payload)
+        except ValueError as e:
+            print(
+                f"Ignoring unexpected message on topic {msg.topic} ({e}): {msg.payload}"
+            )
+            return
+
+        for results in results_dicts:
+            busy = is_busy(results)
+            future = self.router.dispatch(results, buffer=not busy)
+            if future is None:
+                # busy replies nobody waits for are dropped, and so are the
+                # results of abandoned attempts
+                if not busy and not self.router.is_discarded(results):
+                    print(
+                        f"Buffering unclaimed results on topic {msg.topic}: {results}"
+                    )
+                continue
+            if busy:
+                future.set_exception(DeviceBusyError(results))
+            else:
+                future.set_result(results)
+
+    def submit(self, command_topic, payload_dict):
+        """
+        Publish a command and return a future for its results.
+
+        Parameters
+        ----------
+        command_topic : str
+            The MQTT topic to publish the command to.
+        payload_dict : dict
+            The dictionary containing the command and a unique experiment_id.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            A future that is resolved with the results dictionary once a message
+            with the same session_id and experiment_id arrives. If such a
+            message has already arrived (e.g., a late reply to an earlier
+            attempt), the future is resolved right away and nothing is published.
+        """
+        future = Future()
+        buffered = self.router.expect(payload_dict, future)
+        if buffered is not None:
+            future.set_result(buffered)
+            return future
+        self.client.publish(command_topic, json.dumps(payload_dict), qos=2)
+        return future
+
+    def submit_batch(self, command_topic, payload_dicts, aggregate=False):
+        """
+        Publish several commands as one batch payload (see `make_batch_payload`)
+        and return a future for the results of each.
+
+        Parameters
+        ----------
+        command_topic : str
+            The MQTT topic to publish the batch to.
+        payload_dicts : list of dict
+            The dictionaries containing the command and a unique experiment_id.
+        aggregate : bool, optional
+            Whether the device publishes all of the results in one message, by
+            default False.
+
+        Returns
+        -------
+        list of concurrent.futures.Future
+            A future per payload dictionary, see `submit`. Commands whose results
+            have already arrived are left out of the published batch.
+        """
+        futures, pending = [], []
+        for payload_dict in payload_dicts:
+            future = Future()
+            buffered = self.router.expect(payload_dict, future)
+            if buffered is not None:
+                future.set_result(buffered)
+            else:
+                pending.append(payload_dict)
+            futures.append(future)
+        if pending:
+            batch_payload = make_batch_payload(pending, aggregate=aggregate)
+            self.client.publish(command_topic, json.dumps(batch_payload), qos=2)
+        return futures
+
+    def run_experiment_batch(
+        self, command_topic, payload_dicts, timeout=300, aggregate=False
+    ):
+        """
+        Publish several commands as one batch payload and wait for all of their
+        results.
+
+        Parameters
+        ----------
+        command_topic : str
+            The MQTT topic to publish the batch to.
+        payload_dicts : list of dict
+            The dictionaries containing the command and a unique experiment_id.
+        timeout : float, optional
+            The number of seconds to wait for all of the results, by default
+            300.
+        aggregate : bool, optional
+            Whether the device publishes all of the results in one message, by
+            default False.
+
+        Returns
+        -------
+        list of dict
+            The results of the experiments, in the order of payload_dicts.
+
+        Raises
+        ------
+        TimeoutError
+            If not all results arrive within the specified timeout.
+        """
+        futures = self.submit_batch(command_topic, payload_dicts, aggregate=aggregate)
+        deadline = monotonic() + timeout
+        try:
+            return [
+                future.result(timeout=max(deadline - monotonic(), 0))
+                for future in futures
+            ]
+        except FutureTimeoutError as e:
+            n_outstanding = sum(not future.done() for future in futures)
+            raise TimeoutError(
+                f"Timed out with {n_outstanding} experiment(s) outstanding "
+                f"({timeout} seconds)"
+            ) from e
+        finally:
+            for payload_dict in payload_dicts:
+                self.router.cancel(payload_dict)
+
+    def run_experiment(self, command_topic, payload_dict, timeout=30, busy_delay=1):
+        """
+        Publish a command and wait for its results.
+
+        If the device replies that it is busy (see `DeviceBusyError`), the
+        command is published again after `busy_delay` seconds.
+
+        Parameters
+        ----------
+        command_topic : str
+            The MQTT topic to publish the command to.
+        payload_dict : dict
+            The dictionary containing the command and a unique experiment_id.
+        timeout : float, optional
+            The number of seconds to wait for the results, by default 30.
+        busy_delay : float, optional
+            The number of seconds to wait before retrying a command that the
+            device rejected as busy, by default 1.
+
+        Returns
+        -------
+        dict
+            The results of the experiment, as a dictionary.
+
+        Raises
+        ------
+        TimeoutError
+            If the results don't arrive within the specified timeout.
+        """
+        deadline = monotonic() + timeout
+        while True:
+            future = self.submit(command_topic, payload_dict)
+            try:
+                return future.result(timeout=max(deadline - monotonic(), 0))
+            except DeviceBusyError as e:
+                if monotonic() + busy_delay >= deadline:
+                    raise TimeoutError(
+                        f"Device still busy after {timeout} seconds"
+                    ) from e
+                sleep(busy_delay)
+            except FutureTimeoutError as e:
+                self.router.cancel(payload_dict)
+                raise TimeoutError(
+                    f"Sensor data retrieval timed out ({timeout} seconds)"
+                ) from e
+
+    def run_experiments(
+        self,
+        command_topics,
+        payload_dicts,
+        timeout=300,
+        batch=False,
+        busy_delay=1,
+        max_in_flight=None,
+        device_timeout=60,
+    ):
+        """
+        Publish several commands at once, spread over the devices, and yield the
+        results in the order that they arrive.
+
+        Each command goes to the least-loaded device that can take it, i.e., the
+        one that would be done soonest with the commands it already has plus
+        this one at the average experiment duration that it advertises (see
+        `DeviceRegistry`), as long as it has fewer than `max_in_flight`
+        commands outstanding. Explicitly given command topics are used whatever
+        their (possibly stale) status says.
+
+        Commands that a device rejects as busy (see `DeviceBusyError`) go back
+        in line, that device gets no more commands for `busy_delay` seconds or
+        until one of its experiments completes, and its limit is lowered to the
+        number of commands it still has. Commands without results after
+        `device_timeout` seconds are reassigned, to another device if there is
+        one, and the device that didn't complete them gets no more commands for
+        `device_timeout` seconds (or until one of its experiments completes).
+        A reassigned command gets a new experiment_id (the original one plus
+        "-retry<n>", with the original in "retry_of") and replaces its payload
+        dictionary in payload_dicts, so that no experiment_id is run twice, and
+        late results of the abandoned attempt are dropped.
+
+        With ``batch=True``, the commands are instead spread round-robin over
+        the devices and published as one batch payload per device (see
+        `submit_batch`), which saves a broker round trip per command, but needs
+        a device that supports batch payloads. Rejected and timed out commands
+        are published again one at a time. As a device runs its batch in
+        order, the `device_timeout` of a command in it counts from when the
+        device should get to it: the time the batch was published plus the
+        advertised experiment duration for each command before it, or the
+        arrival of the previous results of the batch, whichever is later.
+
+        Parameters
+        ----------
+        command_topics : list of str or None
+            The MQTT topics to publish the commands to, one per device. With
+            None, the command topics of the devices that are online (see
+            `DeviceRegistry`), including ones that come online in the meantime.
+        payload_dicts : list of dict
+            The dictionaries containing the command and a unique experiment_id.
+            Reassigned commands are replaced with their retry (see above).
+        timeout : float, optional
+            The number of seconds to wait for all of the results, by default
+            300.
+        batch : bool, optional
+            Whether to publish one batch payload per topic, by default False.
+        busy_delay : float, optional
+            The number of seconds that a device which rejected a command as busy
+            gets no commands, unless one of its experiments completes, by
+            default 1.
+        max_in_flight : int, optional
+            The maximum number of commands per device that are waiting for
+            results, by default None (the capacity that the device advertises,
+            or no limit if it doesn't).
+        device_timeout : float, optional
+            The number of seconds after which a command without results is
+            reassigned, by default 60. With None, commands aren't reassigned.
+
+        Yields
+        ------
+        int, dict
+            The index of the payload dictionary in payload_dicts and the results
+            of the corresponding experiment, as a dictionary.
+
+        Raises
+        ------
+        TimeoutError
+            If not all results arrive within the specified timeout.
+        ValueError
+            If ``batch=True`` and there are no devices to publish to.
+        """
+        queue = deque(range(len(payload_dicts)))  # indices of unassigned commands
+        pending = {}  # future -> (index, command topic, time started)
+        batched = set()  # futures of commands that were published in a batch
+        in_flight = defaultdict(int)  # command topic -> commands outstanding
+        limits = {}  # command topic -> limit lowered after busy replies
+        held_until = defaultdict(float)  # command topic -> no commands before
+        n_retries = defaultdict(int)  # index -> number of reassignments
+        original_ids = [
+            payload_dict.get("experiment_id") for payload_dict in payload_dicts
+        ]
+
+        def devices():
+            if command_topics is None:
+                return self.devices.online()
+            return command_topics
+
+        def limit(topic):
+            n = self.devices.capacity(topic) if max_in_flight is None else max_in_flight
+            n = limits.get(topic, n)
+            return float("inf") if n is None else n
+
+        def experiment_time(topic):
+            # the average experiment duration that the device advertises, in s
+            status = self.devices.get(topic) or {}
+            return (status.get("experiment_ms") or 1000) / 1000
+
+        def load(topic):
+            # when the device would be done with its commands plus one more
+            return (in_flight[topic] + 1) * experiment_time(topic)
+
+        if batch:
+            topics = devices()
+            if not topics:
+                raise ValueError("No devices to publish the commands to")
+            now = monotonic()
+            for j, topic in enumerate(topics):
+                indices = range(j, len(payload_dicts), len(topics))
+                futures = self.submit_batch(topic, [payload_dicts[i] for i in indices])
+                # the device gets to the k-th command after running k others
+                duration = experiment_time(topic)
+                pending.update(
+                    (f, (i, topic, now + k * duration))
+                    for k, (f, i) in enumerate(zip(futures, indices))
+                )
+                batched.update(futures)
+                in_flight[topic] += len(indices)
+            queue.clear()
+
+        deadline = monotonic() + timeout
+        try:
+            while queue or pending:
+                now = monotonic()
+                if device_timeout is not None:
+                    for future, (i, topic, start_time) in list(pending.items()):
+                        if now - start_time < device_timeout:
+                            continue
+                        n_retries[i] += 1
+                        retry = dict(
+                            payload_dicts[i],
+                            experiment_id=f"{original_ids[i]}-retry{n_retries[i]}",
+                            retry_of=original_ids[i],
+                        )
+                        print(
+                            f"No results from {topic} after {device_timeout} s, "
+                            f"reassigning experiment {payload_dicts[i].get('experiment_id')} "
+                            f"as {retry['experiment_id']}"
+                        )
+                        del pending[future]
+                        in_flight[topic] -= 1
+                        held_until[topic] = now + device_timeout
+                        self.router.cancel(payload_dicts[i], discard=True)
+                        payload_dicts[i] = retry
+                        queue.appendleft(i)
+
+                topics = devices() if queue else []
+                while queue:
+                    available = [
+                        topic
+                        for topic in topics
+                        if held_until[topic] <= now and in_flight[topic] < limit(topic)
+                    ]
+                    if not available:
+                        break
+                    topic = min(available, key=load)
+                    i = queue.popleft()
+                    pending[self.submit(topic, payload_dicts[i])] = (i, topic, now)
+                    in_flight[topic] += 1
+
+                if now >= deadline:
+                    raise TimeoutError(
+                        f"Timed out with {len(pending) + len(queue)} "
+                        f"experiment(s) outstanding ({timeout} seconds)"
+                    )
+
+                # wake up for the next reassignment, and to check for devices
+                # that can take the commands in line
+                wake_time = deadline
+                if pending and device_timeout is not None:
+                    first_start_time = min(t for _, _, t in pending.values())
+                    wake_time = min(wake_time, first_start_time + device_timeout)
+                if queue:
+                    wake_time = min(wake_time, now + busy_delay)
+                if not pending:
+                    sleep(max(wake_time - now, 0))
+                    continue
+                done, _ = wait(
+                    pending,
+                    timeout=max(wake_time - now, 0),
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in done:
+                    i, topic, _ = pending.pop(future)
+                    in_flight[topic] -= 1
+                    try:
+                        results = future.result()
+                    except DeviceBusyError:
+                        held_until[topic] = monotonic() + busy_delay
+                        limits[topic] = max(in_flight[topic], 1)
+                        queue.appendleft(i)
+                        continue
+                    held_until[topic] = 0
+                    # the rest of its batch can't have started before now
+                    now = monotonic()
+                    for other, (j, other_topic, start_time) in list(pending.items()):
+                        if other in batched and other_topic == topic:
+                            pending[other] = (j, topic, max(start_time, now))
+                    yield i, results
+        finally:
+            for payload_dict in payload_dicts:
+                self.router.cancel(payload_dict)
+
+    def close(self):
+        """Stop the network loop and disconnect from the broker."""
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+RECONNECT_MIN_DELAY = 1  # seconds before the first reconnection attempt
+RECONNECT_MAX_DELAY = 60  # seconds between reconnection attempts, at most
+_MISC_INTERVAL = 1  # seconds between keepalive checks of the async transport
+
+
+class AsyncExperimentTransport:
+    """
+    An asyncio version of `ExperimentTransport`.
+
+    Instead of running a network thread, the Paho socket is driven from the
+    event loop: the socket is registered with `loop.add_reader` (and with
+    `loop.add_writer` while Paho has data to send), and a small task takes care
+    of keepalive pings. Waiting for results doesn't need a thread either, so
+    one process can have many experiments outstanding on many devices.
+
+    When the connection is lost, the experiments that are waiting for results
+    fail right away with a ConnectionError (their results would be lost with
+    the session), and the same task reconnects, waiting `RECONNECT_MIN_DELAY`
+    seconds at first and twice as long after each failed attempt, up to
+    `RECONNECT_MAX_DELAY` seconds.
+
+    Parameters
+    ----------
+    subscribe_topic : str or list of str
+        The MQTT topic (or topics, or topic filters, e.g., "test/+/as7341")
+        that results are published to. Binary results (see `encode_results`)
+        are received on these topics plus `BINARY_TOPIC_SUFFIX`.
+    host : str
+        The hostname or IP address of the MQTT server to connect to.
+    username : str
+        The username to use for MQTT authentication.
+    password : str, optional
+        The password to use for MQTT authentication, by default None.
+    port : int, optional
+        The port number to connect to at the MQTT server, by default 8883.
+    tls : bool, optional
+        Whether to use TLS for the connection, by default True.
+    response_ttl : float, optional
+        The number of seconds to keep results that nobody is waiting for, by
+        default 300.
+    max_buffered : int, optional
+        The maximum number of results to keep that nobody is waiting for, by
+        default 1000.
+    status_topic : str or list of str, optional
+        The MQTT topic (or topics, or topic filters, e.g., "test/+/status")
+        that devices publish their status to, which is then kept in
+        ``devices`` (see `DeviceRegistry`), by default None.
+
+    Examples
+    --------
+    >>> async def main():
+    ...     async with AsyncExperimentTransport("test/as7341", "mqtt.example.com", "username", "password") as transport:
+    ...         payload_dicts = [
+    ...             {"command": {"R": 255, "G": 0, "B": 0}, "experiment_id": "a1"},
+    ...             {"command": {"R": 0, "G": 255, "B": 0}, "experiment_id": "b2"},
+    ...         ]
+    ...         return await asyncio.gather(
+    ...             *[transport.run_experiment("test/neopixel", p) for p in payload_dicts]
+    ...         )
+    >>> asyncio.run(main())
+    """
+
+    def __init__(
+        self,
+        subscribe_topic,
+        host,
+        username,
+        password=None,
+        port=8883,
+        tls=True,
+        response_ttl=300,
+        max_buffered=1000,
+        status_topic=None,
+    ):
+        self.subscribe_topic = subscribe_topic
+        self.status_topic = status_topic
+        self._subscribe_topics = _topic_list(subscribe_topic)
+        self._status_topics = _topic_list(status_topic)
+        self.host = host
+        self.port = port
+        self.router = ResponseRouter(ttl=response_ttl, max_buffered=max_buffered)
+        self.devices = DeviceRegistry()
+        self._loop = None
+        self._connected = None
+        self._closed = None
+        self._misc_task = None
+
+        client = mqtt_client.Client()
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_message = self._on_message
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+        if tls:
+            client.tls_set(tls_version=mqtt_client.ssl.PROTOCOL_TLS_CLIENT)
+        client.username_pw_set(username, password)
+        self.client = client
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # Socket callbacks: bridge the Paho socket to the event loop
+
+    def _on_socket_open(self, client, userdata, sock):
+        # also called by client.reconnect() with the new socket
+        self._loop.add_reader(sock, self._on_readable)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._loop.remove_reader(sock)
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(None)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._loop.remove_writer(sock)
+
+    def _on_readable(self):
+        self.client.loop_read()
+        # TLS can hold decrypted bytes that won't make the socket readable again
+        sock = self.client.socket()
+        while sock is not None and getattr(sock, "pending", lambda: 0)():
+            self.client.loop_read()
+            sock = self.client.socket()
+
+    async def _misc_loop(self):
+        # keepalive pings and retries, and reconnecting once the connection is
+        # lost (which closes the socket, see _on_socket_close)
+        delay = RECONNECT_MIN_DELAY
+        while True:
+            if self.client.loop_misc() == mqtt_client.MQTT_ERR_SUCCESS:
+                await asyncio.sleep(_MISC_INTERVAL)
+                continue
+            await asyncio.sleep(delay)
+            try:
+                # NOTE: blocks for the TCP/TLS handshake, like connect
+                self.client.reconnect()
+            except OSError as e:
+                delay = min(2 * delay, RECONNECT_MAX_DELAY)
+                print(
+                    f"Could not reconnect to {self.host}:{self.port} ({e}), "
+                    f"retrying in {delay} s"
+                )
+            else:
+                delay = RECONNECT_MIN_DELAY
+
+    # MQTT callbacks (called from the event loop via loop_read)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        client.subscribe(_subscriptions(self._subscribe_topics, self._status_topics))
+        if not self._connected.done():
+            self._connected.set_result(rc)
+
+    def _on_disconnect(self, client, userdata, rc):
+        # results that were on their way are lost with the (clean) session
+        if rc == mqtt_client.MQTT_ERR_SUCCESS:
+            error = ConnectionError(f"Disconnected from {self.host}:{self.port}")
+        else:
+            error = ConnectionError(
+                f"Lost the connection to {self.host}:{self.port} "
+                f"({mqtt_client.error_string(rc)})"
+            )
+        for future in self.router.pop_waiters():
+            if not future.done():
+                future.set_exception(error)
+
+    def _on_message(self, client, userdata, msg):
+        if _matches_any(self._status_topics, msg.topic):
+            self.devices.handle_message(msg.topic, msg.payload)
+            return
+
+        try:
+            results_dicts = parse_results(msg.topic, msg.payload)
+        except ValueError as e:
+            print(
+                f"Ignoring unexpected message on topic {msg.topic} ({e}): {msg.payload}"
+            )
+            return
+
+        for results in results_dicts:
+            busy = is_busy(results)
+            future = self.router.dispatch(results, buffer=not busy)
+            if future is None:
+                # busy replies nobody waits for are dropped, and so are the
+                # results of abandoned attempts
+                if not busy and not self.router.is_discarded(results):
+                    print(
+                        f"Buffering unclaimed results on topic {msg.topic}: {results}"
+                    )
+                continue
+            if future.done():
+                continue
+            if busy:
+                future.set_exception(DeviceBusyError(results))
+            else:
+                future.set_result(results)
+
+    async def connect(self, timeout=10):
+        """
+        Connect to the broker and wait for the connection to be acknowledged.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The number of seconds to wait for the connection, by default 10.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._connected = self._loop.create_future()
+        # NOTE: the TCP/TLS handshake itself blocks, but only once per campaign
+        self.client.connect(self.host, self.port)
+        if self._misc_task is None:
+            self._misc_task = self._loop.create_task(self._misc_loop())
+        try:
+            await asyncio.wait_for(self._connected, timeout)
+        except asyncio.TimeoutError as e:
+            raise TimeoutError(
+                f"Could not connect to {self.host}:{self.port} within {timeout} s"
+            ) from e
+
+    def submit(self, command_topic, payload_dict):
+        """
+        Publish a command and return a future for its results.
+
+        Parameters
+        ----------
+        command_topic : str
+            The MQTT topic to publish the command to.
+        payload_dict : dict
+            The dictionary containing the command and a unique experiment_id.
+
+        Returns
+        -------
+        asyncio.Future
+            A future that is resolved with the results dictionary once a message
+            with the same session_id and experiment_id arrives. If such a
+            message has already arrived, the future is resolved right away and
+            nothing is published.
+        """
+        future = self._loop.create_future()
+        buffered = self.router.expect(payload_dict, future)
+        if buffered is not None:
+            future.set_result(buffered)
+            return future
+        self.client.publish(command_topic, json.dumps(payload_dict), qos=2)
+        return future
+
+    def submit_batch(self, command_topic, payload_dicts, aggregate=False):
+        """
+        Publish several commands as one batch payload (see `make_batch_payload`)
+        and return a future for the results of each.
+
+        Parameters
+        ----------
+        command_topic : str
+            The MQTT topic to publish the batch to.
+        payload_dicts : list of dict
+            The dictionaries containing the command and a unique experiment_id.
+        aggregate : bool, optional
+            Whether the device publishes all of the results in one message, by
+            default False.
+
+        Returns
+        -------
+        list of asyncio.Future
+            A future per payload dictionary, see `submit`. Commands whose results
+            have already arrived are left out of the published batch.
+        """
+        futures, pending = [], []
+        for payload_dict in payload_dicts:
+            future = self._loop.create_future()
+            buffered = self.router.expect(payload_dict, future)
+            if buffered is not None:
+                future.set_result(buffered)
+            else:
+                pending.append(payload_dict)
+            futures.append(future)
+        if pending:
+            batch_payload = make_batch_payload(pending, aggregate=aggregate)
+            self.client.publish(command_topic, json.dumps(batch_payload), qos=2)
+        return futures
+
+    async def run_experiment_batch(
+        self, command_topic, payload_dicts, timeout=300, aggregate=False
+    ):
+        """
+        Publish several commands as one batch payload and wait for all of their
+        results.
+
+        Parameters
+        ----------
+        command_topic : str
+            The MQTT topic to publish the batch to.
+        payload_dicts : list of dict
+            The dictionaries containing the command and a unique experiment_id.
+        timeout : float, optional
+            The number of seconds to wait for all of the results, by default
+            300.
+        aggregate : bool, optional
+            Whether the device publishes all of the results in one message, by
+            default False.
+
+        Returns
+        -------
+        list of dict
+            The results of the experiments, in the order of payload_dicts.
+
+        Raises
+        ------
+        TimeoutError
+            If not all results arrive within the specified timeout.
+        """
+        futures = self.submit_batch(command_topic, payload_dicts, aggregate=aggregate)
+        try:
+            return await asyncio.wait_for(asyncio.gather(*futures), timeout)
+        except asyncio.TimeoutError as e:
+            n_outstanding = sum(not future.done() for future in futures)
+            raise TimeoutError(
+                f"Timed out with {n_outstanding} experiment(s) outstanding "
+                f"({timeout} seconds)"
+            ) from e
+        finally:
+            for payload_dict in payload_dicts:
+                self.router.cancel(payload_dict)
+
+    async def run_experiment(
+        self, command_topic, payload_dict, timeout=30, busy_delay=1
+    ):
+        """
+        Publish a command and wait for its results.
+
+        If the device replies that it is busy (see `DeviceBusyError`), the
+        command is published again after `busy_delay` seconds.
+
+        Parameters
+        ----------
+        command_topic : str
+            The MQTT topic to publish the command to.
+        payload_dict : dict
+            The dictionary containing the command and a unique experiment_id.
+        timeout : float, optional
+            The number of seconds to wait for the results, by default 30.
+        busy_delay : float, optional
+            The number of seconds to wait before retrying a command that the
+            device rejected as busy, by default 1.
+
+        Returns
+        -------
+        dict
+            The results of the experiment, as a dictionary.
+
+        Raises
+        ------
+        TimeoutError
+            If the results don't arrive within the specified timeout.
+        """
+        deadline = self._loop.time() + timeout
+        try:
+            while True:
+                future = self.submit(command_topic, payload_dict)
+                remaining = max(deadline - self._loop.time(), 0)
+                try:
+                    return await asyncio.wait_for(future, remaining)
+                except DeviceBusyError as e:
+                    if self._loop.time() + busy_delay >= deadline:
+                        raise TimeoutError(
+                            f"Device still busy after {timeout} seconds"
+                        ) from e
+                    await asyncio.sleep(busy_delay)
+                except asyncio.TimeoutError as e:
+                    raise TimeoutError(
+                        f"Sensor data retrieval timed out ({timeout} seconds)"
+                    ) from e
+        finally:
+            self.router.cancel(payload_dict)
+
+    async def close(self, timeout=5):
+        """
+        Disconnect from the broker and detach the socket from the loop.
+
+        Experiments that are still waiting for results fail with a
+        ConnectionError.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The number of seconds to wait for the DISCONNECT packet to be sent,
+            after which the socket is closed anyway, by default 5.
+        """
+        if self._misc_task is not None:
+            self._misc_task.cancel()  # so that it doesn't reconnect
+            self._misc_task = None
+        sock = self.client.socket()
+        if sock is None:
+            return
+        self._closed = self._loop.create_future()
+        # the DISCONNECT packet is written once the socket is writable, after
+        # which Paho closes the socket (see _on_socket_close)
+        self.client.disconnect()
+        try:
+            await asyncio.wait_for(self._closed, timeout)
+        except asyncio.TimeoutError:
+            self._loop.remove_reader(sock)
+            self._loop.remove_writer(sock)
+            sock.close()
@@ -0,0 +1,3 @@
+"""Bounded, array-backed history of mock hardware calls, for testing"""
+
+from history_recorder._history_recorder import HistoryRecorder
@@ -0,0 +1,229 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+_INITIAL_SIZE = 64  # records the buffer holds before it first grows
+
+
+class HistoryRecorder:
+    """
+    A bounded history of records, stored in a NumPy structured array that is
+    used as a ring buffer.
+
+    Mocks append one record per call (e.g., one per LED color that was set) so
+    that tests can inspect what happened. Unlike a plain list, memory use is
+    capped at `capacity` records: the buffer starts small and doubles as
+    needed up to `capacity`, and once full, the oldest records are either
+    overwritten or, if `spill_dir` is given, the buffer is written to
+    ``history_<id>_<n>.npy`` files in that directory before it is reused.
+
+    Values of integer fields are rounded to the nearest integer (rather than
+    truncated, e.g., for fractional RGB power levels from an optimizer), and
+    ones that can't be, such as NaN, raise a ValueError.
+
+    Indexing and iteration behave like the list the history used to be, i.e.,
+    records come back as tuples (or dicts, with ``as_dicts=True``), oldest
+    first, and cover the records that are still in memory.
+
+    Parameters
+    ----------
+    fields : list of str
+        The field names of a record.
+    dtype : numpy.dtype, str or dict, optional
+        The data type of every field, or a dict mapping field names to data
+        types (fields that are missing from it are float), by default float.
+    capacity : int, optional
+        The maximum number of records kept in memory, by default 100000. Only
+        as much memory as the records need is allocated.
+    spill_dir : str, optional
+        A directory to write full buffers to instead of overwriting the oldest
+        records, by default None.
+    as_dicts : bool, optional
+        Whether records are returned as dicts instead of tuples, by default
+        False.
+
+    Attributes
+    ----------
+    n_recorded : int
+        The total number of records appended.
+    n_spilled : int
+        The number of records written to `spill_dir`.
+    n_dropped : int
+        The number of records overwritten without being spilled.
+
+    Examples
+    --------
+    >>> history = HistoryRecorder(["R", "G", "B"], dtype=int, capacity=2)
+    >>> for color in [(255, 0, 0), (0, 255, 0), (0, 0, 255)]:
+    ...     history.append(color)
+    >>> history[-1]
+    (0, 0, 255)
+    >>> len(history), history.n_dropped
+    (2, 1)
+    >>> history.to_dataframe()
+       R    G    B
+    0  0  255    0
+    1  0    0  255
+    """
+
+    def __init__(
+        self, fields, dtype=float, capacity=100000, spill_dir=None, as_dicts=False
+    ):
+        if capacity < 1:
+            raise ValueError(f"capacity must be at least 1, not {capacity}")
+        self.fields = list(fields)
+        if isinstance(dtype, dict):
+            self.dtype = np.dtype([(f, dtype.get(f, float)) for f in self.fields])
+        else:
+            self.dtype = np.dtype([(field, dtype) for field in self.fields])
+        self.capacity = capacity
+        self.spill_dir = spill_dir
+        self.as_dicts = as_dicts
+        self.n_recorded = 0
+        self.n_spilled = 0
+        self.n_dropped = 0
+        self._int_fields = [
+            field
+            for field in self.fields
+            if np.issubdtype(self.dtype[field], np.integer)
+        ]
+        self._buffer = np.zeros(min(capacity, _INITIAL_SIZE), dtype=self.dtype)
+        self._start = 0  # index of the oldest record in the buffer
+        self._size = 0
+        self._spill_paths = []
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._to_record(r) for r in self.to_array()[index].tolist()]
+        if not -self._size <= index < self._size:
+            raise IndexError("history index out of range")
+        position = (self._start + index % self._size) % len(self._buffer)
+        return self._to_record(self._buffer[position].tolist())
+
+    def __iter__(self):
+        for record in self.to_array().tolist():
+            yield self._to_record(record)
+
+    def _to_record(self, values):
+        return dict(zip(self.fields, values)) if self.as_dicts else values
+
+    def append(self, record):
+        """
+        Append a record.
+
+        Parameters
+        ----------
+        record : tuple or dict
+            The values of the fields, in order, or keyed by field name.
+        """
+        if isinstance(record, dict):
+            record = tuple(record[field] for field in self.fields)
+        record = tuple(
+            _round(value, field) if field in self._int_fields else value
+            for field, value in zip(self.fields, record)
+        )
+        self._grow(self._size + 1)
+        if self._size == self.capacity:
+            self._make_room(1)
+        self._buffer[(self._start + self._size) % len(self._buffer)] = record
+        self._size += 1
+        self.n_recorded += 1
+
+    def extend(self, records):
+        """
+        Append many records at once.
+
+        Parameters
+        ----------
+        records : array_like
+            An (N, len(fields)) array of values, with columns in field order.
+        """
+        records = np.asarray(records).reshape(-1, len(self.fields))
+        for chunk_start in range(0, len(records), self.capacity):
+            chunk = records[chunk_start : chunk_start + self.capacity]
+            n = len(chunk)
+            self._grow(self._size + n)
+            self._make_room(n - (self.capacity - self._size))
+            positions = (self._start + self._size + np.arange(n)) % len(self._buffer)
+            for i, field in enumerate(self.fields):
+                column = chunk[:, i]
+                if field in self._int_fields:
+                    column = _round(column, field)
+                self._buffer[field][positions] = column
+            self._size += n
+            self.n_recorded += n
+
+    def _grow(self, n):
+        """Enlarge the buffer (up to `capacity`) to hold at least `n` records."""
+        size = len(self._buffer)
+        if n <= size or size == self.capacity:
+            return
+        buffer = np.zeros(min(self.capacity, max(2 * size, n)), dtype=self.dtype)
+        buffer[: self._size] = self.to_array()
+        self._buffer = buffer
+        self._start = 0
+
+    def _make_room(self, n):
+        """Free up at least `n` slots, spilling the buffer or dropping records."""
+        if n <= 0:
+            return
+        if self.spill_dir is not None:
+            self._spill()
+        else:
+            self._start = (self._start + n) % self.capacity
+            self._size -= n
+            self.n_dropped += n
+
+    def _spill(self):
+        n = len(self._spill_paths)
+        path = os.path.join(self.spill_dir, f"history_{id(self):x}_{n:06d}.npy")
+        np.save(path, self.to_array())
+        self._spill_paths.append(path)
+        self.n_spilled += self._size
+        self._start = 0
+        self._size = 0
+
+    def clear(self):
+        """Forget the records in memory (spilled files are kept)."""
+        self._start = 0
+        self._size = 0
+
+    def to_array(self):
+        """Return the records in memory as a structured array, oldest first."""
+        positions = (self._start + np.arange(self._size)) % len(self._buffer)
+        return self._buffer[positions]
+
+    def to_dataframe(self, include_spilled=True):
+        """
+        Export the history to a DataFrame, oldest first.
+
+        Parameters
+        ----------
+        include_spilled : bool, optional
+            Whether to also load the records that were spilled to disk, by
+            default True.
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per record and one column per field.
+        """
+        arrays = []
+        if include_spilled and self.spill_dir is not None:
+            arrays.extend(np.load(path) for path in self._spill_paths)
+        arrays.append(self.to_array())
+        return pd.DataFrame(np.concatenate(arrays), columns=self.fields)
+
+
+def _round(values, field):
+    """Round values to the nearest integer for an integer field."""
+    rounded = np.rint(np.asarray(values, dtype=float))
+    if not np.all(np.isfinite(rounded)):
+        raise ValueError(f"{field} must be finite to be stored as an integer")
+    return rounded.astype(np.int64) if rounded.ndim else int(rounded)
@@ -1,6 +1,8 @@
 import numpy as np
 from sklearn.metrics import mean_absolute_error
 
+from history_recorder import HistoryRecorder
+
 
 class LightMixer:
     """
@@ -13,6 +15,18 @@ class LightMixer:
     defined as the mean absolute error between the given sensor data and the
     target sensor data.
 
+    Parameters
+    ----------
+    noise : float, optional
+        The level of noise to add to the sensor data, by default 0.1.
+    history_capacity : int, optional
+        The maximum number of experiments kept in the (testing) history, by
+        default 100000. The history grows as experiments are run, and R, G and
+        B are recorded rounded to integers.
+    history_spill_dir : str, optional
+        A directory to write the history to once it is full, instead of
+        dropping the oldest experiments, by default None.
+
     Attributes
     ----------
     noise : float
@@ -43,15 +57,19 @@ class LightMixer:
     run_color_experiment(R, G, B):
         Calculate sensor intensity values for different wavelengths based on the
         power levels of red, green, and blue LEDs.
+    run_color_experiment_batch(rgb):
+        Calculate sensor intensity values for an (N, 3) array of power levels.
     calculate_objective(sensor_data):
         Calculates the objective function value for a given sensor data.
+    calculate_objective_batch(intensities):
+        Calculates the objective function values for an (N, 8) array of
+        sensor intensities.
     calculate_rgb_mismatch(R, G, B):
         Calculate the mismatch between the target color and the actual color
         based on the power levels of red, green, and blue LEDs.
     """
 
-    def __init__(self, noise=0.1):
-        self._history = []  # for testing
+    def __init__(self, noise=0.1, history_capacity=100000, history_spill_dir=None):
         self.noise = noise
         self.rng = np.random.default_rng(42)
 
@@ -59,6 +77,15 @@ class LightMixer:
         self.wavelengths = [410, 440, 470, 510, 550, 583, 620, 670]
         self.wavelength_names = [f"ch{wavelength}" for wavelength in self.wavelengths]
 
+        # for testing
+        self._history = HistoryRecorder(
+            ["R", "G", "B", *self.wavelength_names],
+            dtype={"R": int, "G": int, "B": int},
+            capacity=history_capacity,
+            spill_dir=history_spill_dir,
+            as_dicts=True,
+        )
+
         # Coefficients for how each LED affects the sensor intensity at each wavelength, adjusted for typical color wavelengths
 
         # Stronger influence at longer wavelengths (red)
@@ -70,6 +97,11 @@ class LightMixer:
         # Stronger influence at shorter wavelengths (blue)
         self.blue_coefficients = [0.9, 1.0, 0.8, 0.6, 0.4, 0.2, 0.1, 0.0]
 
+        # (3, 8) matrix mapping RGB power levels to sensor intensities
+        self.coefficients = np.array(
+            [self.red_coefficients, self.green_coefficients, self.blue_coefficients]
+        )
+
         self.target_color = {"R": 255, "G": 127, "B": 63}
 
         self.target_sensor_data = self.run_color_experiment(**self.target_color)
@@ -117,23 +149,46 @@ class LightMixer:
             "ch670": 230.0,
         }
         """
+        intensities = self.run_color_experiment_batch([[R, G, B]])[0]
+        return dict(zip(self.wavelength_names, intensities.tolist()))
+
+    def run_color_experiment_batch(self, rgb):
+        """
+        Calculate sensor intensity values for many RGB power levels at once,
+        using one matrix multiplication and one vectorized noise draw.
+
+        For the same random number generator state, the results match calling
+        `run_color_experiment` on each row in turn (up to floating-point rounding).
+
+        Parameters
+        ----------
+        rgb : array_like
+            An (N, 3) array of red, green, and blue power levels (0-255).
+
+        Returns
+        -------
+        numpy.ndarray
+            An (N, 8) array of sensor intensities, with columns in the order of
+            `wavelength_names`.
+
+        Examples
+        --------
+        >>> mixer = LightMixer()
+        >>> mixer.run_color_experiment_batch([[255, 127, 63], [0, 0, 255]]).shape
+        (2, 8)
+        """
+        rgb = np.asarray(rgb, dtype=float).reshape(-1, 3)
+
         # Calculate sensor intensity for each wavelength
-        sensor_data = {}
-        for i, wavelength_name in enumerate(self.wavelength_names):
-            intensity = (
-                self.red_coefficients[i] * R
-                + self.green_coefficients[i] * G
-                + self.blue_coefficients[i] * B
-            )
-            # Add noise
-            intensity = self.rng.normal(intensity, self.noise * intensity)
-            sensor_data[wavelength_name] = intensity
-
-        self._history.append({"R": R, "G": G, "B": B, **sensor_data})
+        intensities = rgb @ self.coefficients
+        # Add noise
+        intensities = self.rng.normal(intensities, self.noise * intensities)
+
+        self._history.extend(np.hstack([rgb, intensities]))
 
         self._run_color_experiment_called = True  # for testing
 
-        return sensor_data
+        return intensities
 
     def calculate_objective(self, sensor_data):
         """
@@ -175,6 +230,35 @@ class LightMixer:
         self._calculate_objective_called = True  # for testing
         return score
 
+    def calculate_objective_batch(self, intensities):
+        """
+        Calculates the objective function values for many sensor readings at
+        once, i.e., the mean absolute error of each row with respect to the
+        target sensor data.
+
+        Parameters
+        ----------
+        intensities : array_like
+            An (N, 8) array of sensor intensities, with columns in the order of
+            `wavelength_names`, e.g., from `run_color_experiment_batch`.
+
+        Returns
+        -------
+        numpy.ndarray
+            An (N,) array of mean absolute errors.
+
+        Examples
+        --------
+        >>> mixer = LightMixer()
+        >>> intensities = mixer.run_color_experiment_batch([[255, 127, 63]])
+        >>> mixer.calculate_objective_batch(intensities)
+        array([4.2])  # hypothetical output
+        """
+        target = np.array([self.target_sensor_data[k] for k in self.wavelength_names])
+        scores = np.abs(np.asarray(intensities, dtype=float) - target).mean(axis=1)
+        self._calculate_objective_called = True  # for testing
+        return scores
+
     def calculate_rgb_mismatch(self, R, G, B):
         """
         Calculate the mismatch between the target color and the actual color
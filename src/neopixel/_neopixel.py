@@ -11,6 +11,8 @@ This module provides a driver for WS2818 / NeoPixel LEDs.
    directly from :term:`micropython-lib` and copy it to the filesystem.
 """
 
+from history_recorder import HistoryRecorder
+
 
 class Incomplete:
     pass
@@ -24,8 +26,15 @@ class NeoPixel:
         - *n* is the number of LEDs in the strip.
         - *bpp* is 3 for RGB LEDs, and 4 for RGBW LEDs.
         - *timing* is 0 for 400KHz, and 1 for 800kHz LEDs (most are 800kHz).
+
+    For testing, every color that is set is recorded in ``_history``, which
+    keeps at most ``history_capacity`` colors (spilled to ``history_spill_dir``
+    instead of dropped, if set) and grows as colors are set.
     """
 
+    history_capacity = 100000  # For testing purposes
+    history_spill_dir = None  # For testing purposes
+
     ORDER: Incomplete
     pin: Incomplete
     n: Incomplete
@@ -39,7 +48,12 @@ class NeoPixel:
         self.bpp = bpp
         self.timing = timing
         self.pixels = [(0, 0, 0)] * n
-        self._history = []  # This is for testing purposes
+        self._history = HistoryRecorder(
+            "RGBW"[:bpp],
+            dtype=int,
+            capacity=self.history_capacity,
+            spill_dir=self.history_spill_dir,
+        )  # This is for testing purposes
 
     def __len__(self) -> int:
         """